@@ -19,6 +19,11 @@
 
 import math
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 
 from tests import base
 
@@ -26,6 +31,31 @@ JPEGHeader = '\xff\xd8\xff'
 PNGHeader = '\x89PNG'
 
 
+class FakeTransport(object):
+    """
+    Record what a protocol does with its transport.
+    """
+    def __init__(self):
+        self.paused = False
+        self.closing = False
+        self.written = []
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def is_closing(self):
+        return self.closing
+
+    def writelines(self, data):
+        self.written.extend(data)
+
+    def close(self):
+        self.closing = True
+
+
 class LargeImageGirderlessTest(base.TestCase):
     def _testTilesZXY(self, source, metadata, tileParams={},
                       imgHeader=JPEGHeader):
@@ -93,6 +123,39 @@ class LargeImageGirderlessTest(base.TestCase):
         # Make sure we are running in a girderless environment
         self.assertIsNone(tilesource.girder)
 
+    def testLazyImport(self):
+        # Importing large_image shouldn't import any tile source backends, so
+        # check that in a fresh interpreter and measure how long it takes.
+        output = subprocess.check_output([sys.executable, '-c', """
+import sys
+import time
+start = time.time()
+import large_image
+print(time.time() - start)
+print(','.join(sorted(
+    name for name in ('libtiff', 'openslide', 'PIL.ImageFont')
+    if name in sys.modules)))
+from large_image import tilesource
+tilesource.TiffFileTileSource
+print('libtiff' in sys.modules)
+"""]).decode('utf8').strip().split('\n')
+        self.assertLess(float(output[0]), 2)
+        self.assertEqual(output[1], '')
+        self.assertEqual(output[2], 'True')
+
+        # Only the sources that can be imported are exported, so a missing
+        # backend doesn't break "import *"
+        output = subprocess.check_output([sys.executable, '-c', """
+import sys
+sys.modules['openslide'] = None
+from large_image.server.tilesource import *
+from large_image import tilesource
+print('SVSFileTileSource' in tilesource.__all__)
+print('TiffFileTileSource' in tilesource.__all__)
+print(TiffFileTileSource.__name__)
+"""]).decode('utf8').strip().split('\n')
+        self.assertEqual(output[-3:], ['False', 'True', 'TiffFileTileSource'])
+
     def testTilesFromPTIF(self):
         from large_image import tilesource
 
@@ -116,6 +179,810 @@ class LargeImageGirderlessTest(base.TestCase):
         tileMetadata['sparse'] = 5
         self._testTilesZXY(source, tileMetadata)
 
+    def testMappedJpegTiles(self):
+        from large_image import tilesource
+
+        source = tilesource.AvailableTileSources['tifffile'](
+            os.path.join(os.environ['LARGE_IMAGE_DATA'],
+                         'sample_image.ptif'))
+        directory = source._tiffDirectories[5]
+        self.assertIsNotNone(directory._fileMap)
+        images = [directory.getTile(x, y) for x, y in ((0, 0), (7, 1))]
+        for image in images:
+            self.assertEqual(image[:len(JPEGHeader)], JPEGHeader)
+            self.assertEqual(image[-2:], b'\xff\xd9')
+        # Tiles copied from the mapped file match those read by libtiff
+        fileMap = directory._fileMap
+        directory._fileMap = None
+        try:
+            self.assertEqual(
+                [directory.getTile(x, y) for x, y in ((0, 0), (7, 1))], images)
+        finally:
+            directory._fileMap = fileMap
+
+    def testTranscodedTiles(self):
+        import PIL.Image
+        import six
+        from large_image import tilesource
+
+        path = os.path.join(os.environ['LARGE_IMAGE_DATA'],
+                            'sample_image.ptif')
+        stored = tilesource.AvailableTileSources['tifffile'](path).getTile(
+            0, 0, 0)
+        # Edge tiles are never treated as uniform, so this is a stored JPEG.
+        # Asking for a quality re-encodes the stored JPEGs
+        source = tilesource.AvailableTileSources['tifffile'](
+            path, jpegQuality=30)
+        tile = source.getTile(0, 0, 0)
+        self.assertEqual(tile[:len(JPEGHeader)], JPEGHeader)
+        self.assertLess(len(tile), len(stored))
+        # Transcoded tiles are cached by tile source, encoding, and quality
+        self.assertIs(source.getTile(0, 0, 0), tile)
+        self.assertIs(tilesource.AvailableTileSources['tifffile'](
+            path, jpegQuality=30), source)
+        self.assertEqual(PIL.Image.open(six.BytesIO(tile)).size, (256, 256))
+
+        if 'WEBP' not in tilesource.TileSource.outputMimeTypes:
+            return
+        source = tilesource.AvailableTileSources['tifffile'](
+            path, encoding='WEBP', jpegQuality=50)
+        self.assertEqual(source.getTileMimeType(), 'image/webp')
+        tile = source.getTile(0, 0, 0)
+        self.assertEqual(tile[:4], b'RIFF')
+        self.assertEqual(tile[8:12], b'WEBP')
+        self.assertLess(len(tile), len(stored))
+        thumbData, thumbMime = source.getThumbnail(encoding='WEBP')
+        self.assertEqual(thumbMime, 'image/webp')
+        self.assertEqual(thumbData[8:12], b'WEBP')
+
+    def _writeTiledTiff(self, path, data, compression, photometric,
+                        tileSize=256, missingTiles=()):
+        """
+        Write a tiled pyramidal TIFF file without using JPEG compression.
+
+        :param path: the output path.
+        :param data: a numpy array of the full resolution image with shape
+                     (height, width, samples).
+        :param compression: the libtiff compression constant.
+        :param photometric: the libtiff photometric constant.
+        :param tileSize: the width and height of the tiles.
+        :param missingTiles: a list of (x, y) tiles that aren't written in
+                             the full resolution level.
+        """
+        import numpy
+        from libtiff import libtiff_ctypes
+
+        tiff = libtiff_ctypes.TIFF.open(path, 'w')
+        fullResolution = True
+        while True:
+            height, width, samples = data.shape
+            tiff.SetField('ImageWidth', width)
+            tiff.SetField('ImageLength', height)
+            tiff.SetField('BitsPerSample', data.dtype.itemsize * 8)
+            tiff.SetField('SamplesPerPixel', samples)
+            tiff.SetField('Compression', compression)
+            tiff.SetField('Photometric', photometric)
+            tiff.SetField('PlanarConfig', libtiff_ctypes.PLANARCONFIG_CONTIG)
+            tiff.SetField('Orientation', libtiff_ctypes.ORIENTATION_TOPLEFT)
+            tiff.SetField('TileWidth', tileSize)
+            tiff.SetField('TileLength', tileSize)
+            for y in range(0, height, tileSize):
+                for x in range(0, width, tileSize):
+                    if (fullResolution and
+                            (x // tileSize, y // tileSize) in missingTiles):
+                        continue
+                    tile = numpy.zeros((tileSize, tileSize, samples),
+                                       data.dtype)
+                    part = data[y:y + tileSize, x:x + tileSize]
+                    tile[:part.shape[0], :part.shape[1]] = part
+                    libtiff_ctypes.libtiff.TIFFWriteTile(
+                        tiff, tile.ctypes.data, x, y, 0, 0)
+            tiff.WriteDirectory()
+            if width <= tileSize and height <= tileSize:
+                break
+            data = data[::2, ::2]
+            fullResolution = False
+        tiff.close()
+
+    def testTileServer(self):
+        import time
+        from large_image import tilesource
+        from large_image.server.tilesource import signing, tileserver
+
+        token = signing.signToken(
+            'secret', {'assetstore': 'a1', 'path': 'ab/cd/abcd'},
+            time.time() + 60)
+        self.assertEqual(signing.verifyToken('secret', token)['path'],
+                         'ab/cd/abcd')
+        for secret, badToken in (('secret', token + 'x'),
+                                 ('secret', token.split('.')[0]),
+                                 ('secret', 'a.b'), ('other', token)):
+            with self.assertRaises(tilesource.TileSourceException):
+                signing.verifyToken(secret, badToken)
+        with self.assertRaises(tilesource.TileSourceException):
+            signing.verifyToken('secret', token, now=time.time() + 120)
+
+        # Serve the test source in place of the files the tokens name
+        root = tempfile.mkdtemp()
+        getTileSource = tileserver.getTileSource
+        paths = []
+
+        def getTestSource(path):
+            paths.append(path)
+            return getTileSource('large_image://test')
+
+        tileserver.getTileSource = getTestSource
+        try:
+            self._testTileServer(tileserver, root, token)
+        finally:
+            tileserver.getTileSource = getTileSource
+            shutil.rmtree(root)
+        self.assertEqual(paths[0], os.path.join(root, 'ab', 'cd', 'abcd'))
+
+    def _testTileServer(self, tileserver, root, token):
+        import json
+        import six
+        import threading
+        import time
+        from large_image.server.tilesource import signing
+
+        server = tileserver.TileServer('secret', {'a1': root})
+        status, headers, body = server.handle(
+            'GET', '/tiles/%s/0/0/0' % token)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'image/png')
+        self.assertEqual(body[:len(PNGHeader)], six.b(PNGHeader))
+        self.assertIn('max-age', headers['Cache-Control'])
+        tile = body
+        status, headers, body = server.handle('GET', '/tiles/%s' % token)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode('utf8'))['tileWidth'], 256)
+        for target, expectedStatus in (
+                ('/tiles/%s/0/1/0' % token, 404),
+                ('/tiles/%s/0/a/0' % token, 400),
+                ('/tiles/%s/0/0/0' % token.replace('.', ''), 403),
+                ('/other/%s' % token, 404)):
+            self.assertEqual(server.handle('GET', target)[0], expectedStatus)
+        self.assertEqual(server.handle(
+            'POST', '/tiles/%s/0/0/0' % token)[0], 405)
+        # Tokens can only name files within known assetstores
+        for payload in ({'assetstore': 'a2', 'path': 'ab/cd/abcd'},
+                        {'assetstore': 'a1', 'path': '../abcd'},
+                        {'assetstore': 'a1', 'path': '/etc/passwd'},
+                        {'assetstore': 'a1'}):
+            badToken = signing.signToken('secret', payload, time.time() + 60)
+            self.assertEqual(server.handle(
+                'GET', '/tiles/%s/0/0/0' % badToken)[0], 403)
+
+        if tileserver.asyncio is None:
+            return
+        # Reading stops while a request is answered, so pipelined requests
+        # don't accumulate
+        loop = tileserver.asyncio.new_event_loop()
+        transport = FakeTransport()
+        protocol = tileserver.TileServerProtocol(server, loop)
+        protocol.connection_made(transport)
+        try:
+            protocol.data_received(
+                six.b('GET /tiles/%s HTTP/1.1\r\n\r\n' % token) * 3)
+            self.assertTrue(transport.paused)
+            for _ in range(500):
+                if len(transport.written) == 6:
+                    break
+                loop.run_until_complete(tileserver.asyncio.sleep(0.01))
+            self.assertEqual(len(transport.written), 6)
+            self.assertFalse(transport.paused)
+            self.assertEqual(protocol.buffer, b'')
+        finally:
+            protocol.connection_lost(None)
+            loop.close()
+
+        # Serve requests over a socket, reusing the connection
+        from six.moves import http_client
+
+        thread = threading.Thread(target=server.serve, kwargs={'port': 0})
+        thread.start()
+        try:
+            self.assertTrue(server.ready.wait(10))
+            conn = http_client.HTTPConnection('127.0.0.1', server.port,
+                                              timeout=10)
+            conn.request('GET', '/tiles/%s/0/0/0' % token)
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 200)
+            self.assertEqual(resp.getheader('Content-Type'), 'image/png')
+            self.assertEqual(resp.read(), tile)
+            conn.request('GET', '/tiles/%s/0/1/0' % token)
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 404)
+            self.assertIn('message', json.loads(resp.read().decode('utf8')))
+            conn.close()
+        finally:
+            server.stop()
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+    def testTilesFromGenericTiff(self):
+        import numpy
+        import PIL.Image
+        import six
+        from libtiff import libtiff_ctypes
+        from large_image import tilesource
+
+        tempDir = tempfile.mkdtemp()
+        try:
+            yy, xx = numpy.mgrid[0:700, 0:1000]
+            gray = ((xx + yy) % 256).astype(numpy.uint8)[:, :, numpy.newaxis]
+            rgb = numpy.dstack((gray, 255 - gray, (xx % 256).astype(
+                numpy.uint8)))
+            for name, data, compression, photometric in (
+                    ('gray.tiff', gray,
+                     libtiff_ctypes.COMPRESSION_ADOBE_DEFLATE,
+                     libtiff_ctypes.PHOTOMETRIC_MINISBLACK),
+                    ('rgb.tiff', rgb, libtiff_ctypes.COMPRESSION_LZW,
+                     libtiff_ctypes.PHOTOMETRIC_RGB)):
+                path = os.path.join(tempDir, name)
+                self._writeTiledTiff(path, data, compression, photometric)
+                source = tilesource.TiffFileTileSource(path)
+                tileMetadata = source.getMetadata()
+                self.assertEqual(tileMetadata['tileWidth'], 256)
+                self.assertEqual(tileMetadata['sizeX'], 1000)
+                self.assertEqual(tileMetadata['sizeY'], 700)
+                self.assertEqual(tileMetadata['levels'], 3)
+                self._testTilesZXY(source, tileMetadata)
+                self.assertEqual(source.getTileMimeType(), 'image/jpeg')
+                # Re-encoded tiles are cached
+                self.assertIs(source.getTile(1, 1, 2),
+                              source.getTile(1, 1, 2))
+
+                params = {'encoding': 'PNG'}
+                source = tilesource.TiffFileTileSource(path, **params)
+                self._testTilesZXY(source, tileMetadata, params, PNGHeader)
+                image = numpy.asarray(PIL.Image.open(six.BytesIO(
+                    source.getTile(1, 2, 2))))
+                self.assertTrue(numpy.array_equal(
+                    image.reshape(image.shape[:2] + (-1, ))[:188],
+                    data[512:700, 256:512]))
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testSparseFallback(self):
+        import numpy
+        from libtiff import libtiff_ctypes
+        from large_image import tilesource
+
+        tempDir = tempfile.mkdtemp()
+        try:
+            yy, xx = numpy.mgrid[0:1024, 0:1024]
+            data = numpy.dstack((xx // 4, yy // 4, xx // 8)).astype(
+                numpy.uint8)
+            path = os.path.join(tempDir, 'sparse.tiff')
+            self._writeTiledTiff(path, data, libtiff_ctypes.COMPRESSION_LZW,
+                                 libtiff_ctypes.PHOTOMETRIC_RGB,
+                                 missingTiles=[(1, 1), (2, 1)])
+            source = tilesource.TiffFileTileSource(path, encoding='PNG')
+            self.assertEqual(source.getMetadata()['levels'], 3)
+            self.assertTrue(source._tiffDirectories[2].isTileMissing(1, 1))
+            self.assertFalse(source._tiffDirectories[2].isTileMissing(0, 1))
+            with self.assertRaises(tilesource.TileSourceException):
+                source.getTile(1, 1, 2)
+            # Missing tiles can be generated as encoded images or PIL images
+            tile = source.getTile(1, 1, 2, sparseFallback=True)
+            self.assertEqual(tile[:len(PNGHeader)], PNGHeader)
+            image = source.getTile(2, 1, 2, pilImageAllowed=True,
+                                   sparseFallback=True)
+            self.assertEqual(image.size, (256, 256))
+            # The generated tile is the upsampled quadrant of its parent
+            pixel = image.getpixel((100, 100))
+            self.assertLessEqual(abs(pixel[0] - (512 + 100) // 4), 1)
+            self.assertLessEqual(abs(pixel[1] - (256 + 100) // 4), 1)
+            # Both missing tiles share the decoded parent
+            self.assertIs(
+                source._getParentTileImage(1, 0, 1),
+                source._getParentTileImage(1, 0, 1))
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testUniformTiles(self):
+        import numpy
+        import PIL.Image
+        import six
+        from libtiff import libtiff_ctypes
+        from large_image import tilesource
+
+        tempDir = tempfile.mkdtemp()
+        try:
+            yy, xx = numpy.mgrid[0:1024, 0:1024]
+            data = numpy.dstack((xx // 4, yy // 4, xx // 8)).astype(
+                numpy.uint8)
+            # The left half is background
+            data[:, :512] = 200
+            path = os.path.join(tempDir, 'background.tiff')
+            self._writeTiledTiff(path, data, libtiff_ctypes.COMPRESSION_LZW,
+                                 libtiff_ctypes.PHOTOMETRIC_RGB)
+            source = tilesource.TiffFileTileSource(path, encoding='PNG')
+            self.assertEqual(source.getUniformTileColor(0, 0, 2),
+                             (200, 200, 200))
+            self.assertEqual(source.getUniformTileColor(1, 3, 2),
+                             (200, 200, 200))
+            self.assertIsNone(source.getUniformTileColor(2, 0, 2))
+            self.assertEqual(source._getUniformTileCandidates(2),
+                             set((x, y) for x in range(2) for y in range(4)))
+            # Uniform tiles share one encoded tile
+            self.assertIs(source.getTile(0, 0, 2), source.getTile(1, 2, 2))
+            image = PIL.Image.open(six.BytesIO(source.getTile(0, 0, 2)))
+            self.assertEqual(image.getcolors(), [(256 * 256, (200, 200, 200))])
+            # Regions are filled without decoding uniform tiles
+            regionData, regionMime = source.getRegion(
+                left=100, top=100, right=700, bottom=300, encoding='PNG')
+            region = numpy.asarray(PIL.Image.open(six.BytesIO(regionData)))
+            self.assertEqual(region.shape, (200, 600, 4))
+            self.assertTrue((region[:, :412, :3] == 200).all())
+            self.assertEqual(region[10, 500, :3].tolist(), [
+                (600 // 4), (110 // 4), (600 // 8)])
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testTissueMask(self):
+        import numpy
+        import PIL.Image
+        from large_image.server.tilesource import tissue
+
+        # A pink blob with a speck of dust on glass
+        data = numpy.full((200, 300, 3), 235, dtype=numpy.uint8)
+        yy, xx = numpy.mgrid[0:200, 0:300]
+        blob = (xx - 100) ** 2 + (yy - 80) ** 2 < 40 ** 2
+        data[blob] = (200, 120, 170)
+        data[150, 250] = (0, 0, 0)
+        data[151, 251] = (30, 30, 30)
+        mask, threshold = tissue.computeTissueMask(
+            PIL.Image.fromarray(data, 'RGB'))
+        self.assertTrue(160 < threshold < 235)
+        self.assertTrue(mask[80, 100])
+        self.assertFalse(mask[10, 10])
+        self.assertFalse(mask[150:152, 250:252].any())
+        self.assertLess(abs(mask.sum() - blob.sum()), blob.sum() * 0.05)
+
+        record = tissue.encodeMask(mask, threshold)
+        self.assertTrue(numpy.array_equal(tissue.decodeMask(record), mask))
+
+        # The mask covers an image 12 times its size with 256 pixel tiles
+        metadata = {'sizeX': 3600, 'sizeY': 2400, 'tileWidth': 256,
+                    'tileHeight': 256, 'levels': 5}
+        occupancy = tissue.getTileOccupancy(mask, metadata, 4)
+        self.assertEqual(occupancy.shape, (10, 15))
+        self.assertTrue(occupancy[3, 4])
+        self.assertFalse(occupancy[9, 14])
+        tiles = list(tissue.iterOccupiedTiles(mask, metadata, 4))
+        self.assertEqual(len(tiles), occupancy.sum())
+        self.assertIn((4, 3), tiles)
+        # Every level has at least one tile, and the lowest has only one
+        self.assertEqual(tissue.getTileOccupancy(
+            mask, metadata, 0).tolist(), [[True]])
+
+    def testStatistics(self):
+        import numpy
+        from libtiff import libtiff_ctypes
+        from large_image import tilesource
+
+        tempDir = tempfile.mkdtemp()
+        try:
+            yy, xx = numpy.mgrid[0:600, 0:700]
+            data = numpy.dstack((
+                (xx + yy) % 256, xx * 50 + 7)).astype(numpy.uint16)
+            path = os.path.join(tempDir, 'stats.tiff')
+            self._writeTiledTiff(path, data, libtiff_ctypes.COMPRESSION_LZW,
+                                 libtiff_ctypes.PHOTOMETRIC_MINISBLACK)
+            source = tilesource.TiffFileTileSource(path)
+            # The image is small, so the full resolution level is used
+            stats = source.getStatistics()
+            self.assertEqual(stats['level'], 2)
+            self.assertEqual(stats['dtype'], 'uint16')
+            self.assertEqual(stats['pixels'], 600 * 700)
+            self.assertEqual(len(stats['channels']), 2)
+            for channel, values in enumerate((data[:, :, 0], data[:, :, 1])):
+                result = stats['channels'][channel]
+                self.assertEqual(result['min'], values.min())
+                self.assertEqual(result['max'], values.max())
+                self.assertAlmostEqual(result['mean'], values.mean(), 3)
+                self.assertAlmostEqual(result['stdev'], values.std(), 3)
+                self.assertEqual(len(result['histogram']), 256)
+                self.assertEqual(len(result['binEdges']), 257)
+                self.assertEqual(sum(result['histogram']), 600 * 700)
+            # Each bin covers 256 values of the 16-bit range
+            self.assertEqual(stats['channels'][0]['histogram'][0], 600 * 700)
+            stats = source.getStatistics(level=0, bins=16)
+            self.assertEqual(stats['level'], 0)
+            self.assertEqual(stats['pixels'], 150 * 175)
+            self.assertEqual(len(stats['channels'][1]['histogram']), 16)
+            with self.assertRaises(tilesource.TileSourceException):
+                source.getStatistics(level=3)
+
+            # Sources without raw data use their 8-bit tiles
+            dummy = tilesource.AvailableTileSources['test'](
+                sizeX=512, sizeY=512, tileWidth=256, tileHeight=256,
+                minLevel=0, maxLevel=1)
+            stats = dummy.getStatistics()
+            self.assertEqual(stats['dtype'], 'uint8')
+            self.assertEqual(len(stats['channels']), 3)
+            self.assertEqual(stats['pixels'], 512 * 512)
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testRetiledTiles(self):
+        import numpy
+        import PIL.Image
+        import six
+        from large_image import tilesource
+        from large_image.server.tilesource.retile import RetiledTileSource
+
+        source = tilesource.AvailableTileSources['test'](
+            sizeX=1000, sizeY=700, tileWidth=256, tileHeight=256, maxLevel=2)
+
+        def getArray(tile):
+            return numpy.asarray(PIL.Image.open(six.BytesIO(tile)))
+
+        # The full resolution level, assembled from the original tiles
+        level = numpy.zeros((768, 1024, 3), dtype=numpy.uint8)
+        for y in range(3):
+            for x in range(4):
+                level[y * 256:(y + 1) * 256, x * 256:(x + 1) * 256] = \
+                    getArray(source.getTile(x, y, 2))
+        level[700:] = level[:, 1000:] = 0
+
+        for tileSize, overlap in ((512, 0), (300, 2), (100, 10)):
+            retiled = RetiledTileSource(source, tileSize, overlap)
+            # Sources are cached
+            self.assertIs(RetiledTileSource(source, tileSize, overlap),
+                          retiled)
+            metadata = retiled.getMetadata()
+            self.assertEqual(metadata['tileWidth'], tileSize)
+            self.assertEqual(metadata['tileHeight'], tileSize)
+            self.assertEqual(metadata['tileOverlap'], overlap)
+            self.assertEqual(metadata['levels'], 3)
+            size = tileSize + overlap * 2
+            padded = numpy.zeros((768 + size * 2, 1024 + size * 2, 3),
+                                 dtype=numpy.uint8)
+            padded[size:size + 768, size:size + 1024] = level
+            lastX, lastY = (1000 - 1) // tileSize, (700 - 1) // tileSize
+            for x, y in ((0, 0), (1, 1), (lastX, lastY)):
+                tile = getArray(retiled.getTile(x, y, 2))
+                self.assertEqual(tile.shape, (size, size, 3))
+                top = y * tileSize - overlap + size
+                left = x * tileSize - overlap + size
+                self.assertTrue(numpy.array_equal(
+                    tile, padded[top:top + size, left:left + size]))
+            with self.assertRaises(tilesource.TileSourceException):
+                retiled.getTile(lastX + 1, 0, 2)
+            with self.assertRaises(tilesource.TileSourceException):
+                retiled.getTile(0, 0, 3)
+        # Lower levels keep the same resolution
+        self.assertEqual(PIL.Image.open(six.BytesIO(RetiledTileSource(
+            source, 512).getTile(0, 0, 0))).size, (512, 512))
+        # Tiles that match the original tiles are passed through
+        self.assertEqual(RetiledTileSource(source, 256).getTile(1, 2, 2),
+                         source.getTile(1, 2, 2))
+        # Tile sizes and overlaps are limited
+        for tileSize, overlap in ((0, 0), (4097, 0), (256, 256), (256, -1)):
+            with self.assertRaises(tilesource.TileSourceException):
+                RetiledTileSource(source, tileSize, overlap)
+
+    def testTilesFromHighBitDepthTiff(self):
+        import numpy
+        import PIL.Image
+        import six
+        from libtiff import libtiff_ctypes
+        from large_image import tilesource
+        from large_image.server.tilesource.style import TileStyle
+
+        tempDir = tempfile.mkdtemp()
+        try:
+            yy, xx = numpy.mgrid[0:600, 0:600]
+            data = numpy.dstack((xx * 100, yy * 100, xx + yy)).astype(
+                numpy.uint16)
+            path = os.path.join(tempDir, 'fluorescence.tiff')
+            self._writeTiledTiff(path, data, libtiff_ctypes.COMPRESSION_LZW,
+                                 libtiff_ctypes.PHOTOMETRIC_MINISBLACK)
+            source = tilesource.TiffFileTileSource(path)
+            tileMetadata = source.getMetadata()
+            self.assertEqual(tileMetadata['channels'], 3)
+            self.assertEqual(tileMetadata['dtype'], 'uint16')
+            self.assertEqual(tileMetadata['levels'], 3)
+            self._testTilesZXY(source, tileMetadata)
+            tile = source.getTileArray(1, 0, 2)
+            self.assertEqual(tile.dtype, numpy.uint16)
+            self.assertTrue(numpy.array_equal(tile, data[:256, 256:512]))
+
+            params = {'encoding': 'PNG', 'channels': '1', 'windowMin': '0',
+                      'windowMax': '25500', 'colormap': 'green'}
+            source = tilesource.TiffFileTileSource(path, **params)
+            self._testTilesZXY(source, tileMetadata, params, PNGHeader)
+            image = numpy.asarray(PIL.Image.open(six.BytesIO(
+                source.getTile(0, 0, 2))))
+            self.assertEqual(image.shape, (256, 256, 3))
+            self.assertLessEqual(abs(int(image[10, 0, 1]) - 10), 1)
+            self.assertGreaterEqual(image[255, 0, 1], 254)
+            self.assertEqual(image[:, :, 0].max(), 0)
+            self.assertEqual(image[:, :, 2].max(), 0)
+
+            with self.assertRaises(tilesource.TileSourceException):
+                tilesource.TiffFileTileSource(path, colormap='notacolor')
+        finally:
+            shutil.rmtree(tempDir)
+
+        # Channels are windowed, colored, and added together
+        style = TileStyle(channels=[0, 1], windowMin='0,100',
+                          windowMax='100,200', colormap='red,#00ff80')
+        tile = numpy.array([[[50, 150, 7], [200, 50, 7]]], dtype=numpy.uint16)
+        self.assertEqual(style.apply(tile).tolist(), [
+            [[127, 127, 63], [255, 0, 0]]])
+        with self.assertRaises(tilesource.TileSourceException):
+            TileStyle(channels=[3]).apply(tile)
+
+    def testVipsProgress(self):
+        from large_image.server import tiff_writer
+
+        progress = []
+        parser = tiff_writer.VipsProgressParser(progress.append, keepLines=3)
+        # Updates are split across reads and separated by carriage returns
+        for chunk in (b'vips temp-0: 1000x1000 8 threads\rvips temp-0: 1% ',
+                      b'complete\rvips temp-0: 1% complete\rvips temp-0: 5',
+                      b'0% complete\r\nwarning: something\n',
+                      b'vips temp-0: done in 1.2s'):
+            parser.feed(chunk)
+        parser.close()
+        self.assertEqual(progress, [1, 50])
+        self.assertEqual(list(parser.lines), [
+            'vips temp-0: 50% complete', 'warning: something',
+            'vips temp-0: done in 1.2s'])
+
+    def testVipsCommandCanceled(self):
+        import six
+        from large_image.server import tiff_writer
+
+        popen = tiff_writer.subprocess.Popen
+        procs = []
+        envs = []
+
+        def fakeVips(command, **kwargs):
+            envs.append(kwargs['env'])
+            # Report some progress, then take much longer than the test
+            procs.append(popen([sys.executable, '-c', (
+                'import sys, time\n'
+                'sys.stdout.write("vips temp-0: 10% complete\\r")\n'
+                'sys.stdout.flush()\n'
+                'time.sleep(60)\n')], **kwargs))
+            return procs[-1]
+
+        def cancel(percent):
+            raise Exception('The conversion job was canceled')
+
+        tiff_writer.subprocess.Popen = fakeVips
+        try:
+            with six.assertRaisesRegex(self, Exception, 'canceled'):
+                tiff_writer.convertWithVipsCommand(
+                    'in.png', 'out.tiff', progress=cancel, concurrency=3)
+        finally:
+            tiff_writer.subprocess.Popen = popen
+        self.assertEqual(len(procs), 1)
+        self.assertIsNotNone(procs[0].poll())
+        # The concurrency is only set for the command
+        self.assertEqual(envs[0]['VIPS_CONCURRENCY'], '3')
+        self.assertNotEqual(os.environ.get('VIPS_CONCURRENCY'), '3')
+
+    def testConversionEngines(self):
+        from large_image.server import tiff_writer
+
+        pyvipsAvailable = tiff_writer._pyvipsAvailable
+        which = tiff_writer.which
+        converters = {name: getattr(tiff_writer, name) for name in (
+            'convertWithPyvips', 'convertWithVipsCommand',
+            'convertWithPillow')}
+        calls = []
+        for name in converters:
+            setattr(tiff_writer, name,
+                    lambda *args, **kwargs: calls.append(args[:2]))
+        try:
+            for hasPyvips, hasVips, engines in (
+                    (True, True, ['pyvips', 'vips', 'pillow']),
+                    (True, False, ['pyvips', 'pillow']),
+                    (False, True, ['vips', 'pillow']),
+                    (False, False, ['pillow'])):
+                tiff_writer._pyvipsAvailable = lambda: hasPyvips
+                tiff_writer.which = \
+                    lambda name: '/usr/bin/vips' if hasVips else None
+                self.assertEqual(tiff_writer.conversionEngines(), engines)
+                self.assertEqual(
+                    tiff_writer.convertImage('in.png', 'out.tiff'),
+                    engines[0])
+                self.assertEqual(calls, [('in.png', 'out.tiff')])
+                del calls[:]
+        finally:
+            tiff_writer._pyvipsAvailable = pyvipsAvailable
+            tiff_writer.which = which
+            for name, func in converters.items():
+                setattr(tiff_writer, name, func)
+
+    def testPyramidTiffWriter(self):
+        import PIL.Image
+        import six
+        from large_image import tilesource
+        from large_image.server import tiff_writer
+
+        tempDir = tempfile.mkdtemp()
+        try:
+            outPath = os.path.join(tempDir, 'yb10kx5k.tiff')
+            progress = []
+            imagePath = os.path.join(os.path.dirname(__file__), 'test_files',
+                                     'yb10kx5k.png')
+            tiff_writer.convertWithPillow(
+                imagePath, outPath, quality=80, progress=progress.append,
+                processes=1)
+            self.assertEqual(progress[-1], 100)
+            canread = tilesource.AvailableTileSources['tifffile'].canRead(
+                outPath)
+            self.assertTrue(canread)
+            source = tilesource.AvailableTileSources['tifffile'](outPath)
+            tileMetadata = source.getMetadata()
+            self.assertEqual(tileMetadata['tileWidth'], 256)
+            self.assertEqual(tileMetadata['tileHeight'], 256)
+            self.assertEqual(tileMetadata['sizeX'], 10000)
+            self.assertEqual(tileMetadata['sizeY'], 5000)
+            self.assertEqual(tileMetadata['levels'], 7)
+            self._testTilesZXY(source, tileMetadata)
+
+            # Encoding bands in worker processes produces the same tiles
+            parallelPath = os.path.join(tempDir, 'parallel.tiff')
+            tiff_writer.convertWithPillow(
+                imagePath, parallelPath, quality=80, processes=3,
+                bandLevels=3)
+            parallelSource = tilesource.AvailableTileSources['tifffile'](
+                parallelPath)
+            self.assertEqual(parallelSource.getMetadata(), tileMetadata)
+            for z in range(tileMetadata['levels']):
+                for (x, y) in ((0, 0), (1, 1), (2, 0)):
+                    try:
+                        tile = source.getTile(x, y, z)
+                    except tilesource.TileSourceException:
+                        continue
+                    self.assertEqual(parallelSource.getTile(x, y, z), tile)
+
+            # An interrupted conversion can be resumed
+            resumePath = os.path.join(tempDir, 'partial.tiff')
+            resumedPath = os.path.join(tempDir, 'resumed.tiff')
+
+            def interrupt(percent):
+                if percent >= 50:
+                    raise Exception('Interrupted')
+
+            with self.assertRaises(Exception):
+                tiff_writer.convertWithPillow(
+                    imagePath, resumedPath, quality=80, progress=interrupt,
+                    processes=1, resumePath=resumePath, checkpointInterval=0)
+            self.assertTrue(os.path.exists(resumePath + '.checkpoint'))
+            progress = []
+            tiff_writer.convertWithPillow(
+                imagePath, resumedPath, quality=80, progress=progress.append,
+                processes=1, resumePath=resumePath, checkpointInterval=0)
+            self.assertGreaterEqual(progress[0], 50)
+            self.assertFalse(os.path.exists(resumePath))
+            self.assertFalse(os.path.exists(resumePath + '.checkpoint'))
+            resumedSource = tilesource.AvailableTileSources['tifffile'](
+                resumedPath)
+            self.assertEqual(resumedSource.getMetadata(), tileMetadata)
+            for z in range(tileMetadata['levels']):
+                for (x, y) in ((0, 0), (1, 1), (2, 0)):
+                    try:
+                        tile = source.getTile(x, y, z)
+                    except tilesource.TileSourceException:
+                        continue
+                    self.assertEqual(resumedSource.getTile(x, y, z), tile)
+
+            # Abandoned partial conversions are removed once they are old
+            with self.assertRaises(Exception):
+                tiff_writer.convertWithPillow(
+                    imagePath, resumedPath, quality=80, progress=interrupt,
+                    processes=1, resumePath=resumePath, checkpointInterval=0)
+            tiff_writer.removeStaleCheckpoints(tempDir, 3600)
+            self.assertTrue(os.path.exists(resumePath))
+            self.assertTrue(os.path.exists(resumePath + '.checkpoint'))
+            for path in (resumePath, resumePath + '.checkpoint'):
+                os.utime(path, (time.time() - 7200, time.time() - 7200))
+            tiff_writer.removeStaleCheckpoints(tempDir, 3600)
+            self.assertFalse(os.path.exists(resumePath))
+            self.assertFalse(os.path.exists(resumePath + '.checkpoint'))
+            self.assertTrue(os.path.exists(resumedPath))
+
+            # Images that must be decoded all at once can be refused
+            with six.assertRaisesRegex(self, Exception, 'too large'):
+                tiff_writer.convertWithPillow(
+                    imagePath, os.path.join(tempDir, 'refused.tiff'),
+                    processes=1, maxPixels=1000000)
+
+            # Uncompressed images are decoded a few rows at a time
+            image = PIL.Image.open(imagePath).crop((0, 0, 1000, 600))
+            rawPath = os.path.join(tempDir, 'raw.tiff')
+            image.convert('RGB').save(rawPath, 'TIFF')
+            rawImage = PIL.Image.open(rawPath)
+            self.assertTrue(tiff_writer.canDecodeRows(rawImage, 1000))
+            rows = tiff_writer.decodeRows(rawPath, 250, 380)
+            self.assertEqual(rows.size, (1000, 130))
+            self.assertEqual(
+                rows.tobytes(), rawImage.crop((0, 250, 1000, 380)).tobytes())
+            tiff_writer.convertWithPillow(
+                rawPath, os.path.join(tempDir, 'fromraw.tiff'), processes=1,
+                maxPixels=1000)
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testPILTileSource(self):
+        import numpy
+        import PIL.Image
+        from large_image import tilesource
+        from large_image.server import tiff_writer
+        from large_image.server.tilesource.pil import PILFileTileSource
+
+        tempDir = tempfile.mkdtemp()
+        try:
+            imagePath = os.path.join(os.path.dirname(__file__), 'test_files',
+                                     'yb10kx5k.png')
+            # Compressed images that must be decoded all at once aren't read
+            with self.assertRaises(tilesource.TileSourceException):
+                PILFileTileSource(imagePath)
+            image = PIL.Image.open(imagePath).convert('RGB').crop(
+                (0, 0, 1000, 600))
+            rawPath = os.path.join(tempDir, 'raw.tiff')
+            image.save(rawPath, 'TIFF')
+            source = PILFileTileSource(rawPath, encoding='PNG')
+            tileMetadata = source.getMetadata()
+            self.assertEqual(tileMetadata['sizeX'], 1000)
+            self.assertEqual(tileMetadata['sizeY'], 600)
+            self.assertEqual(tileMetadata['levels'], 3)
+            # Tiles match reductions of the whole image
+            level = numpy.asarray(image)
+            for z in range(tileMetadata['levels'] - 1, -1, -1):
+                for y in range(-(-level.shape[0] // 256)):
+                    for x in range(-(-level.shape[1] // 256)):
+                        expected = numpy.zeros((256, 256, 3), numpy.uint8)
+                        data = level[y * 256:(y + 1) * 256,
+                                     x * 256:(x + 1) * 256]
+                        expected[:data.shape[0], :data.shape[1]] = data
+                        tile = source.getTile(x, y, z, pilImageAllowed=True)
+                        self.assertTrue(numpy.array_equal(
+                            numpy.asarray(tile), expected))
+                level = tiff_writer.reduceRows(level)
+            # Decoded rows of tiles are kept up to the cache size
+            self.assertEqual(len(source._bands), 3 + 2 + 1)
+            source.bandCacheSize = 256 * 1000 * 3
+            source._bands.clear()
+            source._bandBytes = 0
+            source.getTile(0, 0, 0)
+            self.assertLessEqual(source._bandBytes, source.bandCacheSize)
+            self.assertEqual(list(source._bands)[-1], (0, 0))
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testPyramidTiffWriterWorkerExit(self):
+        import six
+        from large_image.server import tiff_writer
+
+        tempDir = tempfile.mkdtemp()
+        encodeBand = tiff_writer.encodeBand
+        pollInterval = tiff_writer.WorkerPollInterval
+        try:
+            # Workers are forked, so they use the patched function and exit
+            # without reporting a result
+            tiff_writer.encodeBand = lambda *args: os._exit(3)
+            tiff_writer.WorkerPollInterval = 0.1
+            imagePath = os.path.join(os.path.dirname(__file__), 'test_files',
+                                     'yb10kx5k.png')
+            with six.assertRaisesRegex(self, Exception, 'exited with code 3'):
+                tiff_writer.convertWithPillow(
+                    imagePath, os.path.join(tempDir, 'out.tiff'), processes=2)
+        finally:
+            tiff_writer.encodeBand = encodeBand
+            tiff_writer.WorkerPollInterval = pollInterval
+            shutil.rmtree(tempDir)
+
     def testTilesFromSVS(self):
         from large_image import tilesource
 
@@ -146,6 +1013,80 @@ class LargeImageGirderlessTest(base.TestCase):
             '01A-01-TS1.e8eb65de-d63e-42db-af6f-14fefbbdf7bd.svs'), **params)
         self._testTilesZXY(source, tileMetadata, params, PNGHeader)
 
+    def testSniffSources(self):
+        from large_image import getTileSource, tilesource
+
+        svsPath = os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_svs_image.TCGA-DU-6399-'
+            '01A-01-TS1.e8eb65de-d63e-42db-af6f-14fefbbdf7bd.svs')
+        ptifPath = os.path.join(os.environ['LARGE_IMAGE_DATA'],
+                                'sample_image.ptif')
+        pngPath = os.path.join(os.path.dirname(__file__), 'test_files',
+                               'yb10kx5k.png')
+        sources = tilesource.AvailableTileSources
+        self.assertEqual(tilesource.rankSources(sources, pngPath), [])
+        self.assertEqual(tilesource.rankSources(sources, ptifPath),
+                         ['tifffile', 'svsfile'])
+        self.assertEqual(tilesource.rankSources(sources, svsPath),
+                         ['svsfile', 'tifffile'])
+        # The file is only read once for all of the sources
+        readFileHeader = tilesource.base.readFileHeader
+        reads = []
+
+        def countReads(*args, **kwargs):
+            reads.append(args[0])
+            return readFileHeader(*args, **kwargs)
+
+        tilesource.base.readFileHeader = countReads
+        try:
+            self.assertEqual(tilesource.rankSources(sources, svsPath),
+                             ['svsfile', 'tifffile'])
+        finally:
+            tilesource.base.readFileHeader = readFileHeader
+        self.assertEqual(reads, [svsPath])
+        self.assertIsInstance(getTileSource(svsPath),
+                              tilesource.SVSFileTileSource)
+        self.assertIsInstance(getTileSource(ptifPath),
+                              tilesource.TiffFileTileSource)
+        # Files that can't be read are remembered, but still fail
+        for _ in range(2):
+            with self.assertRaises(tilesource.TileSourceException):
+                getTileSource(pngPath)
+
+    def testEntryPointSources(self):
+        import pkg_resources
+        from large_image import tilesource
+
+        ptifPath = os.path.join(os.environ['LARGE_IMAGE_DATA'],
+                                'sample_image.ptif')
+        entryPoint = pkg_resources.EntryPoint.parse(
+            'othertiff = large_image.server.tilesource.tiff:'
+            'TiffFileTileSource')
+        iterEntryPoints = pkg_resources.iter_entry_points
+
+        def mockIterEntryPoints(group, *args, **kwargs):
+            if group == tilesource.EntryPointGroup:
+                return [entryPoint]
+            return iterEntryPoints(group, *args, **kwargs)
+
+        pkg_resources.iter_entry_points = mockIterEntryPoints
+        try:
+            sources = tilesource.TileSourceRegistry([{
+                'moduleName': '.svs', 'className': 'SVSFileTileSource',
+                'name': 'svsfile', 'extensions': ['.ptif'], 'cost': 5}])
+            self.assertEqual(list(sources), ['svsfile', 'othertiff'])
+            self.assertEqual(sources.getSourceInfo('othertiff'), {})
+            self.assertEqual(sources.getSourceInfo('svsfile'), {
+                'extensions': ['.ptif'], 'cost': 5})
+            # Both sources are equally likely to read the file, so the
+            # cheaper one is tried first
+            self.assertEqual(tilesource.rankSources(sources, ptifPath),
+                             ['othertiff', 'svsfile'])
+            source = tilesource.getTileSourceFromDict(sources, ptifPath)
+            self.assertIsInstance(source, tilesource.TiffFileTileSource)
+        finally:
+            pkg_resources.iter_entry_points = iterEntryPoints
+
     def testGetTileSource(self):
         from large_image import getTileSource, tilesource
 
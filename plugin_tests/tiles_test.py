@@ -17,11 +17,14 @@
 #  limitations under the License.
 ###############################################################################
 
+import contextlib
 import json
 import math
 import os
 import requests
+import shutil
 import struct
+import tempfile
 import time
 from six.moves import range
 
@@ -208,6 +211,33 @@ class LargeImageTilesTest(base.TestCase):
         self.assertStatus(resp, 404)
         self.assertIn('layer does not exist', resp.json['message'])
 
+    @contextlib.contextmanager
+    def _countLoads(self, *modelNames):
+        """
+        Record the documents loaded by some models while in the context.
+
+        :param modelNames: the names of core models to watch.
+        :returns: a list that gets the name of the model for each load.
+        """
+        loads = []
+        models = [self.model(name) for name in modelNames]
+
+        def countLoads(model):
+            load = model.load
+
+            def wrapper(*args, **kwargs):
+                loads.append(model.name)
+                return load(*args, **kwargs)
+            return wrapper
+
+        for model in models:
+            model.load = countLoads(model)
+        try:
+            yield loads
+        finally:
+            for model in models:
+                del model.load
+
     def _postTileViaHttp(self, itemId, fileId):
         """
         When we know we need to process a job, we have to use an actual http
@@ -245,7 +275,11 @@ class LargeImageTilesTest(base.TestCase):
                 resp = self.request(path='/item/%s/tiles' % itemId,
                                     user=self.admin)
                 self.assertStatusOk(resp)
-                break
+                # Tiles may be served from the original file while the
+                # conversion runs, so wait for it to finish.
+                item = self.model('item').load(itemId, user=self.admin)
+                if not item['largeImage'].get('expected'):
+                    break
             except AssertionError as exc:
                 if 'File must have at least 1 level' in exc.args[0]:
                     return False
@@ -306,6 +340,24 @@ class LargeImageTilesTest(base.TestCase):
         self.assertStatus(resp, 400)
         self.assertIn('Item already has', resp.json['message'])
 
+        # Fetch a tile using a token so that the access is cached
+        token = self.model('token').createToken(self.admin)
+        resp = self.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
+                            token=token, isJson=False)
+        self.assertStatusOk(resp)
+        # Image responses are sent with their length
+        self.assertEqual(int(resp.headers['Content-Length']),
+                         len(self.getBody(resp, text=False)))
+        # Repeated tile requests with the same token don't load the token or
+        # user from the database
+        with self._countLoads('token', 'user') as loads:
+            resp = self.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
+                                token=token, isJson=False)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.headers['Cache-Control'].split(',')[0],
+                         'private')
+        self.assertEqual(loads, [])
+
         # We should be able to delete the large image information
         resp = self.request(path='/item/%s/tiles' % itemId, method='DELETE',
                             user=self.admin)
@@ -316,6 +368,12 @@ class LargeImageTilesTest(base.TestCase):
         resp = self.request(path='/item/%s/tiles' % itemId, user=self.admin)
         self.assertStatus(resp, 400)
         self.assertIn('No large image file', resp.json['message'])
+        # Tiles are no longer served, even using a token that had recently
+        # fetched tiles.
+        resp = self.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
+                            token=token)
+        self.assertStatus(resp, 404)
+        self.assertIn('No large image file', resp.json['message'])
 
         # We should be able to re-add it (we are also testing that fileId is
         # optional if there is only one file).
@@ -395,6 +453,268 @@ class LargeImageTilesTest(base.TestCase):
                    'Invalid encoding')
             self._createTestTiles(itemId, {key: badParams[key]}, error=err)
 
+    def testTileBatch(self):
+        file = self._uploadFile(os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        itemId = str(file['itemId'])
+        resp = self.request(path='/item/%s/tiles' % itemId, method='POST',
+                            user=self.admin)
+        self.assertStatusOk(resp)
+        tiles = [[0, 0, 0], [1, 1, 0], [9, 0, 0], [1, 5, 0], [0, -1, 0]]
+        resp = self.request(path='/item/%s/tiles/batch' % itemId,
+                            user=self.admin, isJson=False,
+                            params={'tiles': json.dumps(tiles)})
+        self.assertStatusOk(resp)
+        contentType = resp.headers['Content-Type']
+        self.assertTrue(contentType.startswith('multipart/mixed'))
+        boundary = contentType.split('boundary=')[1]
+        body = self.getBody(resp, text=False)
+        parts = body.split('--%s' % boundary)[1:-1]
+        self.assertEqual(len(parts), len(tiles))
+        for idx, (z, x, y) in enumerate(tiles):
+            self.assertIn('X-Tile-Position: %d/%d/%d' % (z, x, y), parts[idx])
+        # Compare the first tile to one fetched individually
+        resp = self.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
+                            user=self.admin, isJson=False)
+        image = self.getBody(resp, text=False)
+        header, data = parts[0].split('\r\n\r\n', 1)
+        self.assertIn('X-Tile-Status: 200', header)
+        self.assertEqual(data[:-2], image)
+        self.assertIn('X-Tile-Status: 200', parts[1])
+        # Missing levels, out of range, and negative tiles report errors
+        self.assertIn('X-Tile-Status: 404', parts[2])
+        self.assertIn('X-Tile-Status: 404', parts[3])
+        self.assertIn('X-Tile-Status: 400', parts[4])
+        self.assertIn('must be positive integers', parts[4])
+        # Every part, including errors, has its length in bytes
+        for part in parts:
+            header, data = part.split('\r\n\r\n', 1)
+            length = int(header.split('Content-Length: ')[1].split('\r\n')[0])
+            self.assertEqual(len(data), length + 2)
+        # POST works, too
+        resp = self.request(path='/item/%s/tiles/batch' % itemId,
+                            method='POST', user=self.admin, isJson=False,
+                            params={'tiles': json.dumps(tiles[:1])})
+        self.assertStatusOk(resp)
+        self.assertIn(image, self.getBody(resp, text=False))
+        # The positions can be sent as a JSON body
+        for body in (tiles[:1], {'tiles': tiles[:1]}):
+            resp = self.request(path='/item/%s/tiles/batch' % itemId,
+                                method='POST', user=self.admin, isJson=False,
+                                body=json.dumps(body), type='application/json')
+            self.assertStatusOk(resp)
+            self.assertIn(image, self.getBody(resp, text=False))
+        # Tiles that fail to decode are reported without ending the response
+        from girder.plugins.large_image.models.image_item import ImageItem
+        loadTileSource = ImageItem.__dict__['_loadTileSource']
+
+        def failingTileSource(cls, *args, **kwargs):
+            source = loadTileSource.__func__(cls, *args, **kwargs)
+
+            class FailingSource(object):
+                def __getattr__(self, key):
+                    return getattr(source, key)
+
+                def getTile(self, x, y, z, **kwargs):
+                    if (x, y, z) == (3, 0, 2):
+                        raise IOError('Broken tile')
+                    return source.getTile(x, y, z, **kwargs)
+            return FailingSource()
+
+        ImageItem._loadTileSource = classmethod(failingTileSource)
+        try:
+            resp = self.request(path='/item/%s/tiles/batch' % itemId,
+                                user=self.admin, isJson=False,
+                                params={'tiles': json.dumps(
+                                    [[2, 3, 0], [1, 0, 0], [0, 0, 0]])})
+        finally:
+            ImageItem._loadTileSource = loadTileSource
+        self.assertStatusOk(resp)
+        parts = self.getBody(resp, text=False).split('--%s' % resp.headers[
+            'Content-Type'].split('boundary=')[1])[1:-1]
+        self.assertEqual(len(parts), 3)
+        self.assertIn('X-Tile-Status: 500', parts[0])
+        self.assertIn('X-Tile-Status: 200', parts[1])
+        self.assertIn('X-Tile-Status: 200', parts[2])
+        # Test bad parameters
+        for tiles in ('not json', '[[0, 0]]', '[["a", 0, 0]]',
+                      json.dumps([[0, 0, 0]] * 1000)):
+            resp = self.request(path='/item/%s/tiles/batch' % itemId,
+                                user=self.admin, params={'tiles': tiles})
+            self.assertStatus(resp, 400)
+
+    def testTilePrefetch(self):
+        from girder.plugins.large_image.models import image_item
+
+        largeImageConfig = config.getConfig().setdefault('large_image', {})
+        largeImageConfig['prefetch_tiles'] = True
+        try:
+            resp = self.request(path='/item/test/tiles/zxy/3/2/2',
+                                user=self.admin, isJson=False)
+            self.assertStatusOk(resp)
+            sourceKey = image_item.ImageItem._tileSourceKey(
+                {'largeImage': {'sourceName': 'test'}}, {})
+            expected = [(1, 2, 3), (3, 3, 3), (4, 4, 4), (5, 5, 4)]
+            starttime = time.time()
+            while time.time() - starttime < 10:
+                if all(image_item._tileCache.get(sourceKey + (pos, ))
+                       for pos in expected):
+                    break
+                time.sleep(0.1)
+            for pos in expected:
+                self.assertIsNotNone(
+                    image_item._tileCache.get(sourceKey + (pos, )))
+            # Prefetched tiles match those fetched directly
+            tileData, tileMime = image_item._tileCache.get(
+                sourceKey + ((4, 4, 4), ))
+            self.assertEqual(tileMime, 'image/png')
+            resp = self.request(path='/item/test/tiles/zxy/4/4/4',
+                                user=self.admin, isJson=False)
+            self.assertEqual(self.getBody(resp, text=False), tileData)
+        finally:
+            del largeImageConfig['prefetch_tiles']
+
+    def testEncodingNegotiation(self):
+        from girder.plugins.large_image.tilesource import TileSource
+
+        file = self._uploadFile(os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        resp = self.request(path='/item/%s/tiles' % itemId, method='POST',
+                            user=self.admin, params={'fileId': fileId})
+        self.assertStatusOk(resp)
+        tilePath = '/item/%s/tiles/zxy/0/0/0' % itemId
+        resp = self.request(path=tilePath, user=self.admin, isJson=False)
+        stored = self.getBody(resp, text=False)
+        webp = 'WEBP' in TileSource.outputMimeTypes
+        headers = [('Accept', 'image/webp,image/*;q=0.8'),
+                   ('Save-Data', 'on')]
+
+        # Headers are ignored unless negotiation is enabled
+        resp = self.request(path=tilePath, user=self.admin, isJson=False,
+                            additionalHeaders=headers)
+        self.assertEqual(resp.headers['Content-Type'], 'image/jpeg')
+        self.assertEqual(self.getBody(resp, text=False), stored)
+
+        largeImageConfig = config.getConfig().setdefault('large_image', {})
+        largeImageConfig['negotiate_encoding'] = True
+        try:
+            resp = self.request(path=tilePath, user=self.admin, isJson=False,
+                                additionalHeaders=headers[1:])
+            self.assertEqual(resp.headers['Vary'], 'Accept, Save-Data')
+            self.assertEqual(resp.headers['Content-Type'], 'image/jpeg')
+            lowQuality = self.getBody(resp, text=False)
+            self.assertLess(len(lowQuality), len(stored))
+            # A different response has a different ETag
+            etag = resp.headers['ETag']
+            resp = self.request(path=tilePath, user=self.admin, isJson=False)
+            self.assertEqual(self.getBody(resp, text=False), stored)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+            # Explicit parameters win
+            resp = self.request(path=tilePath, user=self.admin, isJson=False,
+                                params={'encoding': 'PNG'},
+                                additionalHeaders=headers)
+            self.assertEqual(resp.headers['Content-Type'], 'image/png')
+            resp = self.request(path=tilePath, user=self.admin, isJson=False,
+                                additionalHeaders=[
+                                    ('Accept', 'image/webp;q=0')])
+            self.assertEqual(resp.headers['Content-Type'], 'image/jpeg')
+            if webp:
+                for path in (tilePath, '/item/%s/tiles/thumbnail' % itemId):
+                    resp = self.request(path=path, user=self.admin,
+                                        isJson=False,
+                                        additionalHeaders=headers[:1])
+                    self.assertEqual(resp.headers['Content-Type'],
+                                     'image/webp')
+                    self.assertEqual(
+                        self.getBody(resp, text=False)[8:12], b'WEBP')
+        finally:
+            del largeImageConfig['negotiate_encoding']
+
+    def testPregenerateTiles(self):
+        from girder.plugins.jobs.constants import JobStatus
+
+        largeImageConfig = config.getConfig().setdefault('large_image', {})
+        largeImageConfig['tile_store_path'] = tempfile.mkdtemp()
+        try:
+            file = self._uploadFile(os.path.join(
+                os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+            itemId = str(file['itemId'])
+            fileId = str(file['_id'])
+            # We can't pregenerate tiles until there is a large image
+            resp = self.request(path='/item/%s/tiles/pregenerate' % itemId,
+                                method='POST', user=self.admin)
+            self.assertStatus(resp, 400)
+            self.assertIn('No large image file', resp.json['message'])
+            resp = self.request(path='/item/%s/tiles' % itemId,
+                                method='POST', user=self.admin)
+            self.assertStatusOk(resp)
+            resp = self.request(path='/item/%s/tiles/pregenerate' % itemId,
+                                method='POST', user=self.admin,
+                                params={'levels': 0})
+            self.assertStatus(resp, 400)
+            resp = self.request(path='/item/%s/tiles/pregenerate' % itemId,
+                                method='POST', user=self.admin,
+                                params={'levels': 3})
+            self.assertStatusOk(resp)
+            jobId = resp.json['_id']
+            starttime = time.time()
+            while time.time() - starttime < 30:
+                job = self.model('job', 'jobs').load(jobId, force=True)
+                if job['status'] in (JobStatus.SUCCESS, JobStatus.ERROR):
+                    break
+                time.sleep(0.1)
+            self.assertEqual(job['status'], JobStatus.SUCCESS)
+            self.assertEqual(job['progress']['total'], 1 + 2 + 4)
+            storePath = os.path.join(largeImageConfig['tile_store_path'],
+                                     fileId)
+            self.assertTrue(os.path.isdir(storePath))
+            # Stored tiles are served
+            resp = self.request(path='/item/%s/tiles/zxy/2/1/0' % itemId,
+                                user=self.admin, isJson=False)
+            self.assertStatusOk(resp)
+            image = self.getBody(resp, text=False)
+            self.assertEqual(image[:len(JPEGHeader)], JPEGHeader)
+            # Removing the large image removes the stored tiles
+            resp = self.request(path='/item/%s/tiles' % itemId,
+                                method='DELETE', user=self.admin)
+            self.assertStatusOk(resp)
+            self.assertFalse(os.path.exists(storePath))
+        finally:
+            shutil.rmtree(largeImageConfig.pop('tile_store_path'))
+
+    def testTileCacheHeaders(self):
+        resp = self.request(path='/item/test/tiles/zxy/0/0/0', user=self.admin,
+                            isJson=False)
+        self.assertStatusOk(resp)
+        etag = resp.headers['ETag']
+        self.assertIn('max-age=', resp.headers['Cache-Control'])
+        self.assertIn('private', resp.headers['Cache-Control'])
+        # Asking with a matching tag returns no data
+        resp = self.request(path='/item/test/tiles/zxy/0/0/0', user=self.admin,
+                            isJson=False,
+                            additionalHeaders=[('If-None-Match', etag)])
+        self.assertStatus(resp, 304)
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertEqual(self.getBody(resp, text=False), '')
+        # Other tiles and other parameters have different tags
+        resp = self.request(path='/item/test/tiles/zxy/1/0/0', user=self.admin,
+                            isJson=False,
+                            additionalHeaders=[('If-None-Match', etag)])
+        self.assertStatusOk(resp)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        resp = self.request(path='/item/test/tiles/zxy/0/0/0', user=self.admin,
+                            isJson=False, params={'encoding': 'JPEG'},
+                            additionalHeaders=[('If-None-Match', etag)])
+        self.assertStatusOk(resp)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        # Anonymous requests can be cached publicly
+        resp = self.request(path='/item/test/tiles/zxy/0/0/0', isJson=False)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertIn('public', resp.headers['Cache-Control'])
+
     def testTilesFromPNG(self):
         file = self._uploadFile(os.path.join(
             os.path.dirname(__file__), 'test_files', 'yb10kx5k.png'))
@@ -444,6 +764,76 @@ class LargeImageTilesTest(base.TestCase):
         self.assertStatus(resp, 400)
         self.assertIn('No large image file', resp.json['message'])
 
+    def testTilesWhileConverting(self):
+        import PIL.Image
+
+        # Compressed PNGs can't be decoded a few rows at a time, so they
+        # aren't read while they are converted
+        file = self._uploadFile(os.path.join(
+            os.path.dirname(__file__), 'test_files', 'yb10kx5k.png'))
+        itemId = str(file['itemId'])
+        item = self.model('item').load(itemId, force=True)
+        item['largeImage'] = {'expected': True, 'originalId': file['_id']}
+        self.model('item').save(item)
+        resp = self.request(path='/item/%s/tiles' % itemId, user=self.admin)
+        self.assertStatus(resp, 400)
+        self.assertIn('still pending creation', resp.json['message'])
+        # Uncompressed TIFFs are read
+        tempDir = tempfile.mkdtemp()
+        try:
+            rawPath = os.path.join(tempDir, 'yb2kx1k.tif')
+            PIL.Image.open(os.path.join(
+                os.path.dirname(__file__), 'test_files', 'yb10kx5k.png')
+            ).convert('RGB').crop((0, 0, 2000, 1000)).save(rawPath, 'TIFF')
+            file = self._uploadFile(rawPath)
+        finally:
+            shutil.rmtree(tempDir)
+        itemId = str(file['itemId'])
+        # Mark the item as being converted without starting a job
+        item = self.model('item').load(itemId, force=True)
+        item['largeImage'] = {'expected': True, 'originalId': file['_id']}
+        self.model('item').save(item)
+        resp = self.request(path='/item/%s/tiles' % itemId, user=self.admin)
+        self.assertStatusOk(resp)
+        tileMetadata = resp.json
+        self.assertEqual(tileMetadata['tileWidth'], 256)
+        self.assertEqual(tileMetadata['tileHeight'], 256)
+        self.assertEqual(tileMetadata['sizeX'], 2000)
+        self.assertEqual(tileMetadata['sizeY'], 1000)
+        self.assertEqual(tileMetadata['levels'], 4)
+        self._testTilesZXY(itemId, tileMetadata)
+        largeImageConfig = config.getConfig().setdefault('large_image', {})
+        largeImageConfig['convert_on_read'] = False
+        try:
+            resp = self.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
+                                user=self.admin)
+            self.assertStatus(resp, 404)
+            self.assertIn('still pending creation', resp.json['message'])
+        finally:
+            del largeImageConfig['convert_on_read']
+        # Without an original file, the image is still pending
+        del item['largeImage']['originalId']
+        self.model('item').save(item)
+        resp = self.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
+                            user=self.admin)
+        self.assertStatus(resp, 404)
+        self.assertIn('still pending creation', resp.json['message'])
+        # Deleting the large image cancels the conversion job, which is kept
+        # until the worker stops
+        Job = self.model('job', 'jobs')
+        job = Job.createJob(title='TIFF conversion', type='large_image_tiff',
+                            user=self.admin)
+        item['largeImage']['jobId'] = job['_id']
+        self.model('item').save(item)
+        resp = self.request(path='/item/%s/tiles' % itemId, method='DELETE',
+                            user=self.admin)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['deleted'], True)
+        job = Job.load(job['_id'], force=True)
+        self.assertIsNotNone(job)
+        self.assertNotEqual(
+            job['status'], girder.plugins.jobs.constants.JobStatus.INACTIVE)
+
     def testTilesFromBadFiles(self):
         # Uploading a monochrome file should result in no useful tiles.
         file = self._uploadFile(os.path.join(
@@ -808,6 +1198,403 @@ class LargeImageTilesTest(base.TestCase):
         self.assertEqual(width, 1000)
         self.assertEqual(height, 750)
 
+    def testTissueOccupancy(self):
+        file = self._uploadFile(os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        resp = self.request(path='/item/%s/tiles' % itemId, method='POST',
+                            user=self.admin, params={'fileId': fileId})
+        self.assertStatusOk(resp)
+
+        resp = self.request(path='/item/%s/tiles/occupancy' % itemId,
+                            user=self.admin)
+        self.assertStatus(resp, 400)
+        self.assertIn('Missing "level"', resp.json['message'])
+        resp = self.request(path='/item/%s/tiles/occupancy' % itemId,
+                            user=self.admin, params={'level': 12})
+        self.assertStatus(resp, 400)
+        self.assertIn('does not exist', resp.json['message'])
+
+        resp = self.request(path='/item/%s/tiles/occupancy' % itemId,
+                            user=self.admin, params={'level': 2})
+        self.assertStatusOk(resp)
+        occupancy = resp.json
+        self.assertEqual(occupancy['tilesAcross'], 4)
+        self.assertEqual(occupancy['tilesDown'], 1)
+        self.assertGreater(occupancy['count'], 0)
+        self.assertLessEqual(occupancy['count'], 4)
+        self.assertIn('bitmap', occupancy)
+        # The mask is stored with the item
+        item = self.model('item').load(itemId, force=True)
+        self.assertIn('tissueMask', item['largeImage'])
+        # Storing a mask only changes the mask, even if the item changed
+        # after it was loaded
+        staleItem = self.model('item').load(itemId, force=True)
+        item['meta'] = {'changed': True}
+        item = self.model('item').save(item)
+        self.model('image_item', 'large_image').getTissueMask(
+            staleItem, threshold=100, recompute=True)
+        item = self.model('item').load(itemId, force=True)
+        self.assertEqual(item['meta'], {'changed': True})
+        self.assertEqual(item['largeImage']['tissueMask']['threshold'], 100)
+
+        resp = self.request(path='/item/%s/tiles/occupancy' % itemId,
+                            user=self.admin,
+                            params={'level': 8, 'format': 'list'})
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json['tiles']), resp.json['count'])
+        self.assertTrue(all(0 <= x < resp.json['tilesAcross'] and
+                            0 <= y < resp.json['tilesDown']
+                            for x, y in resp.json['tiles']))
+        tiles = self.model('image_item', 'large_image').iterOccupiedTiles(
+            item, 8)
+        self.assertEqual([list(tile) for tile in tiles], resp.json['tiles'])
+
+        # A threshold of 0 finds only colorful tissue
+        resp = self.request(path='/item/%s/tiles/tissue' % itemId,
+                            method='POST', user=self.admin,
+                            params={'threshold': 0})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['threshold'], 0)
+        self.assertLess(resp.json['fraction'], 1)
+
+        # Masks aren't computed while the image is being converted
+        item['largeImage']['expected'] = True
+        item = self.model('item').save(item)
+        resp = self.request(path='/item/%s/tiles/occupancy' % itemId,
+                            user=self.admin, params={'level': 2})
+        self.assertStatus(resp, 400)
+        self.assertIn('still pending creation', resp.json['message'])
+        del item['largeImage']['expected']
+        item = self.model('item').save(item)
+
+        # Removing the large image removes the mask
+        resp = self.request(path='/item/%s/tiles' % itemId, method='DELETE',
+                            user=self.admin)
+        self.assertStatusOk(resp)
+        item = self.model('item').load(itemId, force=True)
+        self.assertNotIn('largeImage', item)
+
+    def testDeepZoomAndIiif(self):
+        from PIL import Image
+        from six import BytesIO
+
+        file = self._uploadFile(os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        resp = self.request(path='/item/%s/tiles' % itemId, method='POST',
+                            user=self.admin, params={'fileId': fileId})
+        self.assertStatusOk(resp)
+
+        def getImage(path, params=None):
+            resp = self.request(path='/item/%s/tiles/%s' % (itemId, path),
+                                user=self.admin, params=params or {},
+                                isJson=False)
+            self.assertStatusOk(resp)
+            return self.getBody(resp, text=False)
+
+        resp = self.request(path='/item/%s/tiles/dzi.dzi' % itemId,
+                            user=self.admin, isJson=False)
+        self.assertStatusOk(resp)
+        dzi = self.getBody(resp)
+        self.assertIn('TileSize="256"', dzi)
+        self.assertIn('Format="jpeg"', dzi)
+        self.assertIn('<Size Width="58368" Height="12288"/>', dzi)
+
+        # The highest Deep Zoom level is the full resolution level, and tiles
+        # on the image's own grid are the image's tiles.
+        fullTile = getImage('zxy/8/0/0')
+        self.assertEqual(getImage('dzi_files/16/0_0.jpeg'), fullTile)
+        self.assertEqual(getImage('dzi_files/15/3_1.jpeg'),
+                         getImage('zxy/7/3/1'))
+        # Edge tiles are cropped to the image
+        image = Image.open(BytesIO(getImage('dzi_files/8/0_0.jpeg')))
+        self.assertEqual(image.size, (228, 48))
+        # Levels smaller than the lowest level of the image are scaled
+        image = Image.open(BytesIO(getImage('dzi_files/4/0_0.png')))
+        self.assertEqual(image.format, 'PNG')
+        self.assertEqual(image.size, (15, 3))
+        for tile in ('dzi_files/17/0_0.jpeg', 'dzi_files/16/228_0.jpeg'):
+            resp = self.request(path='/item/%s/tiles/%s' % (itemId, tile),
+                                user=self.admin)
+            self.assertStatus(resp, 404)
+        resp = self.request(path='/item/%s/tiles/dzi_files/16/0_0.gif' %
+                            itemId, user=self.admin)
+        self.assertStatus(resp, 400)
+
+        resp = self.request(path='/item/%s/tiles/iiif/info.json' % itemId,
+                            user=self.admin)
+        self.assertStatusOk(resp)
+        info = resp.json
+        self.assertEqual(info['width'], 58368)
+        self.assertEqual(info['height'], 12288)
+        self.assertTrue(info['@id'].endswith('/item/%s/tiles/iiif' % itemId))
+        self.assertEqual(info['tiles'][0]['width'], 256)
+        self.assertEqual(info['tiles'][0]['scaleFactors'][-1], 256)
+        self.assertEqual(info['maxWidth'], 8192)
+        self.assertEqual(info['maxArea'], 4096 * 4096)
+
+        self.assertEqual(getImage('iiif/0,0,256,256/256,/0/default.jpg'),
+                         fullTile)
+        self.assertEqual(getImage('iiif/2048,2048,2048,2048/256,/0/'
+                                  'default.jpg'), getImage('zxy/5/1/1'))
+        image = Image.open(BytesIO(getImage('iiif/full/228,/0/default.jpg')))
+        self.assertEqual(image.size, (228, 48))
+        image = Image.open(BytesIO(getImage(
+            'iiif/pct:0,0,50,50/!100,100/90/gray.png')))
+        self.assertEqual(image.format, 'PNG')
+        self.assertEqual(image.mode, 'L')
+        self.assertEqual(image.size, (21, 100))
+        image = Image.open(BytesIO(getImage(
+            'iiif/square/300,200/!0/default.jpg')))
+        self.assertEqual(image.size, (300, 200))
+        for path in ('iiif/60000,0,10,10/full/0/default.jpg',
+                     'iiif/0,0,10/full/0/default.jpg',
+                     'iiif/full/0,/0/default.jpg',
+                     'iiif/full/full/45/default.jpg',
+                     'iiif/full/full/0/bitonal.jpg',
+                     'iiif/full/full/0/default.gif',
+                     'iiif/full/full/0/default.jpg',
+                     'iiif/full/8193,/0/default.jpg',
+                     'iiif/full/4097,4097/0/default.jpg'):
+            resp = self.request(path='/item/%s/tiles/%s' % (itemId, path),
+                                user=self.admin)
+            self.assertStatus(resp, 400)
+        # max is scaled to fit the limits
+        from girder.plugins.large_image.rest import tiles
+
+        maxArea = tiles.IiifMaxArea
+        tiles.IiifMaxArea = 10000
+        try:
+            image = Image.open(BytesIO(getImage(
+                'iiif/full/max/0/default.jpg')))
+            self.assertEqual(image.size, (217, 45))
+            resp = self.request(path='/item/%s/tiles/iiif/full/218,/0/'
+                                'default.jpg' % itemId, user=self.admin)
+            self.assertStatus(resp, 400)
+            self.assertIn('largest supported size', resp.json['message'])
+        finally:
+            tiles.IiifMaxArea = maxArea
+
+        # Tile sizes and overlaps are limited
+        for path, params in (
+                ('', {'tileSize': 4097}),
+                ('/zxy/0/0/0', {'tileSize': 0}),
+                ('/zxy/0/0/0', {'tileSize': 512, 'tileOverlap': 512}),
+                ('/zxy/0/0/0', {'tileOverlap': -1}),
+                ('/dzi.dzi', {'tileSize': 5000}),
+                ('/dzi_files/8/0_0.jpeg', {'tileSize': 254, 'overlap': 254})):
+            resp = self.request(path='/item/%s/tiles%s' % (itemId, path),
+                                user=self.admin, params=params)
+            self.assertStatus(resp, 400)
+
+        # Other tile sizes are assembled from the tiles of the image
+        resp = self.request(path='/item/%s/tiles' % itemId, user=self.admin,
+                            params={'tileSize': 512, 'tileOverlap': 1})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['tileWidth'], 512)
+        self.assertEqual(resp.json['tileOverlap'], 1)
+        self.assertEqual(resp.json['levels'], 9)
+        image = Image.open(BytesIO(getImage('zxy/8/1/1', {
+            'tileSize': 512, 'tileOverlap': 1})))
+        self.assertEqual(image.size, (514, 514))
+        resp = self.request(path='/item/%s/tiles/dzi.dzi' % itemId,
+                            user=self.admin, isJson=False,
+                            params={'tileSize': 254, 'overlap': 1})
+        self.assertIn('TileSize="254" Overlap="1"', self.getBody(resp))
+        for tile, size in (('16/0_0', (255, 255)), ('16/1_1', (256, 256)),
+                           ('8/0_0', (228, 48)), ('4/0_0', (15, 3))):
+            image = Image.open(BytesIO(getImage(
+                'dzi_files/%s.jpeg' % tile, {'tileSize': 254, 'overlap': 1})))
+            self.assertEqual(image.size, size)
+
+    def testTilesHistogram(self):
+        file = self._uploadFile(os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        resp = self.request(path='/item/%s/tiles' % itemId, method='POST',
+                            user=self.admin, params={'fileId': fileId})
+        self.assertStatusOk(resp)
+
+        resp = self.request(path='/item/%s/tiles/histogram' % itemId,
+                            user=self.admin, params={'bins': 0})
+        self.assertStatus(resp, 400)
+        self.assertIn('"bins" must be', resp.json['message'])
+        resp = self.request(path='/item/%s/tiles/histogram' % itemId,
+                            user=self.admin, params={'level': 12})
+        self.assertStatus(resp, 400)
+        self.assertIn('does not exist', resp.json['message'])
+
+        resp = self.request(path='/item/%s/tiles/histogram' % itemId,
+                            user=self.admin, params={'level': 2, 'bins': 16})
+        self.assertStatusOk(resp)
+        stats = resp.json
+        self.assertEqual(stats['level'], 2)
+        self.assertEqual(stats['dtype'], 'uint8')
+        self.assertEqual(len(stats['channels']), 3)
+        for channel in stats['channels']:
+            self.assertEqual(len(channel['histogram']), 16)
+            self.assertEqual(sum(channel['histogram']), stats['pixels'])
+            self.assertLessEqual(channel['min'], channel['mean'])
+            self.assertLessEqual(channel['mean'], channel['max'])
+        # Only the default statistics are stored with the item
+        item = self.model('item').load(itemId, force=True)
+        self.assertNotIn('statistics', item['largeImage'])
+        resp = self.request(path='/item/%s/tiles/histogram' % itemId,
+                            user=self.admin)
+        self.assertStatusOk(resp)
+        stats = resp.json
+        item = self.model('item').load(itemId, force=True)
+        self.assertEqual(
+            item['largeImage']['statistics'], {'levelauto_bins256': stats})
+        # Levels above the configured size are refused
+        largeImageConfig = config.getConfig().setdefault('large_image', {})
+        largeImageConfig['statistics_max_pixels'] = 1000
+        try:
+            resp = self.request(path='/item/%s/tiles/histogram' % itemId,
+                                user=self.admin, params={'level': 2})
+            self.assertStatus(resp, 400)
+            self.assertIn('too large', resp.json['message'])
+            # The stored statistics are still available
+            resp = self.request(path='/item/%s/tiles/histogram' % itemId,
+                                user=self.admin)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json, stats)
+        finally:
+            del largeImageConfig['statistics_max_pixels']
+        # Statistics computed from a stale copy of the item aren't stored if
+        # the image is now being converted
+        item = self.model('item').load(itemId, force=True)
+        del item['largeImage']['statistics']
+        item = self.model('item').save(item)
+        staleItem = self.model('item').load(itemId, force=True)
+        item['largeImage']['expected'] = True
+        self.model('item').save(item)
+        self.model('image_item', 'large_image').getStatistics(staleItem)
+        item = self.model('item').load(itemId, force=True)
+        self.assertNotIn('statistics', item['largeImage'])
+        self.assertTrue(item['largeImage']['expected'])
+
+    def testTileServerToken(self):
+        from girder.plugins.large_image.tilesource import signing, tileserver
+
+        file = self._uploadFile(os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        resp = self.request(path='/item/%s/tiles' % itemId, method='POST',
+                            user=self.admin, params={'fileId': fileId})
+        self.assertStatusOk(resp)
+        resp = self.request(path='/item/%s/tiles/tileserver' % itemId,
+                            user=self.admin)
+        self.assertStatus(resp, 400)
+        self.assertIn('not configured', resp.json['message'])
+
+        largeImageConfig = config.getConfig().setdefault('large_image', {})
+        largeImageConfig['tile_signing_secret'] = 'secret'
+        largeImageConfig['tile_server_url'] = 'http://tiles.example.com/'
+        try:
+            # Anonymous users can't read the private item
+            resp = self.request(path='/item/%s/tiles/tileserver' % itemId)
+            self.assertStatus(resp, 401)
+            resp = self.request(path='/item/%s/tiles/tileserver' % itemId,
+                                user=self.admin)
+            self.assertStatusOk(resp)
+        finally:
+            del largeImageConfig['tile_signing_secret']
+            del largeImageConfig['tile_server_url']
+        token = resp.json['token']
+        self.assertEqual(
+            resp.json['url'],
+            'http://tiles.example.com/tiles/%s/{z}/{x}/{y}' % token)
+        payload = signing.verifyToken('secret', token)
+        self.assertEqual(payload['exp'], resp.json['expires'])
+        # The token only names the file within its assetstore
+        assetstore = self.model('assetstore').load(file['assetstoreId'])
+        self.assertEqual(payload['assetstore'], str(assetstore['_id']))
+        self.assertFalse(os.path.isabs(payload['path']))
+        self.assertNotIn(assetstore['root'], json.dumps(payload))
+        self.assertTrue(os.path.isfile(os.path.join(
+            assetstore['root'], payload['path'])))
+
+        # The standalone server serves the same tiles as Girder
+        assetstores = {payload['assetstore']: assetstore['root']}
+        server = tileserver.TileServer('secret', assetstores)
+        status, headers, body = server.handle(
+            'GET', '/tiles/%s/0/0/0' % token)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'image/jpeg')
+        resp = self.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
+                            user=self.admin, isJson=False)
+        self.assertEqual(self.getBody(resp, text=False), body)
+        status, headers, body = server.handle('GET', '/tiles/%s' % token)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode('utf8'))['levels'], 9)
+        self.assertEqual(server.handle(
+            'GET', '/tiles/%s/9/0/0' % token)[0], 404)
+        self.assertEqual(tileserver.TileServer('other', assetstores).handle(
+            'GET', '/tiles/%s/0/0/0' % token)[0], 403)
+
+    def testSignedTileUrls(self):
+        file = self._uploadFile(os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        resp = self.request(path='/item/%s/tiles' % itemId, method='POST',
+                            user=self.admin, params={'fileId': fileId})
+        self.assertStatusOk(resp)
+        resp = self.request(path='/item/%s/tiles' % itemId, user=self.admin)
+        self.assertStatusOk(resp)
+        self.assertNotIn('tileUrl', resp.json)
+        resp = self.request(path='/item/%s/tiles' % itemId, user=self.admin,
+                            params={'signedUrl': 'true'})
+        self.assertStatus(resp, 400)
+        self.assertIn('not configured', resp.json['message'])
+
+        largeImageConfig = config.getConfig().setdefault('large_image', {})
+        largeImageConfig['tile_signing_secret'] = 'secret'
+        try:
+            resp = self.request(path='/item/%s/tiles' % itemId,
+                                user=self.admin, params={'signedUrl': 'true'})
+            self.assertStatusOk(resp)
+            self.assertGreater(resp.json['tileUrlExpires'], time.time())
+            tileUrl = resp.json['tileUrl']
+            self.assertIn('/item/%s/tiles/zxy/{z}/{x}/{y}?tileToken=' % itemId,
+                          tileUrl)
+            token = tileUrl.split('tileToken=')[1]
+            tilePath = '/item/%s/tiles/zxy/0/0/0' % itemId
+            resp = self.request(path=tilePath, user=self.admin, isJson=False)
+            self.assertStatusOk(resp)
+            image = self.getBody(resp, text=False)
+            # The item is private, but the signed token grants access
+            resp = self.request(path=tilePath, isJson=False)
+            self.assertStatus(resp, 401)
+            resp = self.request(path=tilePath, isJson=False,
+                                params={'tileToken': token})
+            self.assertStatusOk(resp)
+            self.assertEqual(self.getBody(resp, text=False), image)
+            self.assertTrue(
+                resp.headers['Cache-Control'].startswith('private'))
+            # The token is only valid for its item
+            otherFile = self._uploadFile(os.path.join(
+                os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+            resp = self.request(
+                path='/item/%s/tiles/zxy/0/0/0' % otherFile['itemId'],
+                params={'tileToken': token})
+            self.assertStatus(resp, 403)
+            # Altered tokens are refused
+            resp = self.request(path=tilePath,
+                                params={'tileToken': token[:-2]})
+            self.assertStatus(resp, 403)
+        finally:
+            del largeImageConfig['tile_signing_secret']
+        # Tokens stop working when signing is disabled
+        resp = self.request(path=tilePath, params={'tileToken': token})
+        self.assertStatus(resp, 403)
+
     def testSettings(self):
         from girder.plugins.large_image import constants
         from girder.models.model_base import ValidationException
@@ -862,3 +1649,13 @@ class LargeImageTilesTest(base.TestCase):
             user=self.admin, encoding='PNG')
         image, mime = source.getThumbnail(encoding='JPEG', width=200)
         self.assertEqual(image[:len(JPEGHeader)], JPEGHeader)
+
+        # Ranking the Girder sources for an item only resolves its file once
+        from girder.plugins.large_image import tilesource
+
+        item = self.model('item').load(itemId, force=True)
+        with self._countLoads('file', 'assetstore') as loads:
+            ranked = tilesource.rankSources(
+                tilesource.AvailableTileSources, item, True)
+        self.assertEqual(ranked[0], 'tiff')
+        self.assertEqual(loads, ['file', 'assetstore'])
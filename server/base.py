@@ -47,6 +47,8 @@ def _postUpload(event):
         item['largeImage']['fileId'] = fileObj['_id']
         item['largeImage']['sourceName'] = 'tiff'
         Item.save(item)
+        ModelImporter.model(
+            'image_item', 'large_image').pregenerateTilesOnCreate(item)
 
 
 def validateSettings(event):
@@ -84,3 +86,7 @@ def load(info):
 
     events.bind('data.process', 'large_image', _postUpload)
     events.bind('model.setting.validate', 'large_image', validateSettings)
+    events.bind('model.item.save.after', 'large_image',
+                TilesItemResource.invalidateTileItemCache)
+    events.bind('model.item.remove', 'large_image',
+                TilesItemResource.invalidateTileItemCache)
@@ -23,3 +23,12 @@ class PluginSettings:
     LARGE_IMAGE_SHOW_THUMBNAILS = 'large_image.show_thumbnails'
     LARGE_IMAGE_SHOW_VIEWER = 'large_image.show_viewer'
     LARGE_IMAGE_DEFAULT_VIEWER = 'large_image.default_viewer'
+
+
+# Number of seconds that clients may reuse tiles, thumbnails, and regions
+# without revalidating them.
+TileCacheMaxAge = 86400
+
+# The largest tile size that tiles can be assembled at.  Overlaps must be
+# smaller than the tile size.
+MaxTileSize = 4096
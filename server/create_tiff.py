@@ -18,7 +18,11 @@
 ###############################################################################
 
 import os
-import subprocess
+import tempfile
+
+# tiff_writer.py is prepended to this script when the job is created
+convertImage = convertImage  # noqa
+removeStaleCheckpoints = removeStaleCheckpoints  # noqa
 
 # Define Girder Worker globals for the style checker
 _tempdir = _tempdir   # noqa
@@ -26,29 +30,51 @@ in_path = in_path   # noqa
 quality = quality   # noqa
 tile_size = tile_size   # noqa
 out_filename = out_filename  # noqa
+# These are optional; older jobs don't specify them
+concurrency = globals().get('concurrency', 0)
+max_pixels = globals().get('max_pixels', 128 * 1024 * 1024)
+checkpoint_dir = globals().get('checkpoint_dir') or os.path.join(
+    tempfile.gettempdir(), 'large_image_checkpoints')
+checkpoint_key = globals().get('checkpoint_key')
+checkpoint_max_age = globals().get('checkpoint_max_age', 86400)
+# The job manager is only available when the job was created with jobInfo
+_job_manager = globals().get('_job_manager')
 
 out_path = os.path.join(_tempdir, out_filename)
 
-convert_command = (
-    'vips',
-    'tiffsave',
-    in_path,
-    out_path,
-    '--compression', 'jpeg',
-    '--Q', str(quality),
-    '--tile',
-    '--tile-width', str(tile_size),
-    '--tile-height', str(tile_size),
-    '--pyramid',
-    '--bigtiff'
-)
-
-proc = subprocess.Popen(convert_command, stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE)
-out, err = proc.communicate()
-
-if proc.returncode:
-    print('stdout: ' + out)
-    print('stderr: ' + err)
-    raise Exception('VIPS command failed (rc=%d): %s' % (
-        proc.returncode, ' '.join(convert_command)))
+
+def reportProgress(percent):
+    """
+    Report conversion progress to the Girder job, if there is one.
+
+    :param percent: the percent of the conversion that is complete.
+    """
+    if _job_manager is not None:
+        # Older versions of Girder Worker can't tell if the job was canceled
+        if getattr(_job_manager, 'canceled', False):
+            raise Exception('The conversion job was canceled')
+        _job_manager.updateProgress(
+            total=100, current=percent, message='Converting image')
+
+
+# The concurrency is the number of threads libvips uses, or the number of
+# processes that encode tiles in conversions with PIL, which use one per CPU
+# if it isn't specified.  Partial output of conversions with PIL is
+# checkpointed so that a failed or canceled conversion of the same file
+# resumes where it stopped.
+resumePath = None
+if checkpoint_key:
+    try:
+        os.makedirs(checkpoint_dir)
+    except OSError:
+        if not os.path.isdir(checkpoint_dir):
+            raise
+    # Jobs that were canceled or failed and won't be retried leave their
+    # partial output behind, so remove any that has been abandoned.
+    if checkpoint_max_age:
+        removeStaleCheckpoints(checkpoint_dir, float(checkpoint_max_age))
+    resumePath = os.path.join(checkpoint_dir, checkpoint_key + '.tiff')
+convertImage(in_path, out_path, int(quality), int(tile_size), reportProgress,
+             processes=int(concurrency or 0), resumePath=resumePath,
+             maxPixels=int(max_pixels) or None)
+reportProgress(100)
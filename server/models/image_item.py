@@ -17,16 +17,128 @@
 #  limitations under the License.
 ###############################################################################
 
+import math
 import os
-
+import repoze.lru
+import six
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from six.moves import range
+
+from girder import logger
 from girder.models.model_base import ValidationException
 from girder.models.item import Item
+from girder.utility import config
+from girder.utility.model_importer import ModelImporter
 from girder.plugins.worker import utils as workerUtils
 from girder.plugins.jobs.constants import JobStatus
 
 from .base import TileGeneralException
-from ..tilesource import AvailableTileSources, TestTileSource, \
-    TileSourceException
+from .. import tilesource
+from ..tilesource import AvailableTileSources, TileSourceException, \
+    rankSources
+from ..tilesource.cache import DiskTileStore
+from ..tilesource.signing import signToken
+
+
+# Number of threads used to fetch tiles concurrently for batch requests
+TileBatchThreads = 8
+# Number of encoded tiles to keep in memory
+TileCacheSize = 2000
+# Default options for serving and generating tiles.  These can be changed in
+# the [large_image] section of the Girder configuration.
+ConfigDefaults = {
+    # If True, prefetch the neighbors and children of requested tiles
+    'prefetch_tiles': False,
+    # Number of threads used for prefetching
+    'prefetch_threads': 2,
+    # Maximum number of tiles waiting to be prefetched for any one source
+    'prefetch_budget': 64,
+    # Directory where pregenerated tiles are stored
+    'tile_store_path': os.path.join(tempfile.gettempdir(), 'large_image'),
+    # Number of levels to pregenerate when pregeneration is requested without
+    # specifying the levels
+    'pregenerate_levels': 5,
+    # If True, pregenerate tiles whenever a large image is created
+    'pregenerate_on_create': False,
+    # Number of threads used for pregenerating tiles
+    'pregenerate_threads': 4,
+    # Options used when converting images to tiled TIFFs.  A concurrency of 0
+    # uses the libvips default.
+    'convert_tile_size': 256,
+    'convert_quality': 90,
+    'convert_concurrency': 0,
+    # Conversions without libvips decode images that aren't stored in strips
+    # or tiles all at once, using about 3 bytes per pixel.  Larger images are
+    # refused.  0 for no limit.
+    'convert_pillow_max_pixels': 128 * 1024 * 1024,
+    # Directory on the worker where partial conversions are kept so that they
+    # can be resumed.  If empty, the worker's temporary directory is used.
+    'convert_checkpoint_path': '',
+    # Partial conversions that haven't been written to for this many seconds
+    # are removed when a conversion starts.  0 to keep them.
+    'convert_checkpoint_max_age': 86400,
+    # If True, serve tiles from the original file of an item while it is
+    # being converted.  Only files that can be decoded a few rows at a time
+    # are read, such as uncompressed images and TIFFs stored in strips or
+    # tiles, and only if no strip or tile has more than the maximum number of
+    # pixels.  0 for no limit.
+    'convert_on_read': True,
+    'convert_on_read_max_pixels': 16 * 1024 * 1024,
+    # If True, tiles, thumbnails, and regions requested without an encoding
+    # are sent as WebP to clients that list it in their Accept header, and
+    # ones requested without a quality use save_data_quality for clients
+    # that send "Save-Data: on".
+    'negotiate_encoding': False,
+    'save_data_quality': 60,
+    # The secret used to sign the tokens of signed tile URLs and of the
+    # standalone tile server, which must be configured with the same secret.
+    # If empty, tokens can't be issued.
+    'tile_signing_secret': '',
+    # The public URL of the standalone tile server
+    'tile_server_url': '',
+    # Number of seconds that signed tile URLs and tile server tokens are valid
+    'tile_token_lifetime': 3600,
+    # The largest level, in pixels, that statistics can be requested from.
+    # Statistics from the default low resolution level are always available.
+    # 0 for no limit.
+    'statistics_max_pixels': 16 * 1024 * 1024,
+}
+
+# The statistics that are stored with an item, which are those computed from
+# the default level and number of bins
+DefaultStatisticsBins = 256
+DefaultStatisticsKey = 'levelauto_bins%d' % DefaultStatisticsBins
+
+_threadPools = {}
+_threadPoolLock = threading.Lock()
+# Encoded tiles keyed by _tileSourceKey plus the tile position.  Values are
+# (tileData, tileMimeType) tuples.
+_tileCache = repoze.lru.LRUCache(TileCacheSize)
+# Tile positions queued for prefetching, keyed by _tileSourceKey
+_prefetchPending = {}
+_prefetchLock = threading.Lock()
+
+
+def _getConfigOption(key):
+    return config.getConfig().get('large_image', {}).get(
+        key, ConfigDefaults[key])
+
+
+def pregenerateTilesJob(job):
+    """
+    Run a tile pregeneration job.  This is called by the jobs plugin for local
+    jobs, which are run in the request thread, so the work is done in a
+    separate thread.
+
+    :param job: the job to run.
+    """
+    imageItem = ModelImporter.model('image_item', 'large_image')
+    thread = threading.Thread(target=imageItem._pregenerateTiles, args=(job, ))
+    thread.daemon = True
+    thread.start()
 
 
 class ImageItem(Item):
@@ -35,7 +147,20 @@ class ImageItem(Item):
     def initialize(self):
         super(ImageItem, self).initialize()
 
-    def createImageItem(self, item, fileObj, user=None, token=None):
+    def createImageItem(self, item, fileObj, user=None, token=None,
+                        **kwargs):
+        """
+        Make an item a large image item.  If the file can't be read directly
+        by a tile source, a job is created to convert it.
+
+        :param item: the item to use.
+        :param fileObj: the file in the item with the image.
+        :param user: the user that owns any job that is created.
+        :param token: the token used by the conversion job.
+        :param **kwargs: optional conversion options: tileSize, quality, and
+            concurrency.  Unspecified options use configured defaults.
+        :returns: the conversion job or None.
+        """
         # Using setdefault ensures that 'largeImage' is in the item
         if 'fileId' in item.setdefault('largeImage', {}):
             # TODO: automatically delete the existing large file
@@ -53,27 +178,34 @@ class ImageItem(Item):
 
         item['largeImage']['fileId'] = fileObj['_id']
         job = None
-        for sourceName in AvailableTileSources:
-            if getattr(AvailableTileSources[sourceName], 'girderSource',
-                       False):
-                if AvailableTileSources[sourceName].canRead(item):
-                    item['largeImage']['sourceName'] = sourceName
-                    break
+        # Try the sources that are most likely to read the file first
+        for sourceName in rankSources(AvailableTileSources, item, True):
+            if AvailableTileSources[sourceName].canRead(item):
+                item['largeImage']['sourceName'] = sourceName
+                break
         if 'sourceName' not in item['largeImage']:
             # No source was successful
             del item['largeImage']['fileId']
-            job = self._createLargeImageJob(item, fileObj, user, token)
+            job = self._createLargeImageJob(
+                item, fileObj, user, token, **kwargs)
             item['largeImage']['expected'] = True
             item['largeImage']['originalId'] = fileObj['_id']
             item['largeImage']['jobId'] = job['_id']
 
         self.save(item)
+        if job is None:
+            self.pregenerateTilesOnCreate(item, user)
         return job
 
-    def _createLargeImageJob(self, item, fileObj, user, token):
-        path = os.path.join(os.path.dirname(__file__), '..', 'create_tiff.py')
-        with open(path, 'r') as f:
-            script = f.read()
+    def _createLargeImageJob(self, item, fileObj, user, token, tileSize=None,
+                             quality=None, concurrency=None):
+        # The worker may not have this plugin installed, so send the fallback
+        # TIFF writer as part of the conversion script.
+        script = ''
+        for name in ('tiff_writer.py', 'create_tiff.py'):
+            path = os.path.join(os.path.dirname(__file__), '..', name)
+            with open(path, 'r') as f:
+                script += f.read() + '\n'
 
         title = 'TIFF conversion: %s' % fileObj['name']
         Job = self.model('job', 'jobs')
@@ -103,6 +235,26 @@ class ImageItem(Item):
                 'id': 'quality',
                 'type': 'number',
                 'format': 'number'
+            }, {
+                'id': 'concurrency',
+                'type': 'number',
+                'format': 'number'
+            }, {
+                'id': 'max_pixels',
+                'type': 'number',
+                'format': 'number'
+            }, {
+                'id': 'checkpoint_dir',
+                'type': 'string',
+                'format': 'text'
+            }, {
+                'id': 'checkpoint_key',
+                'type': 'string',
+                'format': 'text'
+            }, {
+                'id': 'checkpoint_max_age',
+                'type': 'number',
+                'format': 'number'
             }],
             'outputs': [{
                 'id': 'out_path',
@@ -112,6 +264,10 @@ class ImageItem(Item):
             }]
         }
 
+        if tileSize is None:
+            tileSize = _getConfigOption('convert_tile_size')
+        if quality is None:
+            quality = _getConfigOption('convert_quality')
         inputs = {
             'in_path': workerUtils.girderInputSpec(
                 item, resourceType='item', token=token),
@@ -119,13 +275,46 @@ class ImageItem(Item):
                 'mode': 'inline',
                 'type': 'number',
                 'format': 'number',
-                'data': 90
+                'data': quality
             },
             'tile_size': {
                 'mode': 'inline',
                 'type': 'number',
                 'format': 'number',
-                'data': 256
+                'data': tileSize
+            },
+            'concurrency': {
+                'mode': 'inline',
+                'type': 'number',
+                'format': 'number',
+                'data': (concurrency if concurrency is not None else
+                         _getConfigOption('convert_concurrency'))
+            },
+            'max_pixels': {
+                'mode': 'inline',
+                'type': 'number',
+                'format': 'number',
+                'data': _getConfigOption('convert_pillow_max_pixels')
+            },
+            'checkpoint_dir': {
+                'mode': 'inline',
+                'type': 'string',
+                'format': 'text',
+                'data': _getConfigOption('convert_checkpoint_path')
+            },
+            'checkpoint_key': {
+                'mode': 'inline',
+                'type': 'string',
+                'format': 'text',
+                # Partial output can only be reused for the same file and
+                # options
+                'data': '%s-%s-%s' % (fileObj['_id'], tileSize, quality)
+            },
+            'checkpoint_max_age': {
+                'mode': 'inline',
+                'type': 'number',
+                'format': 'number',
+                'data': _getConfigOption('convert_checkpoint_max_age')
             },
             'out_filename': {
                 'mode': 'inline',
@@ -156,36 +345,397 @@ class ImageItem(Item):
         return job
 
     @classmethod
-    def _loadTileSource(cls, item, **kwargs):
+    def _loadTileSource(cls, item, tileSize=None, tileOverlap=None,
+                        **kwargs):
+        """
+        Get the tile source of an item.
+
+        :param item: the item with the tile source.
+        :param tileSize: if not None, serve tiles of this size instead of the
+            source's own tile size.
+        :param tileOverlap: if not None, serve tiles that overlap their
+            neighbors by this many pixels.
+        :param **kwargs: optional arguments passed to the tile source.
+        :returns: a tile source.
+        """
         if 'largeImage' not in item:
             raise TileSourceException('No large image file in this item.')
         if item['largeImage'].get('expected'):
-            raise TileSourceException('The large image file for this item is '
-                                      'still pending creation.')
-
-        sourceName = item['largeImage']['sourceName']
-
-        if sourceName == 'test':
-            tileSource = TestTileSource(**kwargs)
+            tileSource = cls._loadConvertingTileSource(item, **kwargs)
+            if tileSource is None:
+                raise TileSourceException('The large image file for this item '
+                                          'is still pending creation.')
         else:
-            tileSource = AvailableTileSources[sourceName](item, **kwargs)
+            sourceName = item['largeImage']['sourceName']
+
+            if sourceName == 'test':
+                tileSource = AvailableTileSources['test'](**kwargs)
+            else:
+                tileSource = AvailableTileSources[sourceName](item, **kwargs)
+        if tileSize is not None or tileOverlap is not None:
+            from ..tilesource.retile import RetiledTileSource
+
+            tileSource = RetiledTileSource(
+                tileSource,
+                int(tileSize) if tileSize is not None else
+                tileSource.getMetadata()['tileWidth'],
+                int(tileOverlap or 0))
         return tileSource
 
+    @staticmethod
+    def _loadConvertingTileSource(item, **kwargs):
+        """
+        Get a temporary tile source that reads the original file of an item
+        that is being converted.  Once the conversion finishes, the item uses
+        the converted file instead.
+
+        :param item: an item with a pending large image.
+        :param **kwargs: optional arguments passed to the tile source.
+        :returns: a tile source or None if the original file can't be read.
+        """
+        # This is None if PIL or numpy isn't available
+        PILGirderTileSource = getattr(tilesource, 'PILGirderTileSource', None)
+        if (not _getConfigOption('convert_on_read') or
+                'originalId' not in item['largeImage'] or
+                PILGirderTileSource is None):
+            return None
+        try:
+            return PILGirderTileSource(item, maxPixels=_getConfigOption(
+                'convert_on_read_max_pixels') or None, **kwargs)
+        except TileSourceException:
+            return None
+
     def getMetadata(self, item, **kwargs):
         tileSource = self._loadTileSource(item, **kwargs)
         return tileSource.getMetadata()
 
+    @staticmethod
+    def _tileSourceKey(item, kwargs):
+        """
+        Get a key that identifies the tiles a tile source would produce for an
+        item with a set of options.
+
+        :param item: the item with the tile source.
+        :param kwargs: the options passed to the tile source.
+        :returns: a hashable tuple, or None if the item has no usable large
+            image.
+        """
+        largeImage = item.get('largeImage', {})
+        if 'sourceName' not in largeImage or largeImage.get('expected'):
+            return None
+        return (str(largeImage.get('fileId')), largeImage['sourceName'],
+                tuple(sorted(six.iteritems(kwargs))))
+
     def getTile(self, item, x, y, z, **kwargs):
+        sourceKey = self._tileSourceKey(item, kwargs)
+        tile = None
+        if sourceKey is not None:
+            tile = _tileCache.get(sourceKey + ((x, y, z), ))
+            if tile is None and item['largeImage'].get('fileId'):
+                tile = self._getTileStore().get(
+                    sourceKey[0], sourceKey[1:], x, y, z)
+                if tile is not None:
+                    _tileCache.put(sourceKey + ((x, y, z), ), tile)
+        if tile is None:
+            tileSource = self._loadTileSource(item, **kwargs)
+            tileData = tileSource.getTile(x, y, z)
+            tileMimeType = tileSource.getTileMimeType()
+            tile = (tileData, tileMimeType)
+            if sourceKey is not None:
+                _tileCache.put(sourceKey + ((x, y, z), ), tile)
+        if sourceKey is not None and _getConfigOption('prefetch_tiles'):
+            self._prefetchTiles(item, sourceKey, x, y, z, kwargs)
+        return tile
+
+    def getTileUrlToken(self, item):
+        """
+        Create a token that lets anyone who has it read the tiles of an item
+        through the tile routes without other authentication until it
+        expires.  Access to the item must already have been checked.
+
+        :param item: the item with the large image.
+        :returns: the token and the time it expires in seconds since the
+            epoch.
+        """
+        secret = _getConfigOption('tile_signing_secret')
+        if not secret:
+            raise TileGeneralException('Signed tile URLs are not configured.')
+        expires = int(time.time()) + _getConfigOption('tile_token_lifetime')
+        return signToken(secret, {'itemId': str(item['_id'])}, expires), \
+            expires
+
+    def getTileServerToken(self, item):
+        """
+        Create a token that lets a client read the tiles of an item from the
+        standalone tile server.  Access to the item must already have been
+        checked.
+
+        :param item: the item with the large image.
+        :returns: a dictionary with the token, the time it expires in seconds
+            since the epoch, and the tile server's URL template for the tiles
+            of the item.
+        """
+        secret = _getConfigOption('tile_signing_secret')
+        serverUrl = _getConfigOption('tile_server_url')
+        if not secret or not serverUrl:
+            raise TileGeneralException('A tile server is not configured.')
+        largeImage = item.get('largeImage', {})
+        if not largeImage.get('fileId') or largeImage.get('expected'):
+            raise TileGeneralException('No large image file in this item.')
+        # The tile server reads the file directly.  Anyone with the token can
+        # read its contents, so it only names the file relative to the root of
+        # its assetstore, which the tile server is configured with.
+        fileObj = self.model('file').load(largeImage['fileId'], force=True)
+        path = tilesource.GirderTileSource._getFileObjPath(fileObj)
+        assetstore = self.model('assetstore').load(fileObj['assetstoreId'])
+        path = os.path.relpath(path, assetstore['root'])
+        if path.split(os.sep)[0] == os.pardir:
+            raise TileGeneralException(
+                'The tile server can only read files within an assetstore.')
+        expires = int(time.time()) + _getConfigOption('tile_token_lifetime')
+        token = signToken(secret, {
+            'assetstore': str(assetstore['_id']),
+            'path': path.replace(os.sep, '/'),
+        }, expires)
+        return {
+            'token': token,
+            'expires': expires,
+            'url': '%s/tiles/%s/{z}/{x}/{y}' % (serverUrl.rstrip('/'), token),
+        }
+
+    @staticmethod
+    def _getTileStore():
+        """
+        Get the store used for pregenerated tiles.
+
+        :returns: a DiskTileStore.
+        """
+        return DiskTileStore(_getConfigOption('tile_store_path'))
+
+    def pregenerateTiles(self, item, levels=None, user=None):
+        """
+        Create and schedule a job to generate the tiles of the lowest
+        resolution levels of an item and store them on disk, so that the tiles
+        that are viewed first are never slow to generate.
+
+        :param item: the item with the large image.
+        :param levels: the number of levels, starting at the lowest
+            resolution, to generate.  None uses the configured default.
+        :param user: the user that owns the job.
+        :returns: the job model.
+        """
+        if (self._tileSourceKey(item, {}) is None or
+                not item['largeImage'].get('fileId')):
+            raise TileGeneralException('No large image file in this item.')
+        Job = self.model('job', 'jobs')
+        job = Job.createLocalJob(
+            module=__name__, function='pregenerateTilesJob',
+            title='Pregenerate tiles: %s' % item['name'],
+            type='large_image_pregenerate', user=user,
+            kwargs={'itemId': str(item['_id']), 'levels': levels})
+        Job.scheduleLocalJob(job)
+        return job
+
+    def pregenerateTilesOnCreate(self, item, user=None):
+        """
+        Schedule tile pregeneration for a newly created large image if this is
+        enabled in the configuration.
+
+        :param item: the item with the large image.
+        :param user: the user that owns the job.
+        :returns: the job model or None.
+        """
+        if _getConfigOption('pregenerate_on_create'):
+            return self.pregenerateTiles(item, user=user)
+
+    def _pregenerateTiles(self, job):
+        """
+        Generate tiles for a pregeneration job.  Tiles that are already in the
+        store are not regenerated.
+
+        :param job: the job model.  Its kwargs contain itemId and levels.
+        """
+        Job = self.model('job', 'jobs')
+        job = Job.updateJob(job, status=JobStatus.RUNNING)
+        try:
+            item = self.load(job['kwargs']['itemId'], force=True)
+            tileSource = self._loadTileSource(item)
+            sourceKey = self._tileSourceKey(item, {})
+            tileMimeType = tileSource.getTileMimeType()
+            metadata = tileSource.getMetadata()
+            levels = min(job['kwargs'].get('levels') or
+                         _getConfigOption('pregenerate_levels'),
+                         metadata['levels'])
+            positions = []
+            for z in range(levels):
+                scale = 2 ** (metadata['levels'] - 1 - z)
+                for y in range(int(math.ceil(float(metadata['sizeY']) / (
+                        metadata['tileHeight'] * scale)))):
+                    for x in range(int(math.ceil(float(metadata['sizeX']) / (
+                            metadata['tileWidth'] * scale)))):
+                        positions.append((x, y, z))
+            store = self._getTileStore()
+
+            def generateTile(pos):
+                x, y, z = pos
+                if not store.contains(sourceKey[0], sourceKey[1:], x, y, z):
+                    try:
+                        tileData = tileSource.getTile(x, y, z)
+                    except TileGeneralException:
+                        # Sparse images may be missing tiles
+                        return
+                    store.put(sourceKey[0], sourceKey[1:], x, y, z,
+                              tileData, tileMimeType)
+
+            job = Job.updateJob(
+                job, log='Generating %d tiles in %d levels\n' % (
+                    len(positions), levels),
+                progressTotal=len(positions), progressCurrent=0)
+            pool = self._getThreadPool(
+                'pregenerate', _getConfigOption('pregenerate_threads'))
+            for idx, _ in enumerate(pool.imap_unordered(
+                    generateTile, positions)):
+                if not (idx + 1) % 100:
+                    job = Job.updateJob(job, progressCurrent=idx + 1)
+            Job.updateJob(job, status=JobStatus.SUCCESS,
+                          progressCurrent=len(positions),
+                          log='Finished generating tiles\n')
+        except Exception as exc:
+            logger.exception('Failed to pregenerate tiles')
+            Job.updateJob(job, status=JobStatus.ERROR,
+                          log='Failed to pregenerate tiles: %s\n' % exc)
+
+    def _prefetchTiles(self, item, sourceKey, x, y, z, kwargs):
+        """
+        Queue fetching the tiles that surround a tile and its children at the
+        next level into the tile cache.  Tiles that are already cached or
+        queued are skipped, and no more than the prefetch budget of tiles is
+        queued for any one source.
+
+        :param item: the item with the tile source.
+        :param sourceKey: the key returned by _tileSourceKey.
+        :param x: the column of the requested tile.
+        :param y: the row of the requested tile.
+        :param z: the level of the requested tile.
+        :param kwargs: the options passed to the tile source.
+        """
+        positions = [(x + dx, y + dy, z) for dy in (-1, 0, 1)
+                     for dx in (-1, 0, 1) if dx or dy]
+        positions.extend([(x * 2 + dx, y * 2 + dy, z + 1) for dy in (0, 1)
+                          for dx in (0, 1)])
+        budget = _getConfigOption('prefetch_budget')
+        with _prefetchLock:
+            pending = _prefetchPending.setdefault(sourceKey, set())
+            positions = [
+                pos for pos in positions if min(pos) >= 0 and
+                pos not in pending and
+                _tileCache.get(sourceKey + (pos, )) is None]
+            positions = positions[:max(0, budget - len(pending))]
+            if not positions:
+                if not pending:
+                    del _prefetchPending[sourceKey]
+                return
+            pending.update(positions)
+        self._getThreadPool(
+            'prefetch', _getConfigOption('prefetch_threads')).apply_async(
+            self._prefetchWorker, (item, sourceKey, positions, kwargs))
+
+    def _prefetchWorker(self, item, sourceKey, positions, kwargs):
+        """
+        Fetch a list of tiles into the tile cache.  This is run in the
+        prefetch thread pool.  Tiles outside of the image are ignored.
+
+        :param item: the item with the tile source.
+        :param sourceKey: the key returned by _tileSourceKey.
+        :param positions: a list of (x, y, z) tuples to fetch.
+        :param kwargs: the options passed to the tile source.
+        """
+        try:
+            tileSource = self._loadTileSource(item, **kwargs)
+            metadata = tileSource.getMetadata()
+            tileMimeType = tileSource.getTileMimeType()
+            for x, y, z in positions:
+                if z >= metadata['levels']:
+                    continue
+                scale = 2 ** (metadata['levels'] - 1 - z)
+                if (x * metadata['tileWidth'] * scale >= metadata['sizeX'] or
+                        y * metadata['tileHeight'] * scale >=
+                        metadata['sizeY']):
+                    continue
+                try:
+                    _tileCache.put(sourceKey + ((x, y, z), ), (
+                        tileSource.getTile(x, y, z), tileMimeType))
+                except TileGeneralException:
+                    pass
+        except Exception:
+            logger.exception('Failed to prefetch tiles')
+        finally:
+            with _prefetchLock:
+                pending = _prefetchPending.get(sourceKey, set())
+                pending.difference_update(positions)
+                if not pending:
+                    _prefetchPending.pop(sourceKey, None)
+
+    def getTiles(self, item, tiles, **kwargs):
+        """
+        Get a list of tiles from an item.  The tiles are fetched concurrently,
+        but are yielded in the order requested.  Failing to load the tile
+        source raises an exception immediately; failing to get an individual
+        tile is reported as part of the results.
+
+        :param item: the item with the tile source.
+        :param tiles: a list of (x, y, z) tuples.
+        :param **kwargs: optional arguments passed to the tile source.
+        :returns: a generator that yields (tileData, tileMimeType, exception)
+            for each tile.  exception is None if the tile was successfully
+            fetched, a TileGeneralException if the tile doesn't exist, and any
+            other exception if getting the tile failed.
+        """
         tileSource = self._loadTileSource(item, **kwargs)
-        tileData = tileSource.getTile(x, y, z)
         tileMimeType = tileSource.getTileMimeType()
-        return tileData, tileMimeType
+        sourceKey = self._tileSourceKey(item, kwargs)
+
+        def fetchTile(tile):
+            x, y, z = tile
+            if sourceKey is not None:
+                cached = _tileCache.get(sourceKey + (tile, ))
+                if cached is not None:
+                    return cached[0], cached[1], None
+            try:
+                tileData = tileSource.getTile(x, y, z)
+            except TileGeneralException as exc:
+                return None, None, exc
+            except Exception as exc:
+                # The results are streamed, so this can't fail the request
+                logger.exception('Failed to get tile %d/%d/%d' % (z, x, y))
+                return None, None, exc
+            if sourceKey is not None:
+                _tileCache.put(sourceKey + (tile, ), (tileData, tileMimeType))
+            return tileData, tileMimeType, None
+
+        return self._getThreadPool('batch', TileBatchThreads).imap(
+            fetchTile, tiles)
+
+    @staticmethod
+    def _getThreadPool(name, threads):
+        """
+        Get a named thread pool, creating it if necessary.
+
+        :param name: the name of the pool.
+        :param threads: the number of threads to use if the pool is created.
+        :returns: a thread pool.
+        """
+        with _threadPoolLock:
+            if name not in _threadPools:
+                _threadPools[name] = ThreadPool(threads)
+        return _threadPools[name]
 
     def delete(self, item):
         Job = self.model('job', 'jobs')
         deleted = False
         if 'largeImage' in item:
             job = None
+            canceled = False
             if 'jobId' in item['largeImage']:
                 try:
                     job = Job.load(item['largeImage']['jobId'], force=True,
@@ -196,16 +746,17 @@ class ImageItem(Item):
                     pass
             if (item['largeImage'].get('expected') and job and
                     job.get('status') in (
-                    JobStatus.QUEUED, JobStatus.RUNNING)):
-                # cannot cleanly remove the large image, since a conversion
-                # job is currently in progress
-                # TODO: cancel the job
-                # TODO: return a failure error code
-                return False
+                    JobStatus.INACTIVE, JobStatus.QUEUED, JobStatus.RUNNING)):
+                # Cancel the conversion job.  Its partial output is kept by
+                # the worker, so converting the file again resumes it.  The
+                # worker still reports to the job until it stops, so the job
+                # is left in place.
+                self._cancelJob(job)
+                canceled = True
 
             # If this file was created by the worker job, delete it
             if 'jobId' in item['largeImage']:
-                if job:
+                if job and not canceled:
                     # TODO: does this eliminate all traces of the job?
                     # TODO: do we want to remove the original job?
                     Job.remove(job)
@@ -221,6 +772,9 @@ class ImageItem(Item):
                         id=item['largeImage']['fileId'], force=True))
                 del item['largeImage']['originalId']
 
+            if 'fileId' in item['largeImage']:
+                self._getTileStore().remove(item['largeImage']['fileId'])
+
             del item['largeImage']
 
             self.save(item)
@@ -228,6 +782,21 @@ class ImageItem(Item):
 
         return deleted
 
+    def _cancelJob(self, job):
+        """
+        Cancel a conversion job.  Once the job is canceled, the worker stops
+        at its next progress report and its output is no longer added to the
+        item.
+
+        :param job: the job to cancel.
+        """
+        Job = self.model('job', 'jobs')
+        if hasattr(Job, 'cancelJob'):
+            # This also notifies the worker so that queued jobs never start
+            Job.cancelJob(job)
+        else:
+            Job.updateJob(job, status=JobStatus.CANCELED)
+
     def getThumbnail(self, item, width=None, height=None, **kwargs):
         """
         Using a tile source, get a basic thumbnail.  Aspect ratio is
@@ -248,6 +817,125 @@ class ImageItem(Item):
             width, height, **kwargs)
         return thumbData, thumbMime
 
+    def getStatistics(self, item, level=None, bins=256):
+        """
+        Get the per-channel histogram, minimum, maximum, mean, and standard
+        deviation of a large image.  Results are stored in the item's large
+        image information, so they are discarded with it.
+
+        :param item: the item with the tile source.
+        :param level: the level to compute statistics from.  None to use a
+            low resolution level picked by the tile source.  Other levels
+            may have no more than the configured statistics_max_pixels.
+        :param bins: the number of histogram bins.
+        :returns: the statistics.  See TileSource.getStatistics.
+        """
+        if 'largeImage' not in item:
+            raise TileSourceException('No large image file in this item.')
+        # Only the default statistics are stored, so requests for other
+        # levels and bins can't add to the item
+        default = level is None and bins == DefaultStatisticsBins
+        stored = item['largeImage'].get('statistics', {})
+        if default and DefaultStatisticsKey in stored:
+            return stored[DefaultStatisticsKey]
+        tileSource = self._loadTileSource(item)
+        if level is not None:
+            metadata = tileSource.getMetadata()
+            scale = 2 ** (metadata['levels'] - 1 - level)
+            maxPixels = _getConfigOption('statistics_max_pixels')
+            if (0 <= level < metadata['levels'] and maxPixels and
+                    (metadata['sizeX'] // scale) *
+                    (metadata['sizeY'] // scale) > maxPixels):
+                raise TileSourceException(
+                    'The level is too large to compute statistics from.')
+        stats = tileSource.getStatistics(level, bins)
+        if default and not item['largeImage'].get('expected'):
+            item['largeImage'].setdefault('statistics', {})[
+                DefaultStatisticsKey] = stats
+            self._setLargeImageValue(
+                item, 'statistics.' + DefaultStatisticsKey, stats)
+        return stats
+
+    def getTissueMask(self, item, threshold=None, recompute=False):
+        """
+        Get the mask of where there is tissue in a slide.  The mask is
+        computed from a low resolution image the first time it is needed and
+        stored in the item's large image information.
+
+        :param item: the item with the tile source.
+        :param threshold: the brightness below which pixels are tissue.  None
+            to use the stored mask or to pick a threshold from the image.
+        :param recompute: if True, compute the mask even if one is stored.
+        :returns: the mask as a 2-D boolean numpy array.
+        """
+        from ..tilesource import tissue
+
+        if 'largeImage' not in item:
+            raise TileSourceException('No large image file in this item.')
+        if item['largeImage'].get('expected'):
+            # The mask would be computed from the original file and discarded
+            # when the conversion finishes
+            raise TileSourceException('The large image file for this item '
+                                      'is still pending creation.')
+        record = item['largeImage'].get('tissueMask')
+        if (record is None or recompute or
+                (threshold is not None and threshold != record['threshold'])):
+            tileSource = self._loadTileSource(item)
+            mask, threshold = tissue.getSourceTissueMask(
+                tileSource, threshold=threshold)
+            record = tissue.encodeMask(mask, threshold)
+            item['largeImage']['tissueMask'] = record
+            self._setLargeImageValue(item, 'tissueMask', record)
+            return mask
+        return tissue.decodeMask(record)
+
+    def _setLargeImageValue(self, item, key, value):
+        """
+        Store a value computed from the large image file of an item.  Only
+        this value is written, so other changes made to the item since it
+        was loaded are kept.  Nothing is stored if the item's large image has
+        since been removed, replaced, or scheduled for conversion.
+
+        :param item: the item the value was computed from.
+        :param key: the key of the value within the item's large image
+            information.  This may use dots to refer to nested values.
+        :param value: the value to store.
+        """
+        self.update({
+            '_id': item['_id'],
+            'largeImage.fileId': item['largeImage'].get('fileId'),
+            'largeImage.expected': {'$exists': False},
+        }, {'$set': {'largeImage.' + key: value}})
+
+    def getTileOccupancy(self, item, level):
+        """
+        Find which tiles of a level contain tissue.
+
+        :param item: the item with the tile source.
+        :param level: the level of the tiles.
+        :returns: a 2-D boolean numpy array with one entry per tile, indexed by
+            row and then column.
+        """
+        from ..tilesource import tissue
+
+        mask = self.getTissueMask(item)
+        return tissue.getTileOccupancy(
+            mask, self.getMetadata(item), level)
+
+    def iterOccupiedTiles(self, item, level):
+        """
+        Iterate through the tiles of a level that contain tissue, so that
+        analysis can skip the background.
+
+        :param item: the item with the tile source.
+        :param level: the level of the tiles.
+        :returns: an iterator of (x, y) tile positions, ordered by row.
+        """
+        from ..tilesource import tissue
+
+        mask = self.getTissueMask(item)
+        return tissue.iterOccupiedTiles(mask, self.getMetadata(item), level)
+
     def getRegion(self, item, **kwargs):
         """
         Using a tile source, get an arbitrary region of the image, optionally
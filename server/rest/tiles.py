@@ -18,6 +18,13 @@
 ###############################################################################
 
 import cherrypy
+import hashlib
+import json
+import math
+import PIL.Image
+import repoze.lru
+import six
+import uuid
 
 from girder.api import access
 from girder.api.v1.item import Item
@@ -26,10 +33,171 @@ from girder.api.rest import filtermodel, loadmodel, RestException
 from girder.models.model_base import AccessType
 
 from ..models import TileGeneralException
+from ..models.image_item import _getConfigOption
+from ..tilesource.base import TileSource
+from ..tilesource.signing import verifyToken
 
 from .. import constants
 
 
+# The maximum number of tiles that can be requested in a single batch
+MaxTileBatchSize = 256
+
+# The DeepZoom and IIIF file extensions for each output encoding
+DziFormats = {ext: encoding for ext, encoding in six.iteritems({
+    'jpeg': 'JPEG', 'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'})
+    if encoding in TileSource.outputMimeTypes}
+IiifFormats = {ext: encoding for ext, encoding in six.iteritems({
+    'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'})
+    if encoding in TileSource.outputMimeTypes}
+
+# The largest images that the IIIF route produces.  These are listed in the
+# IIIF information, and larger sizes are refused.
+IiifMaxWidth = 8192
+IiifMaxHeight = 8192
+IiifMaxArea = 4096 * 4096
+
+# Parameters that change how tiles are rendered, which the DeepZoom and IIIF
+# routes pass on to the tile source
+ImageStyleParams = [
+    ('jpegQuality', int),
+    ('jpegSubsampling', int),
+    ('channels', str),
+    ('windowMin', str),
+    ('windowMax', str),
+    ('colormap', str),
+]
+
+# Parameters that change the tile grid of a large image
+TileGridParams = [
+    ('tileSize', int),
+    ('tileOverlap', int),
+]
+
+# Items recently loaded by the tile route, keyed by item id.  Each entry holds
+# the parts of the item needed to serve tiles and the set of tokens that have
+# been granted read access.  Entries are dropped when the item is saved or
+# removed; the timeout bounds how long a change in access is ignored.
+_tileItemCache = repoze.lru.ExpiringLRUCache(1000, default_timeout=60)
+
+
+def _acceptsMimeType(accept, mimeType):
+    """
+    Check if an Accept header explicitly lists a mime type.  Wildcards are
+    ignored, since browsers send them with every request.
+
+    :param accept: the value of the Accept header.
+    :param mimeType: the mime type to look for.
+    :returns: True if the mime type is listed with a nonzero quality.
+    """
+    for entry in accept.split(','):
+        parts = [part.strip() for part in entry.split(';')]
+        if parts[0].lower() != mimeType:
+            continue
+        for part in parts[1:]:
+            if part.replace(' ', '').lower().startswith('q='):
+                try:
+                    return float(part.split('=', 1)[1]) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def _parseIiifRegion(region, sizeX, sizeY):
+    """
+    Parse the region of an IIIF image request.
+
+    :param region: full, square, x,y,w,h, or pct:x,y,w,h.
+    :param sizeX: the width of the image.
+    :param sizeY: the height of the image.
+    :returns: the left, top, width, and height of the region in pixels,
+        clipped to the image.
+    """
+    if region == 'full':
+        return 0, 0, sizeX, sizeY
+    if region == 'square':
+        side = min(sizeX, sizeY)
+        return (sizeX - side) // 2, (sizeY - side) // 2, side, side
+    try:
+        if region.startswith('pct:'):
+            values = [float(value) for value in region[4:].split(',')]
+            left, width = [int(round(value * sizeX / 100))
+                           for value in values[0::2]]
+            top, height = [int(round(value * sizeY / 100))
+                           for value in values[1::2]]
+        else:
+            left, top, width, height = [int(value)
+                                        for value in region.split(',')]
+    except ValueError:
+        raise RestException('Invalid region "%s".' % region)
+    if left < 0 or top < 0 or width <= 0 or height <= 0:
+        raise RestException('Invalid region "%s".' % region)
+    width = min(width, sizeX - left)
+    height = min(height, sizeY - top)
+    if width <= 0 or height <= 0:
+        raise RestException('The region is outside of the image.')
+    return left, top, width, height
+
+
+def _parseIiifSize(size, width, height):
+    """
+    Parse the size of an IIIF image request.
+
+    :param size: full, max, w,, ,h, pct:n, w,h, or !w,h.  max is the full
+        size, scaled down if needed to fit IiifMaxWidth, IiifMaxHeight, and
+        IiifMaxArea.
+    :param width: the width of the region in pixels.
+    :param height: the height of the region in pixels.
+    :returns: the width and height of the output image.
+    """
+    try:
+        if size == 'full':
+            outWidth, outHeight = width, height
+        elif size == 'max':
+            factor = min(1.0, float(IiifMaxWidth) / width,
+                         float(IiifMaxHeight) / height,
+                         math.sqrt(float(IiifMaxArea) / (width * height)))
+            outWidth = int(round(width * factor))
+            outHeight = int(round(height * factor))
+            if outWidth * outHeight > IiifMaxArea:
+                outWidth, outHeight = int(width * factor), int(
+                    height * factor)
+        elif size.startswith('pct:'):
+            factor = float(size[4:]) / 100
+            if factor <= 0:
+                raise ValueError
+            outWidth = int(round(width * factor))
+            outHeight = int(round(height * factor))
+        else:
+            confined = size.startswith('!')
+            outWidth, outHeight = [
+                int(value) if value else None
+                for value in size.lstrip('!').split(',')]
+            if (outWidth is None and outHeight is None) or any(
+                    value is not None and value <= 0
+                    for value in (outWidth, outHeight)):
+                raise ValueError
+            if outHeight is None:
+                outHeight = int(round(float(height) * outWidth / width))
+            elif outWidth is None:
+                outWidth = int(round(float(width) * outHeight / height))
+            elif confined:
+                factor = min(float(outWidth) / width,
+                             float(outHeight) / height)
+                outWidth = int(round(width * factor))
+                outHeight = int(round(height * factor))
+    except ValueError:
+        raise RestException('Invalid size "%s".' % size)
+    # Very thin regions could otherwise scale to nothing
+    outWidth, outHeight = max(outWidth, 1), max(outHeight, 1)
+    if (outWidth > IiifMaxWidth or outHeight > IiifMaxHeight or
+            outWidth * outHeight > IiifMaxArea):
+        raise RestException(
+            'The size "%s" is larger than the largest supported size.' % size)
+    return outWidth, outHeight
+
+
 class TilesItemResource(Item):
 
     def __init__(self, apiRoot):
@@ -47,6 +215,29 @@ class TilesItemResource(Item):
                            self.getTilesRegion)
         apiRoot.item.route('GET', (':itemId', 'tiles', 'zxy', ':z', ':x', ':y'),
                            self.getTile)
+        apiRoot.item.route('POST', (':itemId', 'tiles', 'pregenerate'),
+                           self.pregenerateTiles)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'batch'),
+                           self.getTileBatch)
+        apiRoot.item.route('POST', (':itemId', 'tiles', 'batch'),
+                           self.getTileBatch)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'dzi.dzi'),
+                           self.getDziInfo)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'dzi_files', ':level',
+                                   ':tile'), self.getDziTile)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'iiif', 'info.json'),
+                           self.getIiifInfo)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'iiif', ':region',
+                                   ':size', ':rotation', ':quality'),
+                           self.getIiifImage)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'histogram'),
+                           self.getTilesHistogram)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'occupancy'),
+                           self.getTileOccupancy)
+        apiRoot.item.route('POST', (':itemId', 'tiles', 'tissue'),
+                           self.computeTissueMask)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'tileserver'),
+                           self.getTileServerToken)
         apiRoot.item.route('GET', ('test', 'tiles'), self.getTestTilesInfo)
         apiRoot.item.route('GET', ('test', 'tiles', 'zxy', ':z', ':x', ':y'),
                            self.getTestTile)
@@ -60,6 +251,12 @@ class TilesItemResource(Item):
         .param('fileId', 'The ID of the source file containing the image. '
                          'Required if there is more than one file in the item.',
                required=False)
+        .param('tileSize', 'The tile size used if the image must be '
+               'converted.', required=False, dataType='int')
+        .param('quality', 'The JPEG quality used if the image must be '
+               'converted.', required=False, dataType='int')
+        .param('concurrency', 'The number of threads libvips uses if the '
+               'image must be converted.', required=False, dataType='int')
     )
     @access.user
     @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.WRITE)
@@ -77,10 +274,41 @@ class TilesItemResource(Item):
             largeImageFileId, force=True, exc=True)
         user = self.getCurrentUser()
         token = self.getCurrentToken()
+        convertParams = self._parseParams(params, False, [
+            ('tileSize', int),
+            ('quality', int),
+            ('concurrency', int),
+        ])
         try:
             return self.model(
                 'image_item', 'large_image').createImageItem(
-                    item, largeImageFile, user, token)
+                    item, largeImageFile, user, token, **convertParams)
+        except TileGeneralException as e:
+            raise RestException(e.message)
+
+    @describeRoute(
+        Description('Generate and store the tiles of the lowest resolution '
+                    'levels of a large image.')
+        .notes('This schedules a job.  Once tiles are stored, they are served '
+               'without using the original image.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('levels', 'The number of levels to generate, starting with the '
+               'lowest resolution level.  If not specified, a configured '
+               'default is used.', required=False, dataType='int')
+    )
+    @access.user
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.WRITE)
+    @filtermodel(model='job', plugin='jobs')
+    def pregenerateTiles(self, item, params):
+        params = self._parseParams(params, False, [
+            ('levels', int),
+        ])
+        if params.get('levels') is not None and params['levels'] < 1:
+            raise RestException('"levels" must be a positive integer.')
+        try:
+            return self.model(
+                'image_item', 'large_image').pregenerateTiles(
+                    item, params.get('levels'), self.getCurrentUser())
         except TileGeneralException as e:
             raise RestException(e.message)
 
@@ -111,6 +339,240 @@ class TilesItemResource(Item):
                     '"%s" parameter is an incorrect type.' % paramName)
         return results
 
+    def _parseTileGridParams(self, params):
+        """
+        Parse the parameters of a request that may ask for a different tile
+        size or overlap.
+
+        :param params: the request parameters.
+        :returns: the parameters with tileSize and tileOverlap as integers.
+        """
+        params = self._parseParams(params, True, TileGridParams)
+        tileSize = params.get('tileSize')
+        overlap = params.get('tileOverlap', 0)
+        if ((tileSize is not None and
+                not 1 <= tileSize <= constants.MaxTileSize) or
+                not 0 <= overlap < (tileSize or constants.MaxTileSize)):
+            raise RestException(
+                '"tileSize" must be between 1 and %d and "tileOverlap" must '
+                'be less than it.' % constants.MaxTileSize)
+        return params
+
+    @staticmethod
+    def invalidateTileItemCache(event):
+        """
+        Discard any cached tile-route information about an item.  This is
+        bound to item save and remove events.
+
+        :param event: the event whose info is the item.
+        """
+        item = event.info
+        if isinstance(item, dict) and '_id' in item:
+            _tileItemCache.invalidate(str(item['_id']))
+
+    def _getRequestTokenKey(self):
+        """
+        Get the token string sent with the current request without looking it
+        up in the database.  This uses the same sources as Girder, including
+        the cookie, since the tile route allows cookie authentication.
+
+        :returns: the token string or None for anonymous requests.
+        """
+        token = (cherrypy.request.params.get('token') or
+                 cherrypy.request.headers.get('Girder-Token'))
+        if not token and 'girderToken' in cherrypy.request.cookie:
+            token = cherrypy.request.cookie['girderToken'].value
+        return token or None
+
+    def _loadTileItem(self, itemId, params):
+        """
+        Load an item for the tile route, checking that the current user has
+        read access.  Successful lookups are cached per token so that repeated
+        tile requests don't need to load the token, user, and item from the
+        database.  Requests with a signed tile token are checked with the
+        token alone.
+
+        :param itemId: the id of the item.
+        :param params: the request parameters.  The tileToken parameter is
+            removed from them.
+        :returns: an item dictionary containing at least _id and, if present,
+            largeImage.
+        """
+        itemId = str(itemId)
+        tileToken = params.pop('tileToken', None)
+        if tileToken is not None:
+            return self._loadSignedTileItem(itemId, tileToken)
+        tokenKey = self._getRequestTokenKey()
+        if tokenKey is None and self.getCurrentUser() is not None:
+            # The user was authenticated without a token, so we have nothing
+            # to key the access on.
+            return self.model('item').load(
+                itemId, level=AccessType.READ, user=self.getCurrentUser(),
+                exc=True)
+        entry = _tileItemCache.get(itemId)
+        if entry is not None and tokenKey in entry['tokens']:
+            return entry['item']
+        item = self.model('item').load(
+            itemId, level=AccessType.READ, user=self.getCurrentUser(),
+            exc=True)
+        if entry is None:
+            entry = self._cacheTileItem(item)
+        entry['tokens'].add(tokenKey)
+        return entry['item']
+
+    def _cacheTileItem(self, item):
+        """
+        Add an item to the cache used by the tile routes.
+
+        :param item: the item.
+        :returns: the cache entry.
+        """
+        entry = {
+            'item': {key: item[key] for key in ('_id', 'largeImage')
+                     if key in item},
+            'tokens': set(),
+        }
+        _tileItemCache.put(str(item['_id']), entry)
+        return entry
+
+    def _loadSignedTileItem(self, itemId, tileToken):
+        """
+        Load an item for the tile route using a signed tile token rather than
+        the current user.  The token is checked in memory, so neither the
+        Girder token nor the user is looked up.
+
+        :param itemId: the id of the item.
+        :param tileToken: the signed token from a tile URL.
+        :returns: an item dictionary containing at least _id and, if present,
+            largeImage.
+        """
+        secret = _getConfigOption('tile_signing_secret')
+        try:
+            if not secret:
+                raise TileGeneralException(
+                    'Signed tile URLs are not configured.')
+            payload = verifyToken(secret, tileToken)
+        except TileGeneralException as e:
+            raise RestException(e.message, code=403)
+        if payload.get('itemId') != itemId:
+            raise RestException('The tile token is for a different item.',
+                                code=403)
+        # The response must not be shared by proxies
+        cherrypy.request.largeImageSignedTile = True
+        entry = _tileItemCache.get(itemId)
+        if entry is None:
+            entry = self._cacheTileItem(self.model('item').load(
+                itemId, force=True, exc=True))
+        return entry['item']
+
+    def _negotiateEncoding(self, imageArgs):
+        """
+        If enabled in the configuration, pick the encoding and quality of an
+        image from the request headers when the request doesn't specify them.
+        WebP is used for clients that list it in their Accept header, and a
+        lower quality for clients that send "Save-Data: on".
+
+        :param imageArgs: the parameters used to generate the image.
+        :returns: the parameters with any negotiated encoding and quality.
+        """
+        if not _getConfigOption('negotiate_encoding'):
+            return imageArgs
+        # Responses depend on these headers even if they weren't sent
+        cherrypy.response.headers['Vary'] = 'Accept, Save-Data'
+        headers = cherrypy.request.headers
+        imageArgs = dict(imageArgs)
+        if ('encoding' not in imageArgs and
+                'WEBP' in TileSource.outputMimeTypes and
+                _acceptsMimeType(headers.get('Accept', ''), 'image/webp')):
+            imageArgs['encoding'] = 'WEBP'
+        if ('jpegQuality' not in imageArgs and
+                headers.get('Save-Data', '').strip().lower() == 'on'):
+            imageArgs['jpegQuality'] = _getConfigOption('save_data_quality')
+        return imageArgs
+
+    def _imageETag(self, item, route, imageArgs):
+        """
+        Compute a strong ETag for an image response.  The tag is derived from
+        the large image file and everything in the request that affects the
+        image data, so it changes whenever either of them does.
+
+        :param item: the item with the large image.
+        :param route: a tuple identifying the kind of request and, for tiles,
+            the tile coordinates.
+        :param imageArgs: the parameters used to generate the image.
+        :returns: a quoted ETag string, or None if the item has no large image
+            from which to derive a tag.
+        """
+        largeImage = item.get('largeImage', {})
+        if largeImage.get('expected'):
+            return None
+        if largeImage.get('fileId'):
+            source = str(largeImage['fileId'])
+        elif largeImage.get('sourceName') == 'test':
+            source = 'test'
+        else:
+            return None
+        key = repr((source, tuple(route), sorted(
+            (str(k), str(v)) for k, v in six.iteritems(imageArgs))))
+        return '"%s"' % hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def _setCacheHeaders(self, etag):
+        """
+        Add ETag and Cache-Control headers to the current response.
+
+        :param etag: the ETag of the response.  If None, no headers are added.
+        """
+        if etag is None:
+            return
+        cherrypy.response.headers['ETag'] = etag
+        # Responses for authenticated users must not be shared by proxies.
+        # This is decided without looking up the token or user, since the
+        # tile route avoids those lookups.  Looking up the user is only free
+        # when there is no token.
+        private = (getattr(cherrypy.request, 'largeImageSignedTile', False) or
+                   self._getRequestTokenKey() is not None or
+                   self.getCurrentUser() is not None)
+        cherrypy.response.headers['Cache-Control'] = '%s, max-age=%d' % (
+            'private' if private else 'public', constants.TileCacheMaxAge)
+
+    def _imageResponse(self, data, mimeType, etag):
+        """
+        Set the headers of an image response and return its body.  The
+        length of the body is sent, so the encoded image is written to the
+        connection as it is rather than copied into chunked transfer framing.
+
+        :param data: the encoded image.
+        :param mimeType: the mime type of the image.
+        :param etag: the ETag of the response, or None.
+        :returns: a function that returns the image data.
+        """
+        cherrypy.response.headers['Content-Type'] = mimeType
+        cherrypy.response.headers['Content-Length'] = str(len(data))
+        self._setCacheHeaders(etag)
+        return lambda: data
+
+    def _notModified(self, etag):
+        """
+        Check if the client already has a current copy of a response.  If so,
+        the response status is set to 304 (Not Modified) along with the
+        caching headers, and the caller should return an empty body without
+        generating the image.
+
+        :param etag: the ETag of the response.
+        :returns: True if the client's copy is current.
+        """
+        ifNoneMatch = cherrypy.request.headers.get('If-None-Match')
+        if etag is None or not ifNoneMatch:
+            return False
+        # If-None-Match uses weak comparison, so ignore any weak indicator
+        tags = [tag.strip() for tag in ifNoneMatch.split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        if etag not in tags and '*' not in tags:
+            return False
+        self._setCacheHeaders(etag)
+        cherrypy.response.status = 304
+        return True
+
     def _getTilesInfo(self, item, imageArgs):
         """
         Get metadata for an item's large image.
@@ -128,14 +590,34 @@ class TilesItemResource(Item):
     @describeRoute(
         Description('Get large image metadata.')
         .param('itemId', 'The ID of the item.', paramType='path')
+        .param('tileSize', 'Describe tiles of this size instead of the '
+               'tiles of the large image.', required=False, dataType='int')
+        .param('tileOverlap', 'Describe tiles that overlap their neighbors by '
+               'this many pixels.', required=False, dataType='int')
+        .param('signedUrl', 'If true, also return a tile URL template as '
+               'tileUrl, signed so that it can be used without other '
+               'authentication until tileUrlExpires.', required=False,
+               dataType='boolean', default=False)
         .errorResponse('ID was invalid.')
         .errorResponse('Read access was denied for the item.', 403)
     )
     @access.public
     @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
     def getTilesInfo(self, item, params):
-        # TODO: parse params?
-        return self._getTilesInfo(item, params)
+        signedUrl = params.pop('signedUrl', None) == 'true'
+        params = self._parseTileGridParams(params)
+        info = self._getTilesInfo(item, params)
+        if signedUrl:
+            try:
+                token, expires = self.model(
+                    'image_item', 'large_image').getTileUrlToken(item)
+            except TileGeneralException as e:
+                raise RestException(e.message)
+            info = dict(info)
+            info['tileUrl'] = '%s/zxy/{z}/{x}/{y}?tileToken=%s' % (
+                cherrypy.url(), token)
+            info['tileUrlExpires'] = expires
+        return info
 
     @describeRoute(
         Description('Get test large image metadata.')
@@ -164,14 +646,17 @@ class TilesItemResource(Item):
         if x < 0 or y < 0 or z < 0:
             raise RestException('x, y, and z must be positive integers',
                                 code=400)
+        imageArgs = self._negotiateEncoding(imageArgs)
+        etag = self._imageETag(item, ('tile', z, x, y), imageArgs)
+        if self._notModified(etag):
+            return lambda: ''
         try:
             tileData, tileMime = self.model(
                 'image_item', 'large_image').getTile(
                     item, x, y, z, **imageArgs)
         except TileGeneralException as e:
             raise RestException(e.message, code=404)
-        cherrypy.response.headers['Content-Type'] = tileMime
-        return lambda: tileData
+        return self._imageResponse(tileData, tileMime, etag)
 
     @describeRoute(
         Description('Get a large image tile.')
@@ -182,17 +667,123 @@ class TilesItemResource(Item):
                paramType='path')
         .param('y', 'The Y coordinate of the tile (0 is the top).',
                paramType='path')
+        .param('channels', 'A comma-separated list of the channels to '
+               'display.  Applies to images with more than 8 bits per sample '
+               'or multiple channels.', required=False)
+        .param('windowMin', 'A comma-separated list of the value of each '
+               'displayed channel that is shown as black.', required=False)
+        .param('windowMax', 'A comma-separated list of the value of each '
+               'displayed channel that is shown at full intensity.',
+               required=False)
+        .param('colormap', 'A comma-separated list of the color of each '
+               'displayed channel, either a color name or #rrggbb.  Channels '
+               'are added together.', required=False)
+        .param('encoding', 'Tile encoding.  Stored JPEG tiles are sent '
+               'without re-encoding them unless another encoding or a quality '
+               'is requested.', required=False,
+               enum=['JPEG', 'PNG', 'WEBP'], default='JPEG')
+        .param('jpegQuality', 'Quality used for encoding JPEG and WebP '
+               'tiles.', required=False, dataType='int')
+        .param('tileSize', 'Serve tiles of this size, assembled from the '
+               'tiles of the large image, instead of its own tile size.',
+               required=False, dataType='int')
+        .param('tileOverlap', 'Serve tiles that share this many pixels with '
+               'the tiles on each side of them.  Tiles are tileSize plus '
+               'twice the overlap across.', required=False, dataType='int')
+        .param('tileToken', 'A signed token from the tileUrl returned when '
+               'getting large image metadata.  It grants read access to the '
+               'item without other authentication.', required=False)
         .errorResponse('ID was invalid.')
         .errorResponse('Read access was denied for the item.', 403)
     )
     @access.cookie
     @access.public
-    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
-    def getTile(self, item, z, x, y, params):
-        # TODO: cache the user / item loading in the 'loadmodel' decorator
-        # TODO: parse params?
+    def getTile(self, itemId, z, x, y, params):
+        # This is the most frequently called route, so avoid the loadmodel
+        # decorator and use cached item and access information when possible.
+        item = self._loadTileItem(itemId, params)
+        params = self._parseTileGridParams(params)
         return self._getTile(item, z, x, y, params)
 
+    @describeRoute(
+        Description('Get multiple tiles from a large image in one response.')
+        .notes('The tiles are returned as a multipart/mixed response in the '
+               'order requested.  Each part has an X-Tile-Position header of '
+               'the form z/x/y and an X-Tile-Status header with the HTTP '
+               'status that a request for the individual tile would have '
+               'returned.  Parts for tiles that could not be fetched contain '
+               'a JSON error message.  Tiles that fail to decode have a status '
+               'of 500 and don\'t affect the other tiles.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('tiles', 'A JSON list of [z, x, y] tile positions.  At most '
+               '%d tiles may be requested.  For POST requests, this may '
+               'instead be sent as a JSON body, either the list itself or an '
+               'object with a tiles key.' % MaxTileBatchSize, required=False)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    @access.cookie
+    @access.public
+    def getTileBatch(self, itemId, params):
+        item = self._loadTileItem(itemId, params)
+        params = self._negotiateEncoding(
+            self._parseTileGridParams(params))
+        try:
+            if ('tiles' not in params and
+                    cherrypy.request.method == 'POST' and
+                    cherrypy.request.headers.get(
+                        'Content-Type', '').startswith('application/json')):
+                tiles = self.getBodyJson()
+                if isinstance(tiles, dict):
+                    tiles = tiles.get('tiles', [])
+            else:
+                tiles = json.loads(params.pop('tiles', '[]'))
+            tiles = [(int(z), int(x), int(y)) for z, x, y in tiles]
+        except (ValueError, TypeError):
+            raise RestException(
+                'The "tiles" parameter must be a JSON list of [z, x, y] '
+                'positions.', code=400)
+        if len(tiles) > MaxTileBatchSize:
+            raise RestException('At most %d tiles may be requested.' %
+                                MaxTileBatchSize, code=400)
+        # Negative positions are reported without asking the tile source
+        valid = [(x, y, z) for z, x, y in tiles if min(x, y, z) >= 0]
+        try:
+            results = self.model('image_item', 'large_image').getTiles(
+                item, valid, **params)
+        except TileGeneralException as e:
+            raise RestException(e.message, code=404)
+
+        boundary = uuid.uuid4().hex
+        cherrypy.response.headers['Content-Type'] = \
+            'multipart/mixed; boundary=%s' % boundary
+
+        def stream():
+            for z, x, y in tiles:
+                status, message = 200, None
+                if min(x, y, z) < 0:
+                    status = 400
+                    message = 'x, y, and z must be positive integers'
+                else:
+                    tileData, tileMime, exc = next(results)
+                    if isinstance(exc, TileGeneralException):
+                        status, message = 404, exc.message
+                    elif exc is not None:
+                        status, message = 500, 'Failed to get the tile.'
+                if message is not None:
+                    tileMime = 'application/json'
+                    tileData = json.dumps(
+                        {'message': message, 'type': 'rest'}).encode('utf8')
+                yield (
+                    '--%s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+                    'X-Tile-Position: %d/%d/%d\r\nX-Tile-Status: %d\r\n\r\n' % (
+                        boundary, tileMime, len(tileData), z, x, y, status)
+                ).encode('utf8')
+                yield tileData
+                yield b'\r\n'
+            yield ('--%s--\r\n' % boundary).encode('utf8')
+        return stream
+
     @describeRoute(
         Description('Get a test large image tile.')
         .param('z', 'The layer number of the tile (0 is the most zoomed-out '
@@ -237,7 +828,7 @@ class TilesItemResource(Item):
         .param('height', 'The maximum height of the thumbnail in pixels.',
                required=False, dataType='int')
         .param('encoding', 'Thumbnail output encoding', required=False,
-               enum=['JPEG', 'PNG'], default='JPEG')
+               enum=['JPEG', 'PNG', 'WEBP'], default='JPEG')
         .errorResponse('ID was invalid.')
         .errorResponse('Read access was denied for the item.', 403)
     )
@@ -252,6 +843,10 @@ class TilesItemResource(Item):
             ('jpegSubsampling', int),
             ('encoding', str),
         ])
+        params = self._negotiateEncoding(params)
+        etag = self._imageETag(item, ('thumbnail', ), params)
+        if self._notModified(etag):
+            return lambda: ''
         try:
             thumbData, thumbMime = self.model(
                 'image_item', 'large_image').getThumbnail(item, **params)
@@ -259,8 +854,7 @@ class TilesItemResource(Item):
             raise RestException(e.message)
         except ValueError as e:
             raise RestException('Value Error: %s' % e.message)
-        cherrypy.response.headers['Content-Type'] = thumbMime
-        return lambda: thumbData
+        return self._imageResponse(thumbData, thumbMime, etag)
 
     @describeRoute(
         Description('Get any region of a large image item, optionally scaling '
@@ -299,13 +893,22 @@ class TilesItemResource(Item):
         .param('height', 'The maximum height of the output image in pixels.',
                required=False, dataType='int')
         .param('encoding', 'Output image encoding', required=False,
-               enum=['JPEG', 'PNG'], default='JPEG')
+               enum=['JPEG', 'PNG', 'WEBP'], default='JPEG')
         .param('jpegQuality', 'Quality used for generating JPEG images',
                required=False, dataType='int', default=95)
         .param('jpegSubsampling', 'Chroma subsampling used for generating '
                'JPEG images.  0, 1, and 2 are full, half, and quarter '
                'resolution chroma respectively.', required=False,
                enum=['0', '1', '2'], dataType='int', default='0')
+        .param('channels', 'A comma-separated list of the channels to '
+               'display.', required=False)
+        .param('windowMin', 'A comma-separated list of the value of each '
+               'displayed channel that is shown as black.', required=False)
+        .param('windowMax', 'A comma-separated list of the value of each '
+               'displayed channel that is shown at full intensity.',
+               required=False)
+        .param('colormap', 'A comma-separated list of the color of each '
+               'displayed channel.', required=False)
         .errorResponse('ID was invalid.')
         .errorResponse('Read access was denied for the item.', 403)
         .errorResponse('Insufficient memory.')
@@ -328,6 +931,10 @@ class TilesItemResource(Item):
             ('jpegSubsampling', int),
             ('encoding', str),
         ])
+        params = self._negotiateEncoding(params)
+        etag = self._imageETag(item, ('region', ), params)
+        if self._notModified(etag):
+            return lambda: ''
         try:
             regionData, regionMime = self.model(
                 'image_item', 'large_image').getRegion(item, **params)
@@ -335,8 +942,471 @@ class TilesItemResource(Item):
             raise RestException(e.message)
         except ValueError as e:
             raise RestException('Value Error: %s' % e.message)
-        cherrypy.response.headers['Content-Type'] = regionMime
-        return lambda: regionData
+        return self._imageResponse(regionData, regionMime, etag)
+
+    def _convertImage(self, data, encoding, imageArgs, crop=None, size=None,
+                      mirror=False, rotation=0, gray=False):
+        """
+        Decode an image, change it, and encode it again.
+
+        :param data: the encoded image.
+        :param encoding: the output encoding.
+        :param imageArgs: parameters that may include jpegQuality and
+            jpegSubsampling.
+        :param crop: if not None, a (left, top, right, bottom) tuple of the
+            part of the image to keep.
+        :param size: if not None, a (width, height) tuple to resize the image
+            to.
+        :param mirror: if True, flip the image horizontally.
+        :param rotation: the clockwise rotation in degrees.  This must be a
+            multiple of 90.
+        :param gray: if True, convert the image to grayscale.
+        :returns: the image data and mime type.
+        """
+        image = PIL.Image.open(six.BytesIO(data))
+        if crop is not None:
+            image = image.crop(tuple(crop))
+        if size is not None:
+            image = image.resize(size, PIL.Image.BICUBIC)
+        if mirror:
+            image = image.transpose(PIL.Image.FLIP_LEFT_RIGHT)
+        if rotation:
+            # PIL rotates counterclockwise
+            image = image.transpose({
+                90: PIL.Image.ROTATE_270,
+                180: PIL.Image.ROTATE_180,
+                270: PIL.Image.ROTATE_90}[rotation])
+        if gray:
+            image = image.convert('L')
+        elif image.mode not in ('L', 'RGB') and (
+                encoding == 'JPEG' or image.mode not in ('LA', 'RGBA')):
+            image = image.convert('RGB')
+        output = six.BytesIO()
+        image.save(output, encoding,
+                   quality=imageArgs.get('jpegQuality', 95),
+                   subsampling=imageArgs.get('jpegSubsampling', 0))
+        return output.getvalue(), TileSource.outputMimeTypes[encoding]
+
+    def _getScaledRegion(self, item, left, top, width, height, outWidth,
+                         outHeight, encoding, imageArgs):
+        """
+        Get part of a large image at a specific output size.  When the part
+        is exactly one tile of a level of the image, that tile is used rather
+        than compositing and scaling a region, so requests that follow the
+        image's own tile grid are as fast as the tile route.
+
+        :param item: the item with the large image.
+        :param left: the left edge of the part in full resolution pixels.
+        :param top: the top edge of the part in full resolution pixels.
+        :param width: the width of the part in full resolution pixels.
+        :param height: the height of the part in full resolution pixels.
+        :param outWidth: the width of the output image.
+        :param outHeight: the height of the output image.
+        :param encoding: 'JPEG' or 'PNG'.
+        :param imageArgs: additional arguments to use when fetching image data.
+        :returns: the image data and mime type.
+        """
+        imageModel = self.model('image_item', 'large_image')
+        metadata = imageModel.getMetadata(item, **imageArgs)
+        tileWidth = metadata['tileWidth']
+        tileHeight = metadata['tileHeight']
+        for z in range(metadata['levels']):
+            scale = 2 ** (metadata['levels'] - 1 - z)
+            if (left % (tileWidth * scale) or top % (tileHeight * scale) or
+                    width != min(tileWidth * scale,
+                                 metadata['sizeX'] - left) or
+                    height != min(tileHeight * scale,
+                                  metadata['sizeY'] - top) or
+                    outWidth != (width + scale - 1) // scale or
+                    outHeight != (height + scale - 1) // scale):
+                continue
+            tileData, tileMime = imageModel.getTile(
+                item, left // (tileWidth * scale), top // (tileHeight * scale),
+                z, encoding=encoding, **imageArgs)
+            if ((outWidth, outHeight) == (tileWidth, tileHeight) and
+                    tileMime == TileSource.outputMimeTypes[encoding]):
+                return tileData, tileMime
+            # Tiles at the right and bottom edges are padded to the full tile
+            # size
+            return self._convertImage(tileData, encoding, imageArgs,
+                                      crop=(0, 0, outWidth, outHeight))
+        regionData, regionMime = imageModel.getRegion(
+            item, left=left, top=top, right=left + width, bottom=top + height,
+            width=outWidth, height=outHeight, encoding=encoding, **imageArgs)
+        # Regions keep their aspect ratio and are never upsampled, so they
+        # may not be the requested size.  Opening the image only reads its
+        # header.
+        if PIL.Image.open(six.BytesIO(regionData)).size != (
+                outWidth, outHeight):
+            return self._convertImage(regionData, encoding, imageArgs,
+                                      size=(outWidth, outHeight))
+        return regionData, regionMime
+
+    @staticmethod
+    def _getDziGrid(metadata, params):
+        """
+        Get the tile size and overlap of a Deep Zoom image.
+
+        :param metadata: the metadata of the large image.
+        :param params: the request parameters, which may include tileSize and
+            overlap.
+        :returns: the tile size and overlap.
+        """
+        tileSize = metadata['tileWidth']
+        if tileSize != metadata['tileHeight']:
+            # Deep Zoom tiles are square
+            tileSize = 256
+        try:
+            tileSize = int(params.get('tileSize', tileSize))
+            overlap = int(params.get('overlap', 0))
+        except ValueError:
+            raise RestException('"tileSize" and "overlap" must be integers.')
+        if not 1 <= tileSize <= constants.MaxTileSize or not (
+                0 <= overlap < tileSize):
+            raise RestException(
+                '"tileSize" must be between 1 and %d and "overlap" must be '
+                'less than it.' % constants.MaxTileSize)
+        return tileSize, overlap
+
+    @describeRoute(
+        Description('Get a Deep Zoom image descriptor for a large image.')
+        .notes('Deep Zoom viewers request tiles relative to this descriptor '
+               'from the dzi_files route, passing along any parameters.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('encoding', 'Tile encoding', required=False,
+               enum=['JPEG', 'PNG', 'WEBP'], default='JPEG')
+        .param('tileSize', 'The tile size.  By default, this is the tile size '
+               'of the large image.', required=False, dataType='int')
+        .param('overlap', 'The number of pixels each tile shares with its '
+               'neighbors.', required=False, dataType='int', default=0)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    @access.cookie
+    @access.public
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
+    def getDziInfo(self, item, params):
+        encoding = params.get('encoding', 'JPEG')
+        if encoding not in TileSource.outputMimeTypes:
+            raise RestException('Invalid encoding "%s".' % encoding)
+        metadata = self._getTilesInfo(item, {})
+        tileSize, overlap = self._getDziGrid(metadata, params)
+        dzi = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Image TileSize="%d" Overlap="%d" Format="%s" '
+            'xmlns="http://schemas.microsoft.com/deepzoom/2008">'
+            '<Size Width="%d" Height="%d"/></Image>' % (
+                tileSize, overlap, encoding.lower(), metadata['sizeX'],
+                metadata['sizeY']))
+        cherrypy.response.headers['Content-Type'] = 'application/xml'
+        return lambda: dzi.encode('utf8')
+
+    @describeRoute(
+        Description('Get a Deep Zoom tile of a large image.')
+        .notes('Deep Zoom levels that are levels of the large image are '
+               'served from its tiles, and are assembled from them if the '
+               'tile size or overlap differ.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('level', 'The Deep Zoom level.  The highest level is the full '
+               'resolution image and level 0 is a single pixel.',
+               paramType='path')
+        .param('tile', 'The column and row of the tile and the format, such '
+               'as 3_4.jpeg.', paramType='path')
+        .param('tileSize', 'The tile size.  By default, this is the tile size '
+               'of the large image.', required=False, dataType='int')
+        .param('overlap', 'The number of pixels each tile shares with its '
+               'neighbors.', required=False, dataType='int', default=0)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    @access.cookie
+    @access.public
+    def getDziTile(self, itemId, level, tile, params):
+        item = self._loadTileItem(itemId, params)
+        imageArgs = self._parseParams(params, False, ImageStyleParams)
+        try:
+            position, extension = tile.rsplit('.', 1)
+            x, y = [int(value) for value in position.split('_')]
+            level = int(level)
+            encoding = DziFormats[extension.lower()]
+        except (ValueError, KeyError):
+            raise RestException('Invalid Deep Zoom tile "%s".' % tile)
+        metadata = self._getTilesInfo(item, imageArgs)
+        tileSize, overlap = self._getDziGrid(metadata, params)
+        maxLevel = (max(metadata['sizeX'], metadata['sizeY']) - 1).bit_length()
+        if not 0 <= level <= maxLevel:
+            raise RestException('Level does not exist.', code=404)
+        scale = 2 ** (maxLevel - level)
+        levelWidth = (metadata['sizeX'] + scale - 1) // scale
+        levelHeight = (metadata['sizeY'] + scale - 1) // scale
+        if (x < 0 or y < 0 or x * tileSize >= levelWidth or
+                y * tileSize >= levelHeight):
+            raise RestException('Tile does not exist.', code=404)
+        # The part of the Deep Zoom level in the tile
+        left = max(0, x * tileSize - overlap)
+        top = max(0, y * tileSize - overlap)
+        right = min(levelWidth, (x + 1) * tileSize + overlap)
+        bottom = min(levelHeight, (y + 1) * tileSize + overlap)
+        etag = self._imageETag(item, (
+            'dzi', level, x, y, encoding, tileSize, overlap), imageArgs)
+        if self._notModified(etag):
+            return lambda: ''
+        z = metadata['levels'] - 1 - (maxLevel - level)
+        try:
+            if z >= 0:
+                tileArgs = dict(imageArgs)
+                if (overlap or tileSize != metadata['tileWidth'] or
+                        tileSize != metadata['tileHeight']):
+                    tileArgs.update({'tileSize': tileSize,
+                                     'tileOverlap': overlap})
+                tileData, tileMime = self.model(
+                    'image_item', 'large_image').getTile(
+                        item, x, y, z, encoding=encoding, **tileArgs)
+                # Pixel (overlap, overlap) of the tile is its corner, and
+                # edge tiles are padded to the full size.
+                offsetX = x * tileSize - overlap
+                offsetY = y * tileSize - overlap
+                crop = (left - offsetX, top - offsetY,
+                        right - offsetX, bottom - offsetY)
+                if (crop != (0, 0) + (tileSize + 2 * overlap, ) * 2 or
+                        tileMime != TileSource.outputMimeTypes[encoding]):
+                    tileData, tileMime = self._convertImage(
+                        tileData, encoding, imageArgs, crop=crop)
+            else:
+                # Levels below the lowest level of the large image are scaled
+                tileData, tileMime = self._getScaledRegion(
+                    item, left * scale, top * scale,
+                    min(right * scale, metadata['sizeX']) - left * scale,
+                    min(bottom * scale, metadata['sizeY']) - top * scale,
+                    right - left, bottom - top, encoding, imageArgs)
+        except TileGeneralException as e:
+            raise RestException(e.message, code=404)
+        return self._imageResponse(tileData, tileMime, etag)
+
+    @describeRoute(
+        Description('Get the IIIF Image API information for a large image.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    @access.cookie
+    @access.public
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
+    def getIiifInfo(self, item, params):
+        metadata = self._getTilesInfo(item, {})
+        return {
+            '@context': 'http://iiif.io/api/image/2/context.json',
+            '@id': cherrypy.url().rsplit('/', 1)[0],
+            'protocol': 'http://iiif.io/api/image',
+            'width': metadata['sizeX'],
+            'height': metadata['sizeY'],
+            'maxWidth': IiifMaxWidth,
+            'maxHeight': IiifMaxHeight,
+            'maxArea': IiifMaxArea,
+            # Requests for these tiles are served from the image's own tiles
+            'tiles': [{
+                'width': metadata['tileWidth'],
+                'height': metadata['tileHeight'],
+                'scaleFactors': [2 ** level
+                                 for level in range(metadata['levels'])],
+            }],
+            'profile': [
+                'http://iiif.io/api/image/2/level1.json', {
+                    'formats': sorted(IiifFormats),
+                    'qualities': ['default', 'color', 'gray'],
+                    'supports': ['mirroring', 'regionByPct', 'regionByPx',
+                                 'regionSquare', 'rotationBy90s',
+                                 'sizeAboveFull', 'sizeByConfinedWh',
+                                 'sizeByDistortedWh', 'sizeByH', 'sizeByPct',
+                                 'sizeByW', 'sizeByWh'],
+                }],
+        }
+
+    @describeRoute(
+        Description('Get an image from a large image using the IIIF Image '
+                    'API.')
+        .notes('Requests for the tiles listed in the IIIF information are '
+               'served directly from the tiles of the large image.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('region', 'full, square, x,y,w,h, or pct:x,y,w,h.',
+               paramType='path')
+        .param('size', 'full, max, w,, ,h, pct:n, w,h, or !w,h.  Sizes '
+               'above the maxWidth, maxHeight, and maxArea in the IIIF '
+               'information are refused.', paramType='path')
+        .param('rotation', 'A clockwise rotation of 0, 90, 180, or 270 '
+               'degrees, optionally preceded by ! to mirror the image.',
+               paramType='path')
+        .param('quality', 'The quality and format, such as default.jpg.  '
+               'The quality is default, color, or gray and the format is jpg '
+               'or png.', paramType='path')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    @access.cookie
+    @access.public
+    def getIiifImage(self, itemId, region, size, rotation, quality, params):
+        item = self._loadTileItem(itemId, params)
+        imageArgs = self._parseParams(params, False, ImageStyleParams)
+        mirror = rotation.startswith('!')
+        try:
+            rotation = int(rotation.lstrip('!'))
+            quality, extension = quality.rsplit('.', 1)
+            encoding = IiifFormats[extension]
+        except (ValueError, KeyError):
+            raise RestException('Invalid rotation, quality, or format.')
+        if rotation not in (0, 90, 180, 270):
+            raise RestException('Only rotations of 0, 90, 180, and 270 '
+                                'degrees are supported.')
+        if quality not in ('default', 'color', 'gray'):
+            raise RestException('Invalid quality "%s".' % quality)
+        metadata = self._getTilesInfo(item, imageArgs)
+        left, top, width, height = _parseIiifRegion(
+            region, metadata['sizeX'], metadata['sizeY'])
+        outWidth, outHeight = _parseIiifSize(size, width, height)
+        etag = self._imageETag(item, (
+            'iiif', left, top, width, height, outWidth, outHeight, mirror,
+            rotation, quality, encoding), imageArgs)
+        if self._notModified(etag):
+            return lambda: ''
+        try:
+            imageData, imageMime = self._getScaledRegion(
+                item, left, top, width, height, outWidth, outHeight, encoding,
+                imageArgs)
+        except TileGeneralException as e:
+            raise RestException(e.message, code=404)
+        if mirror or rotation or quality == 'gray':
+            imageData, imageMime = self._convertImage(
+                imageData, encoding, imageArgs, mirror=mirror,
+                rotation=rotation, gray=quality == 'gray')
+        return self._imageResponse(imageData, imageMime, etag)
+
+    @describeRoute(
+        Description('Get the histogram and statistics of each channel of a '
+                    'large image.')
+        .notes('These are computed from one level of the image.  By '
+               'default, a low resolution level and 256 bins are used, and '
+               'the result is stored with the item.  Other levels must not '
+               'be larger than a configured number of pixels.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('level', 'The level to use (0 is the most zoomed-out level).',
+               required=False, dataType='int')
+        .param('bins', 'The number of histogram bins.', required=False,
+               dataType='int', default=256)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    @access.public
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
+    def getTilesHistogram(self, item, params):
+        params = self._parseParams(params, False, [
+            ('level', int),
+            ('bins', int),
+        ])
+        bins = params.get('bins', 256)
+        if not 1 <= bins <= 65536:
+            raise RestException('"bins" must be between 1 and 65536.')
+        try:
+            return self.model('image_item', 'large_image').getStatistics(
+                item, params.get('level'), bins)
+        except TileGeneralException as e:
+            raise RestException(e.message)
+
+    @describeRoute(
+        Description('Get which tiles of a level of a large image contain '
+                    'tissue.')
+        .notes('The tissue mask is computed from a low resolution image of '
+               'the slide the first time it is needed and stored with the '
+               'item.  Tiles that overlap the mask at all are occupied.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('level', 'The level of the tiles (0 is the most zoomed-out '
+               'level).', dataType='int')
+        .param('format', 'Either "bitmap" to return a base64-encoded bit for '
+               'each tile, ordered by row and packed most significant bit '
+               'first, or "list" to return the [x, y] positions of occupied '
+               'tiles.', required=False, enum=['bitmap', 'list'],
+               default='bitmap')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    @access.public
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
+    def getTileOccupancy(self, item, params):
+        # This requires numpy, so it is only imported when used
+        from ..tilesource import tissue
+
+        params = self._parseParams(params, False, [
+            ('level', int),
+            ('format', str),
+        ])
+        if 'level' not in params:
+            raise RestException('Missing "level" parameter.')
+        if params.get('format', 'bitmap') not in ('bitmap', 'list'):
+            raise RestException('"format" must be "bitmap" or "list".')
+        try:
+            occupancy = self.model(
+                'image_item', 'large_image').getTileOccupancy(
+                    item, params['level'])
+        except TileGeneralException as e:
+            raise RestException(e.message)
+        result = {
+            'level': params['level'],
+            'tilesAcross': int(occupancy.shape[1]),
+            'tilesDown': int(occupancy.shape[0]),
+            'count': int(occupancy.sum()),
+        }
+        if params.get('format') == 'list':
+            result['tiles'] = [[int(x), int(y)] for y, x in zip(
+                *occupancy.nonzero())]
+        else:
+            result['bitmap'] = tissue.encodeMask(occupancy)['mask']
+        return result
+
+    @describeRoute(
+        Description('Compute the tissue mask of a large image.')
+        .notes('This replaces any stored tissue mask.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('threshold', 'The brightness (0-255) below which pixels are '
+               'tissue.  If not specified, a threshold is picked from the '
+               'image.', required=False, dataType='int')
+    )
+    @access.user
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.WRITE)
+    def computeTissueMask(self, item, params):
+        params = self._parseParams(params, False, [
+            ('threshold', int),
+        ])
+        try:
+            mask = self.model('image_item', 'large_image').getTissueMask(
+                item, params.get('threshold'), recompute=True)
+        except TileGeneralException as e:
+            raise RestException(e.message)
+        return {
+            'width': int(mask.shape[1]),
+            'height': int(mask.shape[0]),
+            'threshold': item['largeImage']['tissueMask']['threshold'],
+            'fraction': float(mask.mean()) if mask.size else 0,
+        }
+
+    @describeRoute(
+        Description('Get a token for reading the tiles of a large image from '
+                    'the standalone tile server.')
+        .notes('The token names the large image file by its assetstore and '
+               'its path within the assetstore, and expires after a '
+               'configured time.  Only files in filesystem assetstores can be '
+               'read.  The returned URL template has {z}, {x}, and {y} '
+               'placeholders for the tile position.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    @access.public
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
+    def getTileServerToken(self, item, params):
+        try:
+            return self.model(
+                'image_item', 'large_image').getTileServerToken(item)
+        except TileGeneralException as e:
+            raise RestException(e.message)
 
     @describeRoute(
         Description('Get public settings for large image display.')
@@ -0,0 +1,956 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# This module is sent to Girder Worker along with create_tiff.py, so it must
+# only depend on the standard library, numpy, and PIL.  libvips is used for
+# conversions when it is available, either through pyvips or as a command.
+
+import collections
+import multiprocessing
+import os
+import pickle
+import re
+import shutil
+import struct
+import subprocess
+import time
+import traceback
+
+import numpy
+import PIL.Image
+from io import BytesIO
+
+try:
+    from shutil import which
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable as which
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# TIFF field types
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_UNDEFINED = 7
+TIFF_LONG8 = 16
+
+TIFFTypeFormats = {
+    TIFF_SHORT: 'H',
+    TIFF_LONG: 'L',
+    TIFF_UNDEFINED: 'B',
+    TIFF_LONG8: 'Q',
+}
+
+# JPEG markers
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+JPEG_SOS = b'\xff\xda'
+JPEG_TABLE_MARKERS = (b'\xff\xdb', b'\xff\xc4')  # DQT, DHT
+JPEG_FRAME_MARKERS = (b'\xff\xc0', b'\xff\xc1', b'\xff\xc2')  # SOF0-2
+
+
+def splitJpeg(data):
+    """
+    Split an encoded JPEG into its quantization and Huffman tables and an
+    abbreviated image without tables.  All other markers (such as JFIF
+    headers) are discarded.
+
+    :param data: a complete JPEG image.
+    :returns: tables, frame: the tables wrapped in Start and End Of Image
+        markers, as used by the TIFF JPEGTables tag, and the image starting
+        with a Start Of Image marker followed by the Start Of Frame marker.
+    """
+    tables = []
+    frame = [JPEG_SOI]
+    pos = 2
+    while True:
+        marker = data[pos:pos + 2]
+        if marker == JPEG_SOS:
+            frame.append(data[pos:])
+            break
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        segment = data[pos:pos + 2 + length]
+        if marker in JPEG_TABLE_MARKERS:
+            tables.append(segment)
+        elif marker in JPEG_FRAME_MARKERS:
+            frame.append(segment)
+        pos += 2 + length
+    return JPEG_SOI + b''.join(tables) + JPEG_EOI, b''.join(frame)
+
+
+def reduceRows(rows):
+    """
+    Halve the size of an image strip by averaging each 2x2 block of pixels.
+    Odd rows and columns are padded by repeating the last row or column.
+
+    :param rows: a numpy array of shape (height, width, 3).
+    :returns: a numpy array of shape ((height + 1) / 2, (width + 1) / 2, 3).
+    """
+    if rows.shape[0] % 2:
+        rows = numpy.concatenate((rows, rows[-1:]), axis=0)
+    if rows.shape[1] % 2:
+        rows = numpy.concatenate((rows, rows[:, -1:]), axis=1)
+    rows = rows.astype(numpy.uint16)
+    reduced = (rows[0::2, 0::2] + rows[1::2, 0::2] + rows[0::2, 1::2] +
+               rows[1::2, 1::2] + 2) // 4
+    return reduced.astype(numpy.uint8)
+
+
+def encodeJpegTile(tile, tileSize, quality):
+    """
+    Encode a tile as an abbreviated JPEG.
+
+    :param tile: a numpy array of at most (tileSize, tileSize, 3).  Smaller
+        tiles are padded.
+    :param tileSize: the width and height of the tile.
+    :param quality: the JPEG quality.
+    :returns: tables, frame: see splitJpeg.
+    """
+    if tile.shape[:2] != (tileSize, tileSize):
+        padded = numpy.zeros((tileSize, tileSize, 3), numpy.uint8)
+        padded[:tile.shape[0], :tile.shape[1]] = tile
+        tile = padded
+    output = BytesIO()
+    # The tables are shared by all tiles, so use the standard Huffman tables
+    # rather than optimizing them per tile.
+    PIL.Image.fromarray(tile, 'RGB').save(
+        output, 'JPEG', quality=quality, subsampling=2, optimize=False)
+    return splitJpeg(output.getvalue())
+
+
+def encodeBand(rows, tileSize, quality, bandLevels):
+    """
+    Encode the tiles of a band of the full resolution image and the levels
+    below it.  The band must be tileSize * 2 ** (bandLevels - 1) rows tall
+    unless it is the last band of the image, so that every level it covers
+    starts on a tile boundary.
+
+    :param rows: a numpy array of shape (rows, width, 3).
+    :param tileSize: the width and height of the tiles.
+    :param quality: the JPEG quality.
+    :param bandLevels: the number of levels to encode.
+    :returns: tables, levels, reduced: the JPEG tables, a list with a tuple of
+        (row count, list of encoded tiles) for each level, and the rows of the
+        next level, which still need to be added to the image.
+    """
+    tables = None
+    levels = []
+    for levelNum in range(bandLevels):
+        tiles = []
+        for y in range(0, rows.shape[0], tileSize):
+            for x in range(0, rows.shape[1], tileSize):
+                tables, frame = encodeJpegTile(
+                    rows[y:y + tileSize, x:x + tileSize], tileSize, quality)
+                tiles.append(frame)
+        levels.append((rows.shape[0], tiles))
+        rows = reduceRows(rows)
+    return tables, levels, rows
+
+
+class PyramidTiffWriter(object):
+    """
+    Write a JPEG-compressed, tiled, pyramidal BigTIFF from strips of image
+    rows.  Each level is written as its own directory, starting with the full
+    resolution level, and all levels share one set of JPEG tables.  Only a
+    tile row per level is kept in memory.
+    """
+
+    def __init__(self, path, width, height, tileSize=256, quality=90,
+                 progress=None, checkpointInterval=None):
+        """
+        Start writing a pyramidal TIFF.
+
+        :param path: the output path.
+        :param width: the width of the full resolution image.
+        :param height: the height of the full resolution image.
+        :param tileSize: the width and height of the tiles.
+        :param quality: the JPEG quality of the tiles.
+        :param progress: if not None, a function that is called with the
+            percentage of the image that has been written.
+        :param checkpointInterval: if not None, the state of the writer is
+            saved next to the output at most this often, in seconds.  If a
+            checkpoint for the same image and options exists, writing resumes
+            from it; rowsAdded is the first row that still needs to be added.
+        """
+        self.path = path
+        self.width = width
+        self.height = height
+        self.tileSize = tileSize
+        self.quality = quality
+        self.progress = progress
+        self.checkpointInterval = checkpointInterval
+        self._lastCheckpoint = time.time()
+        self._jpegTables = None
+        self._levels = []
+        while True:
+            self._levels.append({
+                'width': width,
+                'height': height,
+                # Rows waiting until there is a full row of tiles
+                'pending': numpy.zeros((0, width, 3), numpy.uint8),
+                # Rows waiting to be reduced for the next level
+                'unreduced': numpy.zeros((0, width, 3), numpy.uint8),
+                'rowsAdded': 0,
+                'offsets': [],
+                'byteCounts': [],
+            })
+            if width <= tileSize and height <= tileSize:
+                break
+            width = (width + 1) // 2
+            height = (height + 1) // 2
+        if checkpointInterval is not None and self._resume():
+            return
+        self._file = open(path, 'wb')
+        # The header is rewritten with the first directory offset on close
+        self._file.write(b'\x00' * 16)
+
+    @property
+    def rowsAdded(self):
+        return self._levels[0]['rowsAdded']
+
+    def _checkpointKey(self):
+        return (self.width, self.height, self.tileSize, self.quality)
+
+    def _resume(self):
+        """
+        Restore the state of the writer from its checkpoint.
+
+        :returns: True if the writer was restored.
+        """
+        checkpointPath = self.path + '.checkpoint'
+        try:
+            with open(checkpointPath, 'rb') as f:
+                checkpoint = pickle.load(f)
+            if (checkpoint['key'] != self._checkpointKey() or
+                    os.path.getsize(self.path) < checkpoint['position']):
+                return False
+        except Exception:
+            return False
+        self._levels = checkpoint['levels']
+        self._jpegTables = checkpoint['jpegTables']
+        self._file = open(self.path, 'r+b')
+        # Discard anything written after the checkpoint
+        self._file.truncate(checkpoint['position'])
+        self._file.seek(checkpoint['position'])
+        return True
+
+    def checkpoint(self):
+        """
+        Save the state of the writer so that it can be resumed.  The state is
+        replaced atomically, so an interrupted checkpoint leaves the previous
+        one intact.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        checkpointPath = self.path + '.checkpoint'
+        with open(checkpointPath + '.tmp', 'wb') as f:
+            pickle.dump({
+                'key': self._checkpointKey(),
+                'position': self._file.tell(),
+                'levels': self._levels,
+                'jpegTables': self._jpegTables,
+            }, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(checkpointPath + '.tmp', checkpointPath)
+        self._lastCheckpoint = time.time()
+
+    def _rowsAdded(self):
+        if (self.checkpointInterval is not None and
+                time.time() - self._lastCheckpoint >= self.checkpointInterval):
+            self.checkpoint()
+        if self.progress:
+            self.progress(100 * self.rowsAdded // self.height)
+
+    def addStrip(self, strip):
+        """
+        Add the next rows of the full resolution image.
+
+        :param strip: a numpy array of shape (rows, width, 3) and type uint8.
+        """
+        if strip.shape[1:] != (self.width, 3):
+            raise ValueError('Strips must be %d pixels wide with 3 samples' %
+                             self.width)
+        self._addRows(0, strip)
+        self._rowsAdded()
+
+    def _addRows(self, levelNum, rows):
+        level = self._levels[levelNum]
+        level['rowsAdded'] += rows.shape[0]
+        if level['rowsAdded'] > level['height']:
+            raise ValueError('Too many rows added to the image')
+        final = level['rowsAdded'] == level['height']
+        level['pending'] = numpy.concatenate((level['pending'], rows))
+        while (level['pending'].shape[0] >= self.tileSize or
+                (final and level['pending'].shape[0])):
+            self._writeTileRow(level, level['pending'][:self.tileSize])
+            level['pending'] = level['pending'][self.tileSize:]
+        if levelNum + 1 < len(self._levels):
+            level['unreduced'] = numpy.concatenate((level['unreduced'], rows))
+            count = level['unreduced'].shape[0]
+            if not final:
+                count -= count % 2
+            if count:
+                self._addRows(levelNum + 1,
+                              reduceRows(level['unreduced'][:count]))
+                level['unreduced'] = level['unreduced'][count:]
+
+    def encodeTile(self, tile):
+        """
+        Encode a tile as an abbreviated JPEG, recording the JPEG tables on the
+        first call.
+
+        :param tile: a numpy array of at most (tileSize, tileSize, 3).  Smaller
+            tiles are padded.
+        :returns: the encoded tile.
+        """
+        tables, frame = encodeJpegTile(tile, self.tileSize, self.quality)
+        if self._jpegTables is None:
+            self._jpegTables = tables
+        return frame
+
+    def addEncodedBand(self, band):
+        """
+        Add a band of the full resolution image that was encoded with
+        encodeBand.  Bands must be added in order.
+
+        :param band: the value returned by encodeBand.
+        """
+        tables, levels, reduced = band
+        if self._jpegTables is None:
+            self._jpegTables = tables
+        for levelNum, (rowCount, tiles) in enumerate(levels):
+            level = self._levels[levelNum]
+            level['rowsAdded'] += rowCount
+            for data in tiles:
+                self.writeEncodedTile(level, data)
+        if len(levels) < len(self._levels):
+            self._addRows(len(levels), reduced)
+        self._rowsAdded()
+
+    def _writeTileRow(self, level, rows):
+        for x in range(0, level['width'], self.tileSize):
+            self.writeEncodedTile(
+                level, self.encodeTile(rows[:, x:x + self.tileSize]))
+
+    def writeEncodedTile(self, level, data):
+        """
+        Append an encoded tile to the file.  Tiles must be written in order.
+
+        :param level: the level record the tile belongs to.
+        :param data: the encoded tile.
+        """
+        level['offsets'].append(self._file.tell())
+        level['byteCounts'].append(len(data))
+        self._file.write(data)
+
+    def _writeData(self, data):
+        """
+        Write data at the end of the file, aligned to a word boundary.
+
+        :returns: the offset of the data.
+        """
+        if self._file.tell() % 2:
+            self._file.write(b'\x00')
+        offset = self._file.tell()
+        self._file.write(data)
+        return offset
+
+    def _buildDirectory(self, levelNum, tablesOffset):
+        level = self._levels[levelNum]
+        entries = [
+            (254, TIFF_LONG, [1 if levelNum else 0]),  # NewSubfileType
+            (256, TIFF_LONG, [level['width']]),  # ImageWidth
+            (257, TIFF_LONG, [level['height']]),  # ImageLength
+            (258, TIFF_SHORT, [8, 8, 8]),  # BitsPerSample
+            (259, TIFF_SHORT, [7]),  # Compression: JPEG
+            (262, TIFF_SHORT, [6]),  # PhotometricInterpretation: YCbCr
+            (274, TIFF_SHORT, [1]),  # Orientation: top-left
+            (277, TIFF_SHORT, [3]),  # SamplesPerPixel
+            (284, TIFF_SHORT, [1]),  # PlanarConfiguration: contiguous
+            (322, TIFF_LONG, [self.tileSize]),  # TileWidth
+            (323, TIFF_LONG, [self.tileSize]),  # TileLength
+            (324, TIFF_LONG8, level['offsets']),  # TileOffsets
+            (325, TIFF_LONG8, level['byteCounts']),  # TileByteCounts
+            (347, TIFF_UNDEFINED, None),  # JPEGTables
+            (530, TIFF_SHORT, [2, 2]),  # YCbCrSubSampling
+        ]
+        records = []
+        for tag, fieldType, values in entries:
+            if tag == 347:
+                count, valueData = len(self._jpegTables), struct.pack(
+                    '<Q', tablesOffset)
+            else:
+                count = len(values)
+                valueData = struct.pack(
+                    '<%d%s' % (count, TIFFTypeFormats[fieldType]), *values)
+                if len(valueData) > 8:
+                    valueData = struct.pack('<Q', self._writeData(valueData))
+            records.append(struct.pack('<HHQ', tag, fieldType, count) +
+                           valueData.ljust(8, b'\x00'))
+        return struct.pack('<Q', len(records)) + b''.join(records)
+
+    def close(self):
+        """
+        Finish writing the file.  All rows of the image must have been added.
+        """
+        if self.rowsAdded != self.height:
+            raise ValueError('Only %d of %d rows were added to the image' % (
+                self.rowsAdded, self.height))
+        tablesOffset = self._writeData(self._jpegTables)
+        directories = [self._buildDirectory(levelNum, tablesOffset)
+                       for levelNum in range(len(self._levels))]
+        if self._file.tell() % 2:
+            self._file.write(b'\x00')
+        firstOffset = nextOffset = self._file.tell()
+        for idx, directory in enumerate(directories):
+            nextOffset += len(directory) + 8
+            self._file.write(directory)
+            self._file.write(struct.pack(
+                '<Q', nextOffset if idx + 1 < len(directories) else 0))
+        # BigTIFF header: little endian, version 43, 8-byte offsets
+        self._file.seek(0)
+        self._file.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, firstOffset))
+        self._file.close()
+        if os.path.exists(self.path + '.checkpoint'):
+            os.unlink(self.path + '.checkpoint')
+
+
+def removeStaleCheckpoints(directory, maxAge):
+    """
+    Remove partial conversions and their checkpoints that haven't been written
+    to recently, such as those of jobs that were canceled or that failed and
+    weren't retried.
+
+    :param directory: the directory with the partial conversions.
+    :param maxAge: the number of seconds since a partial conversion or its
+        checkpoint was last written after which both are removed.
+    """
+    partials = {}
+    for name in os.listdir(directory):
+        for suffix in ('.tiff', '.tiff.checkpoint', '.tiff.checkpoint.tmp'):
+            if name.endswith(suffix):
+                base = os.path.join(directory, name[:-len(suffix)])
+                partials.setdefault(base, []).append(
+                    os.path.join(directory, name))
+    now = time.time()
+    for paths in partials.values():
+        try:
+            if now - max(os.path.getmtime(path) for path in paths) <= maxAge:
+                continue
+            for path in paths:
+                os.unlink(path)
+        except OSError:
+            # Another job removed or replaced one of the files
+            pass
+
+
+# Seconds to wait for an encoded band before checking that the processes
+# encoding them are still running
+WorkerPollInterval = 5
+
+
+def _bandWorker(tasks, results, tileSize, quality, bandLevels):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        idx, rows = task
+        try:
+            results.put((idx, encodeBand(rows, tileSize, quality, bandLevels),
+                         None))
+        except Exception:
+            results.put((idx, None, traceback.format_exc()))
+
+
+def writeBandsInParallel(writer, bands, processes, bandLevels):
+    """
+    Encode bands of the full resolution image in worker processes and add
+    them to a writer in order.  Only a couple of bands per process are read
+    ahead of the writer.
+
+    :param writer: a PyramidTiffWriter.
+    :param bands: an iterator of numpy arrays, each of which is
+        writer.tileSize * 2 ** (bandLevels - 1) rows of the image, except
+        possibly the last.
+    :param processes: the number of worker processes.
+    :param bandLevels: the number of levels encoded by the workers.
+    """
+    # Workers are forked and only exchange data through the queues, so this
+    # works when the module is run as a Girder Worker script rather than being
+    # imported.
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(
+        target=_bandWorker,
+        args=(tasks, results, writer.tileSize, writer.quality, bandLevels))
+        for _ in range(processes)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        bands = enumerate(bands)
+        queued = 0
+        nextIdx = 0
+        done = {}
+        while True:
+            while queued - nextIdx < processes * 2:
+                task = next(bands, None)
+                if task is None:
+                    break
+                tasks.put(task)
+                queued += 1
+            if nextIdx == queued:
+                break
+            while nextIdx not in done:
+                try:
+                    idx, band, error = results.get(
+                        timeout=WorkerPollInterval)
+                except queue.Empty:
+                    # Workers only exit when there are no more tasks, so one
+                    # that exited early was killed or crashed and its band
+                    # will never arrive.
+                    for worker in workers:
+                        if worker.exitcode is not None:
+                            raise Exception(
+                                'A band encoding process exited with code '
+                                '%s' % worker.exitcode)
+                    continue
+                if error:
+                    raise Exception('Failed to encode band: %s' % error)
+                done[idx] = band
+            writer.addEncodedBand(done.pop(nextIdx))
+            nextIdx += 1
+    finally:
+        for worker in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+        # Bands queued for workers that died can never be sent; don't wait
+        # for them when this process exits.
+        tasks.cancel_join_thread()
+        results.cancel_join_thread()
+
+
+def openLargeImage(path):
+    """
+    Open an image without PIL's check for decompression bombs, which would
+    refuse most images that need converting.  The check is restored
+    afterwards; callers are responsible for not decoding too much at once.
+
+    :param path: the path of the image.
+    :returns: a PIL image that hasn't been decoded.
+    """
+    maxImagePixels = PIL.Image.MAX_IMAGE_PIXELS
+    PIL.Image.MAX_IMAGE_PIXELS = None
+    try:
+        return PIL.Image.open(path)
+    finally:
+        PIL.Image.MAX_IMAGE_PIXELS = maxImagePixels
+
+
+# Bits per pixel of the raw modes whose rows can be read separately
+RawModeBits = {
+    'L': 8, 'P': 8, 'I;16': 16, 'I;16B': 16, 'LA': 16, 'RGB': 24,
+    'BGR': 24, 'RGBA': 32, 'RGBX': 32, 'CMYK': 32, 'I': 32, 'F': 32,
+}
+
+
+def _rawRowBytes(image, tile):
+    """
+    Get the length of each row of a part of an image that is stored without
+    compression, one row after another, from the top to the bottom.
+
+    :param image: a PIL image that hasn't been decoded.
+    :param tile: one of the image's tile entries.
+    :returns: the number of bytes in each row, or None if the rows of the
+        tile can't be read separately.
+    """
+    decoder, extents, offset, args = tile[:4]
+    if not isinstance(args, tuple):
+        args = (args, )
+    if (decoder != 'raw' or args[0] not in RawModeBits or
+            (len(args) > 2 and args[2] != 1) or
+            extents[0] != 0 or extents[2] != image.size[0]):
+        return None
+    if len(args) > 1 and args[1]:
+        return args[1]
+    return (image.size[0] * RawModeBits[args[0]] + 7) // 8
+
+
+def canDecodeRows(image, maxPixels=None):
+    """
+    Check if any range of rows of an image can be decoded without decoding
+    the rest of it.  This is true for images that are stored without
+    compression and for TIFFs that PIL decodes one strip or tile at a time.
+
+    :param image: a PIL image that hasn't been decoded.
+    :param maxPixels: if not None, the largest strip or tile that may be
+        decoded at once.
+    :returns: True if decodeRows can be used.
+    """
+    splits = [_rawRowBytes(image, tile) is not None for tile in image.tile]
+    if not all(splits) and (image.format != 'TIFF' or len(splits) < 2):
+        return False
+    return not maxPixels or all(
+        split or (tile[1][2] - tile[1][0]) * (tile[1][3] - tile[1][1]) <=
+        maxPixels for split, tile in zip(splits, image.tile))
+
+
+def decodeRows(path, top, bottom):
+    """
+    Decode a range of rows of an image, only reading the rows, strips, or
+    tiles that contain them.
+
+    :param path: the path of an image for which canDecodeRows is True.
+    :param top: the first row.
+    :param bottom: the row after the last row.
+    :returns: a PIL image of the rows.
+    """
+    image = openLargeImage(path)
+    width = image.size[0]
+    tiles = []
+    for tile in image.tile:
+        x0, y0, x1, y1 = tile[1]
+        if y0 >= bottom or y1 <= top:
+            continue
+        rowBytes = _rawRowBytes(image, tile)
+        if rowBytes is not None:
+            # Only read the requested rows
+            offset = tile[2] + (max(y0, top) - y0) * rowBytes
+            y0, y1 = max(y0, top), min(y1, bottom)
+            tile = (tile[0], tile[1], offset) + tuple(tile[3:])
+        tiles.append((tile, y0, y1))
+    windowTop = min(y0 for tile, y0, y1 in tiles)
+    windowBottom = max(y1 for tile, y0, y1 in tiles)
+    # Decode the parts of the file that cover the rows as if they were a
+    # whole image
+    image.tile = [
+        (tile[0], (tile[1][0], y0 - windowTop, tile[1][2], y1 - windowTop)) +
+        tuple(tile[2:]) for tile, y0, y1 in tiles]
+    size = (width, windowBottom - windowTop)
+    if hasattr(image, '_size'):
+        image._size = size
+    else:
+        image.size = size
+    image.load()
+    return image.crop((0, top - windowTop, width, bottom - windowTop))
+
+
+def convertWithPillow(inPath, outPath, quality=90, tileSize=256,
+                      progress=None, processes=1, bandLevels=2,
+                      resumePath=None, checkpointInterval=30,
+                      maxPixels=PIL.Image.MAX_IMAGE_PIXELS):
+    """
+    Convert an image that PIL can read to a pyramidal TIFF.  Images that are
+    uncompressed or are TIFFs stored in strips or tiles are decoded a few rows
+    at a time.  Other images are decoded all at once, so they are refused if
+    they are too large.
+
+    :param inPath: the source image.
+    :param outPath: the output tiled pyramidal TIFF.
+    :param quality: the JPEG quality.
+    :param tileSize: the width and height of the output tiles.
+    :param progress: if not None, a function that is called with the
+        percentage of the conversion that is complete.
+    :param processes: the number of processes used to encode tiles.  If 0 or
+        None, use one per CPU.
+    :param bandLevels: when using more than one process, the number of levels
+        encoded in each band of the image.  Lower levels are encoded by the
+        main process.  Each band is tileSize * 2 ** (bandLevels - 1) rows.
+    :param resumePath: if not None, the image is written to this path and
+        checkpointed periodically.  If a previous conversion of the same image
+        was interrupted, it is resumed.  The finished image is moved to
+        outPath.
+    :param checkpointInterval: the minimum time in seconds between
+        checkpoints when resumePath is specified.
+    :param maxPixels: the largest number of pixels in an image, strip, or tile
+        that must be decoded all at once.  None for no limit.
+    """
+    image = openLargeImage(inPath)
+    width, height = image.size
+    rowsDecodable = canDecodeRows(image, maxPixels)
+    if not rowsDecodable and maxPixels and width * height > maxPixels:
+        raise Exception(
+            'The image is too large to convert without libvips (%d x %d '
+            'pixels).' % (width, height))
+    if resumePath:
+        writer = PyramidTiffWriter(resumePath, width, height, tileSize,
+                                   quality, progress, checkpointInterval)
+    else:
+        writer = PyramidTiffWriter(outPath, width, height, tileSize, quality,
+                                   progress)
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    bandLevels = max(1, min(bandLevels, len(writer._levels)))
+    bandHeight = tileSize * 2 ** (bandLevels - 1) if processes > 1 else \
+        tileSize
+
+    def strips(start, end, stripHeight):
+        for y in range(start, end, stripHeight):
+            bottom = min(end, y + stripHeight)
+            if rowsDecodable:
+                strip = decodeRows(inPath, y, bottom)
+            else:
+                strip = image.crop((0, y, width, bottom))
+            yield numpy.asarray(strip.convert('RGB'))
+
+    # A resumed conversion may not stop on a band boundary, so add rows one
+    # strip at a time until it does.
+    start = writer.rowsAdded
+    bandStart = min(height, -(-start // bandHeight) * bandHeight)
+    for strip in strips(start, bandStart, tileSize):
+        writer.addStrip(strip)
+    if processes > 1:
+        writeBandsInParallel(writer, strips(bandStart, height, bandHeight),
+                             processes, bandLevels)
+    else:
+        for strip in strips(bandStart, height, tileSize):
+            writer.addStrip(strip)
+    writer.close()
+    if resumePath:
+        shutil.move(resumePath, outPath)
+
+
+class VipsProgressParser(object):
+    """
+    Parse the output of the vips command run with --vips-progress as it is
+    read.  Progress updates are separated by carriage returns, and each is
+    reported once when its percentage changes.  Only the end of the output is
+    kept, for error reporting.
+    """
+    def __init__(self, progress=None, keepLines=20):
+        """
+        :param progress: if not None, a function that is called with the
+            percentage of the conversion that is complete.
+        :param keepLines: the number of lines of output to keep.
+        """
+        self.progress = progress
+        self.lines = collections.deque(maxlen=keepLines)
+        self.lastPercent = None
+        self._partial = b''
+
+    def feed(self, data):
+        """
+        Parse part of the output.
+
+        :param data: the next bytes of output.
+        """
+        self._partial += data
+        parts = re.split(b'[\r\n]', self._partial)
+        self._partial = parts.pop()
+        for part in parts:
+            self._addLine(part)
+
+    def close(self):
+        """
+        Parse any output that didn't end with a line break.
+        """
+        self._addLine(self._partial)
+        self._partial = b''
+
+    def _addLine(self, line):
+        if not line.strip():
+            return
+        self.lines.append(line.decode('utf8', 'replace'))
+        match = re.search(b'(\\d+)% complete', line)
+        if match and int(match.group(1)) != self.lastPercent:
+            self.lastPercent = int(match.group(1))
+            if self.progress is not None:
+                self.progress(self.lastPercent)
+
+
+def convertWithPyvips(inPath, outPath, quality=90, tileSize=256,
+                      progress=None, concurrency=None):
+    """
+    Convert an image in-process using libvips.
+
+    :param inPath: the source image.
+    :param outPath: the output tiled pyramidal TIFF.
+    :param quality: the JPEG quality.
+    :param tileSize: the width and height of the output tiles.
+    :param progress: if not None, a function that is called with the
+        percentage of the conversion that is complete.
+    :param concurrency: if not None or 0, the number of threads libvips uses
+        for this conversion.
+    """
+    import pyvips
+
+    image = pyvips.Image.new_from_file(inPath, access='sequential')
+    lastPercent = [None]
+    failures = []
+
+    def evalCallback(image, vipsProgress):
+        # Only report when the percentage changes to avoid flooding the job
+        if vipsProgress.percent != lastPercent[0] and not failures:
+            lastPercent[0] = vipsProgress.percent
+            try:
+                progress(vipsProgress.percent)
+            except Exception as exc:
+                # libvips ignores exceptions raised in callbacks, so ask it
+                # to stop and raise this once it has.
+                failures.append(exc)
+                image.set_kill(True)
+
+    if progress is not None:
+        image.set_progress(True)
+        image.signal_connect('eval', evalCallback)
+    # libvips only reads VIPS_CONCURRENCY when it is initialized, and this
+    # process may run other conversions, so set the concurrency for this one
+    # and restore it afterwards.
+    if concurrency:
+        previousConcurrency = pyvips.concurrency_get()
+        pyvips.concurrency_set(int(concurrency))
+    try:
+        image.tiffsave(
+            outPath, compression='jpeg', Q=quality, tile=True,
+            tile_width=tileSize, tile_height=tileSize, pyramid=True,
+            bigtiff=True)
+    except pyvips.Error:
+        if not failures:
+            raise
+    finally:
+        if concurrency:
+            pyvips.concurrency_set(previousConcurrency)
+    if failures:
+        raise failures[0]
+
+
+def convertWithVipsCommand(inPath, outPath, quality=90, tileSize=256,
+                           progress=None, concurrency=None):
+    """
+    Convert an image using the vips command line tool.  Progress is parsed
+    from the command's output as it runs.
+
+    :param inPath: the source image.
+    :param outPath: the output tiled pyramidal TIFF.
+    :param quality: the JPEG quality.
+    :param tileSize: the width and height of the output tiles.
+    :param progress: if not None, a function that is called with the
+        percentage of the conversion that is complete.
+    :param concurrency: if not None or 0, the number of threads the vips
+        command uses.
+    """
+    convertCommand = (
+        'vips',
+        'tiffsave',
+        inPath,
+        outPath,
+        '--compression', 'jpeg',
+        '--Q', str(quality),
+        '--tile',
+        '--tile-width', str(tileSize),
+        '--tile-height', str(tileSize),
+        '--pyramid',
+        '--bigtiff',
+        '--vips-progress'
+    )
+    # Progress is written to stdout with carriage returns between updates, so
+    # merge stderr into it and read it in small pieces.
+    env = dict(os.environ)
+    if concurrency:
+        env['VIPS_CONCURRENCY'] = str(int(concurrency))
+    proc = subprocess.Popen(convertCommand, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, env=env)
+    parser = VipsProgressParser(progress)
+    try:
+        while True:
+            # Unlike proc.stdout.read, this returns as soon as there is any
+            # output
+            chunk = os.read(proc.stdout.fileno(), 256)
+            if not chunk:
+                break
+            parser.feed(chunk)
+        parser.close()
+        proc.wait()
+    finally:
+        # Stop the conversion if reporting progress failed, such as when the
+        # job was canceled.
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    if proc.returncode:
+        print('output: ' + '\n'.join(parser.lines))
+        raise Exception('VIPS command failed (rc=%d): %s' % (
+            proc.returncode, ' '.join(convertCommand)))
+
+
+def _pyvipsAvailable():
+    try:
+        import pyvips  # noqa
+    except (ImportError, OSError):
+        return False
+    return True
+
+
+def conversionEngines():
+    """
+    List the ways that images can be converted here, from the most to the
+    least preferred: in-process libvips, the vips command, and PIL.
+
+    :returns: a list of engine names, always ending with 'pillow'.
+    """
+    engines = []
+    if _pyvipsAvailable():
+        engines.append('pyvips')
+    if which('vips'):
+        engines.append('vips')
+    engines.append('pillow')
+    return engines
+
+
+def convertImage(inPath, outPath, quality=90, tileSize=256, progress=None,
+                 processes=0, resumePath=None,
+                 maxPixels=PIL.Image.MAX_IMAGE_PIXELS):
+    """
+    Convert an image to a pyramidal TIFF with the most preferred available
+    engine.
+
+    :param inPath: the source image.
+    :param outPath: the output tiled pyramidal TIFF.
+    :param quality: the JPEG quality.
+    :param tileSize: the width and height of the output tiles.
+    :param progress: if not None, a function that is called with the
+        percentage of the conversion that is complete.
+    :param processes: the number of threads used by libvips or processes
+        used to encode tiles with PIL.  If 0 or None, libvips uses its default
+        and PIL uses one process per CPU.
+    :param resumePath: if not None, conversions with PIL are checkpointed to
+        this path so that they can be resumed.  See convertWithPillow.
+    :param maxPixels: the largest image that PIL may decode all at once.
+        See convertWithPillow.
+    :returns: the name of the engine that was used.
+    """
+    engine = conversionEngines()[0]
+    if engine == 'pyvips':
+        convertWithPyvips(inPath, outPath, quality, tileSize, progress,
+                          concurrency=processes)
+    elif engine == 'vips':
+        convertWithVipsCommand(inPath, outPath, quality, tileSize, progress,
+                               concurrency=processes)
+    else:
+        # Much slower than vips, but only needs numpy and PIL
+        convertWithPillow(inPath, outPath, quality, tileSize, progress,
+                          processes=processes, resumePath=resumePath,
+                          maxPixels=maxPixels)
+    return engine
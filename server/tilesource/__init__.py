@@ -22,9 +22,11 @@
 
 import collections
 import functools
+import importlib
 import sys
+import types
 from .base import TileSource, getTileSourceFromDict, TileSourceException, \
-    TileSourceAssetstoreException
+    TileSourceAssetstoreException, rankSources
 try:
     import girder
     from girder.constants import TerminalColor
@@ -34,54 +36,217 @@ except ImportError:
     import logging as logger
     girder = None
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
-AvailableTileSources = collections.OrderedDict()
-all = [TileSource, TileSourceException, TileSourceAssetstoreException,
-       AvailableTileSources]
 
-if girder:
-    all.append(GirderTileSource)
+# Tiled TIFF and OpenSlide extensions and mime types
+TiffExtensions = ['.tif', '.tiff', '.ptif']
+TiffMimeTypes = ['image/tiff']
+OpenSlideExtensions = ['.svs', '.ndpi', '.scn', '.bif', '.vms', '.vmu',
+                      '.mrxs', '.svslide']
 
+# The modules that implement tile sources can be slow to import (libtiff,
+# OpenSlide, and PIL's font support), so they are only imported when a source
+# is first used.  Sources with names are available through
+# AvailableTileSources.  Each source can declare:
+#   extensions, mimeTypes: lists of the lowercase file extensions and mime
+#       types that the source is expected to read.  Files that match are tried
+#       with the source before files that don't.
+#   cost: the relative cost of trying to open a file with the source.
+#   priority: used to pick between sources that are equally likely to read a
+#       file and are equally costly.  Lower values are tried first.
 sourceList = [
-    {'moduleName': '.tiff', 'className': 'TiffFileTileSource'},
+    {'moduleName': '.tiff', 'className': 'TiffFileTileSource',
+     'name': 'tifffile', 'extensions': TiffExtensions,
+     'mimeTypes': TiffMimeTypes, 'cost': 1},
     {'moduleName': '.tiff', 'className': 'TiffGirderTileSource',
-     'girder': True},
-    {'moduleName': '.svs', 'className': 'SVSFileTileSource'},
-    {'moduleName': '.svs', 'className': 'SVSGirderTileSource', 'girder': True},
-    {'moduleName': '.test', 'className': 'TestTileSource'},
-    {'moduleName': '.dummy', 'className': 'DummyTileSource'},
+     'name': 'tiff', 'girder': True, 'extensions': TiffExtensions,
+     'mimeTypes': TiffMimeTypes, 'cost': 1},
+    {'moduleName': '.svs', 'className': 'SVSFileTileSource',
+     'name': 'svsfile', 'extensions': OpenSlideExtensions, 'cost': 2},
+    {'moduleName': '.svs', 'className': 'SVSGirderTileSource', 'name': 'svs',
+     'girder': True, 'extensions': OpenSlideExtensions, 'cost': 2},
+    {'moduleName': '.test', 'className': 'TestTileSource', 'name': 'test'},
+    {'moduleName': '.dummy', 'className': 'DummyTileSource', 'name': 'dummy'},
+    # These don't have names, so they are only used for items that are still
+    # being converted
+    {'moduleName': '.pil', 'className': 'PILFileTileSource'},
+    {'moduleName': '.pil', 'className': 'PILGirderTileSource', 'girder': True},
 ]
-for source in sourceList:
+# Don't try to load girder sources if we couldn't import girder
+sourceList = [source for source in sourceList
+              if girder or not source.get('girder')]
+
+# Other packages can add tile sources with entry points in this group.  Each
+# entry point's name is the name of the source, and it refers to either a
+# tile source class or a dictionary like those in sourceList, where moduleName
+# is an absolute module name.  A class can declare extensions, mimeTypes,
+# cost, and priority as class attributes.  Sources with the same name as one
+# of ours replace it.
+EntryPointGroup = 'large_image.tilesource'
+SourceInfoKeys = ('extensions', 'mimeTypes', 'cost', 'priority')
+
+
+def _loadEntryPointSources():
+    """
+    Find the tile sources that other packages provide through entry points.
+
+    :returns: a list of sources in the same form as sourceList.
+    """
     try:
-        # Don't try to load girder sources if we couldn't import girder
-        if not girder and source.get('girder'):
-            continue
-        # For each of our sources, try to import the named class from the
-        # source module
-        className = source['className']
-        sourceModule = __import__(
-            source['moduleName'].lstrip('.'), globals(), locals(), [className],
-            len(source['moduleName']) - len(source['moduleName'].lstrip('.')))
-        sourceClass = getattr(sourceModule, className)
-        # Add the source class to the locals name so that it can be reached by
-        # importing the tilesource module
-        locals().update({className: sourceClass})
-        # add it to our list of exports
-        all.append(sourceClass)
-        # add it to our dictionary of available sources if it has a name
-        if getattr(sourceClass, 'name', None):
-            AvailableTileSources[sourceClass.name] = sourceClass
+        import pkg_resources
     except ImportError:
-        if girder:
-            print(TerminalColor.error('Error: Could not import %s' % className))
-            logger.exception('Error: Could not import %s' % className)
+        return []
+    sources = []
+    for entryPoint in pkg_resources.iter_entry_points(EntryPointGroup):
+        try:
+            value = entryPoint.load()
+        except Exception:
+            logger.exception('Error: Could not load tile source entry point '
+                             '%s' % entryPoint)
+            continue
+        if isinstance(value, dict):
+            source = dict(value)
         else:
-            logger.warning('Error: Could not import %s' % className)
+            source = {'className': value.__name__, 'class': value,
+                      'girder': getattr(value, 'girderSource', False)}
+            source.update({key: getattr(value, key)
+                           for key in SourceInfoKeys if hasattr(value, key)})
+        source['name'] = entryPoint.name
+        if girder or not source.get('girder'):
+            sources.append(source)
+    return sources
+
+
+def _loadSourceClass(source):
+    """
+    Import the class of a tile source, if this hasn't been tried already.
+
+    :param source: an entry from sourceList.
+    :returns: the class or None if it couldn't be imported.
+    """
+    if 'class' not in source:
+        className = source['className']
+        try:
+            sourceModule = importlib.import_module(
+                source['moduleName'], __name__)
+            source['class'] = getattr(sourceModule, className)
+        except ImportError:
+            source['class'] = None
+            if girder:
+                print(TerminalColor.error(
+                    'Error: Could not import %s' % className))
+                logger.exception('Error: Could not import %s' % className)
+            else:
+                logger.warning('Error: Could not import %s' % className)
+    return source['class']
+
+
+class TileSourceRegistry(Mapping):
+    """
+    An ordered mapping of tile source names to classes.  Each source's module
+    is imported the first time the source is accessed, either directly or by
+    iterating through the mapping.  Sources that can't be imported are
+    skipped.  Sources provided by entry points are found on first use.
+    """
+    def __init__(self, sources):
+        self._sources = collections.OrderedDict(
+            (source['name'], source) for source in sources
+            if source.get('name'))
+        self._discovered = False
+
+    def _discover(self):
+        if not self._discovered:
+            self._discovered = True
+            for source in _loadEntryPointSources():
+                self._sources[source['name']] = source
+
+    def __getitem__(self, name):
+        self._discover()
+        sourceClass = _loadSourceClass(self._sources[name])
+        if sourceClass is None:
+            raise KeyError(name)
+        return sourceClass
+
+    def __iter__(self):
+        self._discover()
+        for name, source in list(self._sources.items()):
+            if _loadSourceClass(source) is not None:
+                yield name
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def getSourceInfo(self, name):
+        """
+        Get what a source declares about the files it reads, without
+        importing it.
+
+        :param name: the name of the source.
+        :returns: a dictionary that may contain extensions, mimeTypes, cost,
+            and priority.
+        """
+        self._discover()
+        source = self._sources[name]
+        return {key: source[key] for key in SourceInfoKeys if key in source}
+
+
+AvailableTileSources = TileSourceRegistry(sourceList)
 
 # Create a partial function that will work through the known functions to get a
 # tile source.
 getTileSource = functools.partial(getTileSourceFromDict,
                                   AvailableTileSources)
-all.append(getTileSource)
 
-__all__ = all
+# The tile source classes are only listed in __all__ if they can be
+# imported, which is checked when __all__ is first used.
+_baseAll = ['TileSource', 'TileSourceException',
+            'TileSourceAssetstoreException', 'AvailableTileSources',
+            'rankSources', 'getTileSource']
+if girder:
+    _baseAll.append('GirderTileSource')
+
+
+def _getLazyAttribute(name):
+    """
+    Get a tile source class, loading it on first access, such as by
+    "from large_image.tilesource import TiffFileTileSource", or get __all__.
+
+    :param name: the name of the attribute.
+    :returns: the value of the attribute.
+    """
+    if name == '__all__':
+        return _baseAll + [
+            source['className'] for source in sourceList
+            if _loadSourceClass(source) is not None]
+    for source in sourceList:
+        if source['className'] == name:
+            sourceClass = _loadSourceClass(source)
+            if sourceClass is not None:
+                return sourceClass
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+if sys.version_info >= (3, 7):
+    __getattr__ = _getLazyAttribute
+else:
+    class _LazySourceModule(types.ModuleType):
+        """
+        This module, with _getLazyAttribute used for attributes it doesn't
+        have.  Python before 3.7 doesn't use a module's __getattr__.
+        """
+        def __getattr__(self, name):
+            return _getLazyAttribute(name)
+
+    # Replacing a module in sys.modules while it is imported is supported: the
+    # import system returns whatever is in sys.modules when the import
+    # finishes.  Python 2 clears the globals of a module when it is garbage
+    # collected, which would break the functions defined here, so the lazy
+    # module keeps a reference to the original one.
+    _lazyModule = _LazySourceModule(__name__, __doc__)
+    _lazyModule.__dict__.update(sys.modules[__name__].__dict__)
+    _lazyModule._module = sys.modules[__name__]
+    sys.modules[__name__] = _lazyModule
@@ -18,8 +18,14 @@
 #############################################################################
 
 import math
+import mimetypes
+import os
+import repoze.lru
+import six
 from six import BytesIO
 
+from .cache import instanceLruCache
+
 try:
     import girder
     from girder import logger
@@ -38,13 +44,155 @@ except ImportError:
 # Not having PIL disables thumbnail creation, but isn't fatal
 try:
     import PIL
-    if int(PIL.PILLOW_VERSION.split('.')[0]) < 3:
+    # Pillow 7 removed PILLOW_VERSION
+    if int(getattr(PIL, '__version__', getattr(
+            PIL, 'PILLOW_VERSION', '0')).split('.')[0]) < 3:
         logger.warning('Error: Pillow v3.0 or later is required')
         PIL = None
 except ImportError:
     logger.warning('Error: Could not import PIL')
     PIL = None
 
+# Not having numpy disables detecting uniform tiles
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Results of sniffing a file to see if a tile source can read it
+SniffNo = 0
+SniffUnknown = 1
+SniffLikely = 2
+
+# Defaults for the relative cost of opening a file with a tile source and the
+# priority of the source.  Lower values are tried first.
+DefaultSourceCost = 1
+DefaultSourcePriority = 0
+
+# Number of bytes read from the start of a file when sniffing it
+SniffHeaderSize = 512
+# Little and big endian signatures of classic TIFF and BigTIFF files
+TiffSignatures = (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')
+
+# Names of the sources that read files, keyed by (path, mtime, size).  False is
+# stored for files no source could read.
+_sourceNameCache = repoze.lru.LRUCache(1000)
+
+# The largest difference between pixel values in a tile that is treated as
+# having a single color, such as the background of a slide
+UniformTileTolerance = 2
+
+# Statistics are computed from the lowest resolution level that is at least
+# this many pixels wide or high, unless a level is specified.
+StatisticsMinSize = 2048
+
+
+def readFileHeader(path, size=SniffHeaderSize):
+    """
+    Read the start of a file.
+
+    :param path: the path of the file.
+    :param size: the maximum number of bytes to read.
+    :returns: the bytes read.  This is empty if the file can't be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return f.read(size)
+    except (IOError, OSError, TypeError):
+        return b''
+
+
+def _getSourceFileInfo(sourceObj, girderSources):
+    """
+    Get the name, mime type, and first bytes of the file a source would read.
+    This is done once for all of the sources being ranked.
+
+    :param sourceObj: a file path or, for Girder sources, an item.
+    :param girderSources: True if sourceObj is an item.
+    :returns: name, mimeType, header.  Any may be None if it isn't known.
+    """
+    if girderSources:
+        if not girder:
+            return None, None, None
+        try:
+            fileObj = ModelImporter.model('file').load(
+                sourceObj['largeImage']['fileId'], force=True)
+        except (KeyError, TypeError, ValidationException):
+            return None, None, None
+        if fileObj is None:
+            return None, None, None
+        try:
+            header = readFileHeader(GirderTileSource._getFileObjPath(fileObj))
+        except TileSourceException:
+            header = None
+        # Files in the assetstore don't keep their names
+        return fileObj.get('name'), fileObj.get('mimeType'), header
+    if isinstance(sourceObj, six.string_types):
+        return (sourceObj, mimetypes.guess_type(sourceObj)[0],
+                readFileHeader(sourceObj))
+    return None, None, None
+
+
+def rankSources(availableSources, sourceObj, girderSources=False):
+    """
+    Order the sources that might read an input, skipping those that can't read
+    it.  Sources are ordered by how likely they are to read the input, based
+    on sniffing it and on the extensions and mime types the sources declare,
+    then by their declared cost and priority, and finally by their order.
+
+    :param availableSources: an ordered dictionary of sources.  If it has a
+        getSourceInfo method, that is used to get the extensions, mimeTypes,
+        cost, and priority declared for each source.
+    :param sourceObj: a file path or, for Girder sources, an item.
+    :param girderSources: True to rank Girder sources, False for the others.
+    :returns: a list of source names.
+    """
+    name, mimeType, header = _getSourceFileInfo(sourceObj, girderSources)
+    ext = os.path.splitext(name)[1].lower() if name else None
+    getSourceInfo = getattr(availableSources, 'getSourceInfo',
+                            lambda sourceName: {})
+    ranked = []
+    for idx, sourceName in enumerate(availableSources):
+        sourceClass = availableSources[sourceName]
+        if getattr(sourceClass, 'girderSource', False) != girderSources:
+            continue
+        score = sourceClass.sniffSource(sourceObj, sniffInfo=(name, header))
+        if score == SniffNo:
+            continue
+        info = getSourceInfo(sourceName)
+        if (ext in info.get('extensions', ()) or
+                (mimeType and mimeType in info.get('mimeTypes', ()))):
+            score += 1
+        ranked.append((
+            -score, info.get('cost', DefaultSourceCost),
+            info.get('priority', DefaultSourcePriority), idx, sourceName))
+    return [entry[-1] for entry in sorted(ranked)]
+
+
+def getUniformColor(image, tolerance=UniformTileTolerance):
+    """
+    Check if an image is a single color.
+
+    :param image: a PIL image.
+    :param tolerance: the largest difference between values of a channel
+        that is still treated as one color.
+    :returns: an RGB tuple, or None if the image has more than one color, is
+        partly transparent, or numpy isn't available.
+    """
+    if numpy is None:
+        return None
+    if image.mode in ('RGBA', 'LA'):
+        alpha = numpy.asarray(image.split()[-1])
+        if alpha.min() != 255:
+            return None
+    data = numpy.asarray(image.convert('RGB')).reshape(-1, 3)
+    low = data.min(axis=0).astype(int)
+    high = data.max(axis=0).astype(int)
+    if (high - low > tolerance).any():
+        return None
+    return tuple(int(value) for value in (low + high) // 2)
+
 
 class TileSourceException(TileGeneralException):
     pass
@@ -54,11 +202,29 @@ class TileSourceAssetstoreException(TileSourceException):
     pass
 
 
-class TileSource(object):
-    outputMimeTypes = {
+def _pilEncodings():
+    """
+    Get the image encodings that tile sources can produce.  WebP depends on
+    how PIL was built.
+
+    :returns: a dictionary of PIL encodings and their mime types.
+    """
+    encodings = {
         'JPEG': 'image/jpeg',
         'PNG': 'image/png'
     }
+    # This is how PIL checks for WebP support, and it is much quicker than
+    # loading all of PIL's image plugins.
+    try:
+        from PIL import _webp  # noqa
+        encodings['WEBP'] = 'image/webp'
+    except ImportError:
+        pass
+    return encodings
+
+
+class TileSource(object):
+    outputMimeTypes = _pilEncodings()
     name = None
 
     def __init__(self, *args, **kwargs):
@@ -103,7 +269,7 @@ class TileSource(object):
         :param image: a PIL image.
         :param encoding: a valid PIL encoding (typically 'PNG' or 'JPEG').
                          Must also be in the outputMimeTypes map.
-        :param jpegQuality: the quality to use when encoding a JPEG.
+        :param jpegQuality: the quality to use when encoding a JPEG or WebP.
         :param jpegSubsampling: the subsampling level to use when encoding a
                                 JPEG.
         """
@@ -178,6 +344,15 @@ class TileSource(object):
         """
         return False
 
+    @classmethod
+    def sniffSource(cls, *args, **kwargs):
+        """
+        Guess whether this class can read the input without trying to read it.
+
+        :returns: SniffNo, SniffUnknown, or SniffLikely.
+        """
+        return SniffNo
+
     def getMetadata(self):
         return {
             'levels': self.levels,
@@ -193,6 +368,164 @@ class TileSource(object):
     def getTileMimeType(self):
         return 'image/jpeg'
 
+    def getTileArray(self, x, y, z):
+        """
+        Get the decoded pixels of a tile.  Sources that have data other than
+        8-bit color override this to return their original values.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :returns: a numpy array of shape (tileHeight, tileWidth, channels).
+        """
+        tile = self.getTile(x, y, z, pilImageAllowed=True)
+        if not isinstance(tile, PIL.Image.Image):
+            tile = PIL.Image.open(BytesIO(tile))
+        if tile.mode not in ('L', 'RGB'):
+            tile = tile.convert('RGB')
+        tile = numpy.asarray(tile)
+        return tile.reshape(tile.shape[:2] + (-1, ))
+
+    def getStatistics(self, level=None, bins=256):
+        """
+        Compute the minimum, maximum, mean, standard deviation, and histogram
+        of each channel from the tiles of one level.  By default, a low
+        resolution level is used, which is representative of the whole image
+        and is quick to read.
+
+        :param level: the level to use.  None to use the lowest resolution
+            level that is at least StatisticsMinSize pixels across.
+        :param bins: the number of histogram bins.  Integer data is binned
+            over the range of its data type and floating point data over the
+            range of its values.
+        :returns: a dictionary with the level, dtype, number of pixels, and a
+            list with the statistics of each channel.
+        """
+        if numpy is None:
+            raise TileSourceException('numpy is required for statistics.')
+        metadata = self.getMetadata()
+        if level is None:
+            level = metadata['levels'] - 1
+            while level > 0 and max(
+                    metadata['sizeX'], metadata['sizeY']) >> (
+                    metadata['levels'] - level) >= StatisticsMinSize:
+                level -= 1
+        if not 0 <= level < metadata['levels']:
+            raise TileSourceException('z layer does not exist')
+        if bins < 1:
+            raise ValueError('Invalid number of bins.')
+        scale = 2 ** (metadata['levels'] - 1 - level)
+        levelWidth = int(math.ceil(float(metadata['sizeX']) / scale))
+        levelHeight = int(math.ceil(float(metadata['sizeY']) / scale))
+        positions = [
+            (x, y) for y in range(int(math.ceil(
+                float(levelHeight) / metadata['tileHeight'])))
+            for x in range(int(math.ceil(
+                float(levelWidth) / metadata['tileWidth'])))]
+
+        def tiles():
+            for x, y in positions:
+                try:
+                    tile = self.getTileArray(x, y, level)
+                except TileSourceException:
+                    # Missing tiles of sparse images are skipped
+                    continue
+                # Don't count the padding of edge tiles
+                yield tile[:levelHeight - y * metadata['tileHeight'],
+                           :levelWidth - x * metadata['tileWidth']]
+
+        stats = histograms = None
+        for tile in tiles():
+            values = tile.reshape(-1, tile.shape[2])
+            if stats is None:
+                stats = {
+                    'dtype': tile.dtype,
+                    'count': 0,
+                    'min': values.min(axis=0),
+                    'max': values.max(axis=0),
+                    'sum': numpy.zeros(tile.shape[2]),
+                    'sumSquares': numpy.zeros(tile.shape[2]),
+                }
+                if tile.dtype.kind in 'ui':
+                    info = numpy.iinfo(tile.dtype)
+                    ranges = [(float(info.min), float(info.max) + 1)] * \
+                        tile.shape[2]
+                    histograms = [numpy.zeros(bins, dtype=numpy.int64)
+                                  for _ in ranges]
+            stats['count'] += values.shape[0]
+            stats['min'] = numpy.minimum(stats['min'], values.min(axis=0))
+            stats['max'] = numpy.maximum(stats['max'], values.max(axis=0))
+            if histograms is not None:
+                for channel, channelRange in enumerate(ranges):
+                    histograms[channel] += numpy.histogram(
+                        values[:, channel], bins=bins, range=channelRange)[0]
+            values = values.astype(numpy.float64)
+            stats['sum'] += values.sum(axis=0)
+            stats['sumSquares'] += (values * values).sum(axis=0)
+        if stats is None:
+            raise TileSourceException('The level has no data.')
+        if histograms is None:
+            # The range of floating point data is only known after reading
+            # all of the tiles, so they are read again.
+            ranges = [(float(low), float(high) if high > low else low + 1)
+                      for low, high in zip(stats['min'], stats['max'])]
+            histograms = [numpy.zeros(bins, dtype=numpy.int64)
+                          for _ in ranges]
+            for tile in tiles():
+                values = tile.reshape(-1, tile.shape[2])
+                for channel, channelRange in enumerate(ranges):
+                    histograms[channel] += numpy.histogram(
+                        values[:, channel], bins=bins, range=channelRange)[0]
+        channels = []
+        for channel, channelRange in enumerate(ranges):
+            mean = stats['sum'][channel] / stats['count']
+            variance = stats['sumSquares'][channel] / stats['count'] - \
+                mean * mean
+            channels.append({
+                'min': stats['min'][channel].item(),
+                'max': stats['max'][channel].item(),
+                'mean': float(mean),
+                'stdev': float(math.sqrt(max(0, variance))),
+                'histogram': histograms[channel].tolist(),
+                'binEdges': numpy.linspace(
+                    channelRange[0], channelRange[1], bins + 1).tolist(),
+            })
+        return {
+            'level': level,
+            'dtype': stats['dtype'].name,
+            'pixels': stats['count'],
+            'channels': channels,
+        }
+
+    def getUniformTileColor(self, x, y, z):
+        """
+        Check if a tile is known to be a single color, such as the background
+        of a slide, without decoding it.  Sources that can tell cheaply
+        override this.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :returns: an RGB tuple, or None if the tile isn't known to be a single
+            color.
+        """
+        return None
+
+    @instanceLruCache(16)
+    def _getConstantTile(self, color):
+        """
+        Get an encoded tile that is a single color.  These are shared by all
+        of the uniform tiles of that color.
+
+        :param color: an RGB tuple.
+        :returns: the encoded tile.
+        """
+        image = PIL.Image.new('RGB', (self.tileWidth, self.tileHeight), color)
+        return self._encodeImage(
+            image, getattr(self, 'encoding', 'JPEG'),
+            getattr(self, 'jpegQuality', 95),
+            getattr(self, 'jpegSubsampling', 0))[0]
+
     def getThumbnail(self, width=None, height=None, **kwargs):
         """
         Get a basic thumbnail from the current tile source.  Aspect ratio is
@@ -325,13 +658,22 @@ class TileSource(object):
             b'\x00' * (regionWidth * regionHeight * 4), 'raw', 'RGBA', 0, 1)
         for x in range(xmin, xmax):
             for y in range(ymin, ymax):
+                posX = x * metadata['tileWidth'] - left
+                posY = y * metadata['tileHeight'] - top
+                color = self.getUniformTileColor(x, y, preferredLevel)
+                if color is not None:
+                    # Fill uniform tiles instead of decoding them
+                    if mode == 'RGBA':
+                        color += (255, )
+                    image.paste(color, (
+                        posX, posY, posX + metadata['tileWidth'],
+                        posY + metadata['tileHeight']))
+                    continue
                 tileData = self.getTile(
                     x, y, preferredLevel, pilImageAllowed=True,
                     sparseFallback=True)
                 if not isinstance(tileData, PIL.Image.Image):
                     tileData = PIL.Image.open(BytesIO(tileData))
-                posX = x * metadata['tileWidth'] - left
-                posY = y * metadata['tileHeight'] - top
                 # Add each tile to the image.  PIL crops these if they are off
                 # the edge.
                 image.paste(tileData, (posX, posY),
@@ -364,12 +706,41 @@ class FileTileSource(TileSource):
         :returns: True if this class can read the input.  False if it
                   cannot.
         """
+        if cls.sniffSource(path) == SniffNo:
+            return False
         try:
             cls(path, *args, **kwargs)
             return True
         except TileSourceException:
             return False
 
+    @classmethod
+    def sniff(cls, path, header):
+        """
+        Cheaply guess whether a file can be read by this class from its name
+        and the first bytes of its contents.  This is used to decide which
+        sources to try, so it should never rule out a file that could be read.
+
+        :param path: the path or name of the file.
+        :param header: up to SniffHeaderSize bytes from the start of the file.
+        :returns: SniffNo, SniffUnknown, or SniffLikely.
+        """
+        return SniffUnknown
+
+    @classmethod
+    def sniffSource(cls, path, sniffInfo=None):
+        """
+        Guess whether this class can read the input.
+
+        :param path: the input, as passed to __init__.
+        :param sniffInfo: if not None, the name and header of the file, so
+            they aren't read again for each source.
+        :returns: SniffNo, SniffUnknown, or SniffLikely.
+        """
+        if sniffInfo is None:
+            sniffInfo = (path, readFileHeader(path))
+        return cls.sniff(*sniffInfo)
+
 
 # Girder specific classes
 
@@ -382,16 +753,46 @@ if girder:
             super(GirderTileSource, self).__init__(item, *args, **kwargs)
             self.item = item
 
+        def _getLargeImageFileId(self):
+            return self.item['largeImage']['fileId']
+
         def _getLargeImagePath(self):
             try:
-                largeImageFileId = self.item['largeImage']['fileId']
-                # Access control checking should already have been done on
-                # item, so don't repeat.
-                # TODO: is it possible that the file is on a different item, so
-                # do we want to repeat the access check?
+                largeImageFileId = self._getLargeImageFileId()
+            except KeyError as e:
+                raise TileSourceException(
+                    'No large image file in this item: %s' % e.message)
+            return self._getFilePath(largeImageFileId)
+
+        @staticmethod
+        def _getFilePath(fileId):
+            """
+            Get the local path of a Girder file.
+
+            :param fileId: the id of the file.
+            :returns: the path of the file.
+            """
+            # Access control checking should already have been done on
+            # item, so don't repeat.
+            # TODO: is it possible that the file is on a different item, so
+            # do we want to repeat the access check?
+            try:
                 largeImageFile = ModelImporter.model('file').load(
-                    largeImageFileId, force=True)
+                    fileId, force=True)
+            except ValidationException as e:
+                raise TileSourceException(
+                    'No large image file in this item: %s' % e.message)
+            return GirderTileSource._getFileObjPath(largeImageFile)
 
+        @staticmethod
+        def _getFileObjPath(largeImageFile):
+            """
+            Get the local path of a Girder file document.
+
+            :param largeImageFile: the file document.
+            :returns: the path of the file.
+            """
+            try:
                 # TODO: can we move some of this logic into Girder core?
                 assetstore = ModelImporter.model('assetstore').load(
                     largeImageFile['assetstoreId'])
@@ -412,6 +813,16 @@ if girder:
                 raise TileSourceException(
                     'No large image file in this item: %s' % e.message)
 
+        @classmethod
+        def sniffSource(cls, item, sniffInfo=None):
+            if sniffInfo is None:
+                name, _, header = _getSourceFileInfo(item, True)
+                sniffInfo = (name, header)
+            if sniffInfo[1] is None:
+                # Let the constructor report the problem
+                return SniffUnknown
+            return cls.sniff(*sniffInfo)
+
 
 def getTileSourceFromDict(availableSources, pathOrUri, user=None, *args,
                           **kwargs):
@@ -426,25 +837,56 @@ def getTileSourceFromDict(availableSources, pathOrUri, user=None, *args,
     :param user: user used for access for girder items.  Ignored otherwise.
     :returns: a tile source instance or and error.
     """
-    sourceObj = pathOrUri
     uriWithoutProtocol = pathOrUri.split('://', 1)[-1]
-    isGirder = pathOrUri.startswith('girder_item://')
-    if isGirder and girder:
-        sourceObj = ModelImporter.model('item').load(
-            uriWithoutProtocol, user=user, level=AccessType.READ)
-    isLargeImageUri = pathOrUri.startswith('large_image://')
-    for sourceName in availableSources:
-        useSource = False
-        girderSource = getattr(availableSources[sourceName], 'girderSource',
-                               False)
-        if isGirder:
-            if girderSource:
-                useSource = availableSources[sourceName].canRead(sourceObj)
-        elif isLargeImageUri:
-            if sourceName == uriWithoutProtocol:
-                useSource = True
-        elif not girderSource:
-            useSource = availableSources[sourceName].canRead(sourceObj)
-        if useSource:
-            return availableSources[sourceName](sourceObj, *args, **kwargs)
+    if pathOrUri.startswith('large_image://'):
+        if uriWithoutProtocol in availableSources:
+            return availableSources[uriWithoutProtocol](
+                pathOrUri, *args, **kwargs)
+    elif pathOrUri.startswith('girder_item://'):
+        if girder:
+            item = ModelImporter.model('item').load(
+                uriWithoutProtocol, user=user, level=AccessType.READ)
+            for sourceName in rankSources(availableSources, item, True):
+                try:
+                    return availableSources[sourceName](item, *args, **kwargs)
+                except TileSourceException:
+                    pass
+    else:
+        return _getFileTileSource(availableSources, pathOrUri, *args,
+                                  **kwargs)
     raise TileSourceException('No available tilesource for %s' % pathOrUri)
+
+
+def _getFileTileSource(availableSources, path, *args, **kwargs):
+    """
+    Get a tile source for a file.  Sources are tried from the most to the least
+    likely, and the source that worked is remembered until the file changes.
+
+    :param availableSources: an ordered dictionary of sources to try.
+    :param path: the path of the file.
+    :returns: a tile source instance or and error.
+    """
+    try:
+        stat = os.stat(path)
+        cacheKey = (path, stat.st_mtime, stat.st_size)
+    except (OSError, TypeError):
+        cacheKey = None
+    sourceName = _sourceNameCache.get(cacheKey) if cacheKey else None
+    if sourceName is False:
+        raise TileSourceException('No available tilesource for %s' % path)
+    if sourceName in availableSources:
+        try:
+            return availableSources[sourceName](path, *args, **kwargs)
+        except TileSourceException:
+            pass
+    for sourceName in rankSources(availableSources, path):
+        try:
+            source = availableSources[sourceName](path, *args, **kwargs)
+        except TileSourceException:
+            continue
+        if cacheKey:
+            _sourceNameCache.put(cacheKey, sourceName)
+        return source
+    if cacheKey:
+        _sourceNameCache.put(cacheKey, False)
+    raise TileSourceException('No available tilesource for %s' % path)
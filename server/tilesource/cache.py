@@ -17,7 +17,12 @@
 #  limitations under the License.
 ###############################################################################
 
+import errno
 import functools
+import hashlib
+import os
+import shutil
+import tempfile
 
 import six
 import repoze.lru
@@ -132,3 +137,85 @@ class instanceLruCache(object):  # noqa - N801
             return value
 
         return functools.update_wrapper(wrapper, func)
+
+
+class DiskTileStore(object):
+    """
+    A persistent store of encoded tiles on disk.  Tiles are grouped by a
+    source id, such as the id of the file they were generated from, so that
+    all tiles of a source can be removed at once.  Within a source, tiles are
+    grouped by a key describing the options used to generate them.
+    """
+    def __init__(self, root):
+        """
+        :param root: the directory in which to store tiles.  It is created if
+            necessary.
+        """
+        self.root = root
+
+    def _path(self, sourceId, key, x, y, z):
+        keyHash = hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+        return os.path.join(
+            self.root, str(sourceId), keyHash, str(z), str(x), str(y))
+
+    def get(self, sourceId, key, x, y, z):
+        """
+        Get a tile from the store.
+
+        :param sourceId: the id of the tile source.
+        :param key: a key with a stable repr describing the tile options.
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :returns: a (tileData, tileMimeType) tuple or None if the tile is not
+            stored.
+        """
+        try:
+            with open(self._path(sourceId, key, x, y, z), 'rb') as f:
+                # The mime type is stored on the first line of the file.
+                # Reading the rest separately avoids copying the tile data
+                # out of the whole file.
+                mimeType = f.readline()[:-1]
+                tileData = f.read()
+        except IOError:
+            return None
+        return tileData, mimeType.decode('utf8')
+
+    def contains(self, sourceId, key, x, y, z):
+        """
+        Check if a tile is in the store without reading it.  See get for
+        parameters.
+
+        :returns: True if the tile is stored.
+        """
+        return os.path.isfile(self._path(sourceId, key, x, y, z))
+
+    def put(self, sourceId, key, x, y, z, tileData, tileMimeType):
+        """
+        Add a tile to the store.  See get for parameters.
+
+        :param tileData: the encoded tile.
+        :param tileMimeType: the mime type of the tile.
+        """
+        path = self._path(sourceId, key, x, y, z)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        # Write to a temporary file and rename it so that readers never see
+        # a partial tile.
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(tileMimeType.encode('utf8') + b'\n')
+            f.write(tileData)
+        os.rename(tempPath, path)
+
+    def remove(self, sourceId):
+        """
+        Remove all tiles of a source from the store.
+
+        :param sourceId: the id of the tile source.
+        """
+        shutil.rmtree(os.path.join(self.root, str(sourceId)),
+                      ignore_errors=True)
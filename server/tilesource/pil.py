@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import collections
+import math
+import threading
+
+import numpy
+import PIL.Image
+import six
+
+from .base import FileTileSource, TileSourceException
+from .cache import LruCacheMetaclass
+from ..tiff_writer import canDecodeRows, decodeRows, openLargeImage, \
+    reduceRows
+
+try:
+    import girder
+    from .base import GirderTileSource
+except ImportError:
+    girder = None
+
+
+# Largest strip or tile of an image, in pixels, that will be decoded at once
+DefaultMaxPixels = 16 * 1024 * 1024
+
+
+@six.add_metaclass(LruCacheMetaclass)
+class PILFileTileSource(FileTileSource):
+    """
+    Provides tile access to images that PIL can decode a few rows at a time,
+    such as uncompressed images and TIFFs stored in strips or tiles.  Each
+    row of tiles is decoded or reduced from the next higher resolution level
+    when it is first needed, and recently used rows of tiles are kept up to
+    bandCacheSize bytes.  This is used to show images that are being
+    converted to tiled TIFFs, so it isn't one of the available sources.
+    """
+    cacheMaxSize = 2
+    cacheTimeout = 60
+    # Bytes of decoded and reduced rows of tiles kept by each source
+    bandCacheSize = 64 * 1024 * 1024
+
+    @staticmethod
+    def cacheKeyFunc(args, kwargs):
+        path = args[0]
+        return (path,
+                kwargs.get('jpegQuality'),
+                kwargs.get('jpegSubsampling'),
+                kwargs.get('encoding'))
+
+    def __init__(self, path, jpegQuality=95, jpegSubsampling=0,
+                 encoding='JPEG', maxPixels=DefaultMaxPixels, **kwargs):
+        """
+        Initialize the tile class.
+
+        :param path: the associated file path.
+        :param jpegQuality: when serving jpegs, use this quality.
+        :param jpegSubsampling: when serving jpegs, use this subsampling (0 is
+                                full chroma, 1 is half, 2 is quarter).
+        :param encoding: 'JPEG', 'PNG', or, if PIL supports it, 'WEBP'.
+        :param maxPixels: images with strips or tiles that have more pixels
+                          than this are not read.  None for no limit.
+        """
+        super(PILFileTileSource, self).__init__(path, **kwargs)
+
+        if encoding not in self.outputMimeTypes:
+            raise ValueError('Invalid encoding "%s"' % encoding)
+
+        self.encoding = encoding
+        self.jpegQuality = int(jpegQuality)
+        self.jpegSubsampling = int(jpegSubsampling)
+
+        self._largeImagePath = self._getLargeImagePath()
+        try:
+            image = openLargeImage(self._largeImagePath)
+        except (IOError, ValueError):
+            raise TileSourceException('File cannot be opened via PIL.')
+        self.sizeX, self.sizeY = image.size
+        if self.sizeX <= 0 or self.sizeY <= 0:
+            raise TileSourceException('PIL image size is invalid.')
+        if not canDecodeRows(image, maxPixels):
+            raise TileSourceException(
+                'PIL image cannot be decoded a few rows at a time.')
+        self.tileWidth = self.tileHeight = 256
+        self.levels = int(math.ceil(max(
+            math.log(float(self.sizeX) / self.tileWidth),
+            math.log(float(self.sizeY) / self.tileHeight)) / math.log(2))) + 1
+        self.levels = max(1, self.levels)
+        # Rows of tiles as numpy arrays, keyed by (level, row), from least to
+        # most recently used.  The lock is only held to use the dictionary, so
+        # requests don't wait for each other's decoding.
+        self._bands = collections.OrderedDict()
+        self._bandBytes = 0
+        self._bandLock = threading.Lock()
+
+    def _getBand(self, z, y):
+        """
+        Get a row of tiles of a level, decoding it from the image or reducing
+        two rows of tiles of the next higher resolution level as needed.
+
+        :param z: the level number.
+        :param y: the row of tiles within the level.
+        :returns: a numpy array of shape (height, width, 3), where width is
+            the width of the level and height is at most the tile height.
+        """
+        key = (z, y)
+        with self._bandLock:
+            band = self._bands.pop(key, None)
+            if band is not None:
+                self._bands[key] = band
+                return band
+        if z == self.levels - 1:
+            top = y * self.tileHeight
+            band = numpy.asarray(decodeRows(
+                self._largeImagePath, top,
+                min(self.sizeY, top + self.tileHeight)).convert('RGB'))
+        else:
+            scale = 2 ** (self.levels - 2 - z)
+            levelHeight = -(-self.sizeY // scale)
+            rows = [self._getBand(z + 1, y * 2)]
+            if (y * 2 + 1) * self.tileHeight < levelHeight:
+                rows.append(self._getBand(z + 1, y * 2 + 1))
+            band = reduceRows(numpy.concatenate(rows))
+        with self._bandLock:
+            if key not in self._bands:
+                self._bands[key] = band
+                self._bandBytes += band.nbytes
+            while self._bandBytes > self.bandCacheSize and self._bands:
+                self._bandBytes -= self._bands.popitem(last=False)[1].nbytes
+        return band
+
+    def getTile(self, x, y, z, pilImageAllowed=False, **kwargs):
+        if not (0 <= z < self.levels):
+            raise TileSourceException('z layer does not exist')
+        scale = 2 ** (self.levels - 1 - z)
+        if not (0 <= x * self.tileWidth * scale < self.sizeX):
+            raise TileSourceException('x is outside layer')
+        if not (0 <= y * self.tileHeight * scale < self.sizeY):
+            raise TileSourceException('y is outside layer')
+        data = self._getBand(z, y)[
+            :, x * self.tileWidth:(x + 1) * self.tileWidth]
+        # Edge tiles are padded like the tiles of a tiled TIFF
+        tile = numpy.zeros((self.tileHeight, self.tileWidth, 3), numpy.uint8)
+        tile[:data.shape[0], :data.shape[1]] = data
+        tile = PIL.Image.fromarray(tile, 'RGB')
+        if pilImageAllowed:
+            return tile
+        output = six.BytesIO()
+        tile.save(output, self.encoding, quality=self.jpegQuality,
+                  subsampling=self.jpegSubsampling)
+        return output.getvalue()
+
+    def getTileMimeType(self):
+        return self.outputMimeTypes[self.encoding]
+
+
+if girder:
+    class PILGirderTileSource(PILFileTileSource, GirderTileSource):
+        """
+        Provides tile access to the original file of a Girder item while it is
+        being converted to a tiled TIFF.
+        """
+        cacheMaxSize = 2
+        cacheTimeout = 60
+
+        @staticmethod
+        def cacheKeyFunc(args, kwargs):
+            item = args[0]
+            return (item.get('largeImage', {}).get('originalId'),
+                    kwargs.get('jpegQuality'),
+                    kwargs.get('jpegSubsampling'),
+                    kwargs.get('encoding'))
+
+        def _getLargeImageFileId(self):
+            return self.item['largeImage']['originalId']
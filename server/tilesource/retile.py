@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import math
+
+import numpy
+import PIL.Image
+import six
+
+from .base import TileSource, TileSourceException
+from .cache import LruCacheMetaclass, instanceLruCache
+from ..constants import MaxTileSize
+
+
+# Number of decoded tiles of the original source to keep for assembling
+# tiles.  A tile that overlaps its neighbors needs up to nine of them.
+SourceTileCacheSize = 64
+# Number of assembled and encoded tiles to keep
+RetiledTileCacheSize = 256
+
+
+@six.add_metaclass(LruCacheMetaclass)
+class RetiledTileSource(TileSource):
+    """
+    Serve the tiles of another tile source with a different tile size and,
+    optionally, with tiles that overlap their neighbors.  The levels are the
+    same as those of the original source.  Each tile is assembled by copying
+    the parts of the original tiles it covers, so nothing is resampled.
+
+    Like the tiles of a tiled TIFF, every tile has the same size.  Pixel
+    (overlap, overlap) of tile (x, y) is pixel (x * tileSize, y * tileSize)
+    of its level, and parts of a tile outside of the image are black.
+    """
+    # The original source is part of the key, so it is kept as long as this
+    # is.
+    cacheMaxSize = 16
+    cacheTimeout = 300
+
+    def __init__(self, source, tileSize, overlap=0):
+        """
+        Initialize the tile class.
+
+        :param source: the tile source whose tiles are served.
+        :param tileSize: the width and height of the tiles without overlap.
+            This is at most MaxTileSize.
+        :param overlap: the number of pixels each tile shares with the tiles
+            on each side of it.  This is less than the tile size.
+        """
+        super(RetiledTileSource, self).__init__()
+        if not 1 <= tileSize <= MaxTileSize or not 0 <= overlap < tileSize:
+            raise TileSourceException('Invalid tile size or overlap.')
+        self.source = source
+        self.overlap = overlap
+        metadata = source.getMetadata()
+        self.levels = metadata['levels']
+        self.sizeX = metadata['sizeX']
+        self.sizeY = metadata['sizeY']
+        self.tileWidth = self.tileHeight = tileSize
+        self._sourceTileWidth = metadata['tileWidth']
+        self._sourceTileHeight = metadata['tileHeight']
+        # Pass the original tiles through when they are already what is
+        # asked for
+        self._sameTiles = (overlap == 0 and
+                           self._sourceTileWidth == tileSize and
+                           self._sourceTileHeight == tileSize)
+        mimeType = source.getTileMimeType()
+        self.encoding = 'JPEG'
+        for encoding, encodingMimeType in six.iteritems(
+                self.outputMimeTypes):
+            if encodingMimeType == mimeType:
+                self.encoding = encoding
+        self.jpegQuality = getattr(source, 'jpegQuality', 95)
+        self.jpegSubsampling = getattr(source, 'jpegSubsampling', 0)
+
+    def getMetadata(self):
+        metadata = self.source.getMetadata()
+        metadata.update({
+            'tileWidth': self.tileWidth,
+            'tileHeight': self.tileHeight,
+            'tileOverlap': self.overlap,
+        })
+        return metadata
+
+    def getTileMimeType(self):
+        return self.source.getTileMimeType()
+
+    @instanceLruCache(SourceTileCacheSize)
+    def _getSourceTile(self, x, y, z, sparseFallback):
+        """
+        Get the pixels of a tile of the original source.
+
+        :returns: a numpy uint8 array of shape (height, width, 3).
+        """
+        tile = self.source.getTile(x, y, z, pilImageAllowed=True,
+                                   sparseFallback=sparseFallback)
+        if not isinstance(tile, PIL.Image.Image):
+            tile = PIL.Image.open(six.BytesIO(tile))
+        if tile.mode != 'RGB':
+            tile = tile.convert('RGB')
+        return numpy.asarray(tile)
+
+    def _assembleTile(self, x, y, z, sparseFallback):
+        """
+        Copy the parts of the original tiles that a tile covers.
+
+        :returns: a PIL image.
+        """
+        if not (0 <= z < self.levels):
+            raise TileSourceException('z layer does not exist')
+        scale = 2 ** (self.levels - 1 - z)
+        levelWidth = int(math.ceil(float(self.sizeX) / scale))
+        levelHeight = int(math.ceil(float(self.sizeY) / scale))
+        if not (0 <= x * self.tileWidth < levelWidth):
+            raise TileSourceException('x is outside layer')
+        if not (0 <= y * self.tileHeight < levelHeight):
+            raise TileSourceException('y is outside layer')
+        size = self.tileWidth + 2 * self.overlap
+        tile = numpy.zeros((size, size, 3), dtype=numpy.uint8)
+        # The part of the level in the tile
+        left = x * self.tileWidth - self.overlap
+        top = y * self.tileHeight - self.overlap
+        x0, x1 = max(0, left), min(levelWidth, left + size)
+        y0, y1 = max(0, top), min(levelHeight, top + size)
+        sourceWidth, sourceHeight = \
+            self._sourceTileWidth, self._sourceTileHeight
+        for sy in range(y0 // sourceHeight, (y1 - 1) // sourceHeight + 1):
+            for sx in range(x0 // sourceWidth, (x1 - 1) // sourceWidth + 1):
+                sourceTile = self._getSourceTile(sx, sy, z, sparseFallback)
+                # The part of the level shared by this source tile and the
+                # tile
+                px0 = max(x0, sx * sourceWidth)
+                px1 = min(x1, (sx + 1) * sourceWidth)
+                py0 = max(y0, sy * sourceHeight)
+                py1 = min(y1, (sy + 1) * sourceHeight)
+                tile[py0 - top:py1 - top, px0 - left:px1 - left] = \
+                    sourceTile[py0 - sy * sourceHeight:py1 - sy * sourceHeight,
+                               px0 - sx * sourceWidth:px1 - sx * sourceWidth]
+        return PIL.Image.fromarray(tile, 'RGB')
+
+    @instanceLruCache(RetiledTileCacheSize)
+    def _getEncodedTile(self, x, y, z, sparseFallback):
+        return self._encodeImage(
+            self._assembleTile(x, y, z, sparseFallback), self.encoding,
+            self.jpegQuality, self.jpegSubsampling)[0]
+
+    def getTile(self, x, y, z, pilImageAllowed=False, sparseFallback=False,
+                **kwargs):
+        if self._sameTiles:
+            return self.source.getTile(
+                x, y, z, pilImageAllowed=pilImageAllowed,
+                sparseFallback=sparseFallback)
+        if pilImageAllowed:
+            return self._assembleTile(x, y, z, sparseFallback)
+        return self._getEncodedTile(x, y, z, sparseFallback)
+
+    # Regions and thumbnails don't depend on the tile grid, so they come
+    # from the original source.
+    def getRegion(self, *args, **kwargs):
+        return self.source.getRegion(*args, **kwargs)
+
+    def getThumbnail(self, *args, **kwargs):
+        return self.source.getThumbnail(*args, **kwargs)
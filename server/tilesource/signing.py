@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+import six
+
+from .base import TileSourceException
+
+
+def _encode(data):
+    """
+    Encode bytes as unpadded URL-safe base64.
+
+    :param data: the bytes to encode.
+    :returns: an ascii string.
+    """
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _decode(text):
+    """
+    Decode unpadded URL-safe base64.
+
+    :param text: the string to decode.
+    :returns: the decoded bytes.
+    """
+    text = text.encode('ascii')
+    return base64.urlsafe_b64decode(text + b'=' * (-len(text) % 4))
+
+
+def _signature(secret, message):
+    if isinstance(secret, six.text_type):
+        secret = secret.encode('utf8')
+    return hmac.new(secret, message, hashlib.sha256).digest()
+
+
+def signToken(secret, payload, expires):
+    """
+    Create a token that proves that whoever holds the secret granted access
+    to something until a time.  The token can be verified without any other
+    state, and can be used in URLs.
+
+    :param secret: the shared secret.
+    :param payload: a dictionary describing what the token grants access to.
+        It must be serializable as JSON.  The token's contents are readable by
+        anyone who has it.
+    :param expires: the time, in seconds since the epoch, after which the
+        token is no longer valid.
+    :returns: the token string.
+    """
+    payload = dict(payload, exp=int(expires))
+    message = _encode(json.dumps(
+        payload, sort_keys=True, separators=(',', ':')).encode('utf8'))
+    return '%s.%s' % (message, _encode(_signature(
+        secret, message.encode('ascii'))))
+
+
+def verifyToken(secret, token, now=None):
+    """
+    Check that a token was signed with a secret and hasn't expired.
+
+    :param secret: the shared secret.
+    :param token: the token string.
+    :param now: the current time in seconds since the epoch.  None to use
+        the system time.
+    :returns: the token's payload dictionary, including its expiration time
+        as exp.
+    """
+    try:
+        message, signature = token.split('.')
+        valid = hmac.compare_digest(
+            _signature(secret, message.encode('ascii')), _decode(signature))
+        payload = json.loads(_decode(message).decode('utf8')) \
+            if valid else None
+    except (ValueError, TypeError, UnicodeError, AttributeError):
+        valid = False
+    if not valid or not isinstance(payload, dict) or not isinstance(
+            payload.get('exp'), six.integer_types):
+        raise TileSourceException('Invalid token.')
+    if payload['exp'] < (time.time() if now is None else now):
+        raise TileSourceException('The token has expired.')
+    return payload
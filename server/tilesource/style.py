@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import six
+
+from .base import TileSourceException
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Named colors that a channel can be mapped to.  Each channel is displayed as
+# a ramp from black to its color.
+ColormapColors = {
+    'gray': (255, 255, 255),
+    'grey': (255, 255, 255),
+    'white': (255, 255, 255),
+    'red': (255, 0, 0),
+    'green': (0, 255, 0),
+    'blue': (0, 0, 255),
+    'cyan': (0, 255, 255),
+    'magenta': (255, 0, 255),
+    'yellow': (255, 255, 0),
+}
+
+# The colors used for channels without a colormap when compositing more than
+# one channel
+DefaultChannelColors = ('red', 'green', 'blue', 'cyan', 'magenta', 'yellow',
+                        'white')
+
+
+def _parseList(value, valueType, name):
+    """
+    Parse a style parameter that has a value per channel.
+
+    :param value: None, a single value, a list, or a comma-separated string.
+    :param valueType: a function to convert each value.
+    :param name: the name of the parameter for error messages.
+    :returns: None or a tuple of values.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, six.string_types):
+        value = value.split(',')
+    elif not isinstance(value, (list, tuple)):
+        value = [value]
+    try:
+        return tuple(valueType(entry) for entry in value)
+    except ValueError:
+        raise TileSourceException('Invalid "%s" style parameter.' % name)
+
+
+def _colormapLut(colormap):
+    """
+    Get the lookup table for a colormap.
+
+    :param colormap: a color name or a hex color of the form #rrggbb.
+    :returns: a numpy array of shape (256, 3) with the color of each value.
+    """
+    colormap = colormap.strip().lower()
+    if colormap in ColormapColors:
+        color = ColormapColors[colormap]
+    elif colormap.startswith('#') and len(colormap) == 7:
+        try:
+            color = tuple(int(colormap[pos:pos + 2], 16)
+                          for pos in (1, 3, 5))
+        except ValueError:
+            raise TileSourceException('Invalid colormap "%s".' % colormap)
+    else:
+        raise TileSourceException('Invalid colormap "%s".' % colormap)
+    return (numpy.arange(256, dtype=numpy.uint16)[:, numpy.newaxis] *
+            numpy.array(color, dtype=numpy.uint16) // 255)
+
+
+class TileStyle(object):
+    """
+    How to display the channels of high bit depth or multichannel tiles.
+    Each displayed channel is windowed to a minimum and maximum value, mapped
+    through a colormap, and added to the other displayed channels.
+    """
+    def __init__(self, channels=None, windowMin=None, windowMax=None,
+                 colormap=None):
+        """
+        Any parameter may be a list or a comma-separated string.  Values that
+        are per channel are in the same order as the displayed channels.
+
+        :param channels: the indices of the channels to display.  None to
+            display all channels.
+        :param windowMin: the value of each channel that is shown as black.
+            If a single value is given, it is used for all channels.  None to
+            use 0.
+        :param windowMax: the value of each channel that is shown at full
+            intensity.  If a single value is given, it is used for all
+            channels.  None to use the largest value of the data type, or 1
+            for floating point data.
+        :param colormap: the colormap of each channel.  None to use gray for
+            single channels, the original colors of RGB images, and
+            DefaultChannelColors otherwise.
+        """
+        if numpy is None:
+            raise TileSourceException('numpy is required to style tiles.')
+        self.channels = _parseList(channels, int, 'channels')
+        self.windowMin = _parseList(windowMin, float, 'windowMin')
+        self.windowMax = _parseList(windowMax, float, 'windowMax')
+        colormap = _parseList(colormap, str, 'colormap')
+        self.luts = [_colormapLut(entry) for entry in colormap] \
+            if colormap else None
+
+    def _perChannel(self, values, count, default):
+        if not values:
+            return [default] * count
+        if len(values) == 1:
+            return list(values) * count
+        if len(values) != count:
+            raise TileSourceException(
+                'Style parameters must have one value per channel.')
+        return list(values)
+
+    def apply(self, tile):
+        """
+        Convert a tile to an 8-bit RGB image.
+
+        :param tile: a numpy array of shape (height, width, channels).
+        :returns: a numpy uint8 array of shape (height, width, 3).
+        """
+        channels = self.channels
+        if channels is None:
+            channels = list(range(tile.shape[2]))
+        if any(channel < 0 or channel >= tile.shape[2]
+               for channel in channels):
+            raise TileSourceException('Style channel does not exist.')
+        luts = self.luts
+        if luts is None:
+            if len(channels) == 1:
+                names = ['gray']
+            elif len(channels) == 3 and tile.shape[2] in (3, 4):
+                names = ['red', 'green', 'blue']
+            else:
+                names = [DefaultChannelColors[idx % len(DefaultChannelColors)]
+                         for idx in range(len(channels))]
+            luts = [_colormapLut(name) for name in names]
+        luts = self._perChannel(luts, len(channels), None)
+        if tile.dtype.kind == 'f':
+            dtypeMax = 1.0
+        else:
+            dtypeMax = float(numpy.iinfo(tile.dtype).max)
+        windowMin = self._perChannel(self.windowMin, len(channels), 0.0)
+        windowMax = self._perChannel(self.windowMax, len(channels), dtypeMax)
+
+        result = numpy.zeros(tile.shape[:2] + (3, ), dtype=numpy.uint16)
+        for idx, channel in enumerate(channels):
+            low, high = windowMin[idx], windowMax[idx]
+            scale = 255.0 / (high - low) if high != low else 0
+            values = tile[:, :, channel].astype(numpy.float32)
+            values -= low
+            values *= scale
+            numpy.clip(values, 0, 255, out=values)
+            result += luts[idx][values.astype(numpy.uint8)]
+        numpy.clip(result, 0, 255, out=result)
+        return result.astype(numpy.uint8)
+
+
+def getTileStyle(channels=None, windowMin=None, windowMax=None,
+                 colormap=None):
+    """
+    Get a tile style from style parameters.  See TileStyle for parameters.
+
+    :returns: a TileStyle, or None if no style parameters were given.
+    """
+    if all(value is None or value == '' for value in (
+            channels, windowMin, windowMax, colormap)):
+        return None
+    return TileStyle(channels, windowMin, windowMax, colormap)
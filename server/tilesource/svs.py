@@ -18,6 +18,7 @@
 ###############################################################################
 
 import math
+import os
 import six
 
 from six import BytesIO
@@ -26,7 +27,8 @@ from six.moves import range
 import openslide
 import PIL
 
-from .base import FileTileSource, TileSourceException
+from .base import FileTileSource, TileSourceException, SniffNo, \
+    SniffUnknown, SniffLikely, TiffSignatures, getUniformColor
 from .cache import LruCacheMetaclass
 
 try:
@@ -36,6 +38,13 @@ except ImportError:
     girder = None
 
 
+# Extensions of TIFF-based formats that are better read by OpenSlide than as
+# generic tiled TIFFs
+OpenSlideTiffExtensions = ('.svs', '.ndpi', '.scn', '.bif')
+# Extensions of formats that OpenSlide reads that aren't TIFF files
+OpenSlideOtherExtensions = ('.vms', '.vmu', '.mrxs', '.svslide')
+
+
 @six.add_metaclass(LruCacheMetaclass)
 class SVSFileTileSource(FileTileSource):
     """
@@ -53,6 +62,14 @@ class SVSFileTileSource(FileTileSource):
                 kwargs.get('jpegSubsampling'),
                 kwargs.get('encoding'))
 
+    @classmethod
+    def sniff(cls, path, header):
+        ext = os.path.splitext(path)[1].lower()
+        if header[:4] in TiffSignatures:
+            return SniffLikely if ext in OpenSlideTiffExtensions else \
+                SniffUnknown
+        return SniffLikely if ext in OpenSlideOtherExtensions else SniffNo
+
     def __init__(self, path, jpegQuality=95, jpegSubsampling=0,
                  encoding='JPEG', **kwargs):
         """
@@ -62,11 +79,11 @@ class SVSFileTileSource(FileTileSource):
         :param jpegQuality: when serving jpegs, use this quality.
         :param jpegSubsampling: when serving jpegs, use this subsampling (0 is
                                 full chroma, 1 is half, 2 is quarter).
-        :param encoding: 'JPEG' or 'PNG'.
+        :param encoding: 'JPEG', 'PNG', or, if PIL supports it, 'WEBP'.
         """
         super(SVSFileTileSource, self).__init__(path, **kwargs)
 
-        if encoding not in ('PNG', 'JPEG'):
+        if encoding not in self.outputMimeTypes:
             raise ValueError('Invalid encoding "%s"' % encoding)
 
         self.encoding = encoding
@@ -105,6 +122,10 @@ class SVSFileTileSource(FileTileSource):
         if self.levels < 1:
             raise TileSourceException(
                 'OpenSlide image must have at least one level.')
+        # The colors of tiles that have been read and are a single color,
+        # keyed by (x, y, z).  OpenSlide doesn't expose the stored size of
+        # tiles, so tiles are recorded as they are read.
+        self._uniformTiles = {}
         self._svslevels = []
         svsLevelDimensions = self._openslide.level_dimensions
         # Precompute which SVS level should be used for our tile levels.  SVS
@@ -151,6 +172,12 @@ class SVSFileTileSource(FileTileSource):
         offsety = y * self.tileHeight * scale
         if not (0 <= offsety < self.sizeY):
             raise TileSourceException('y is outside layer')
+        color = self._uniformTiles.get((x, y, z))
+        if color is not None:
+            if pilImageAllowed:
+                return PIL.Image.new(
+                    'RGB', (self.tileWidth, self.tileHeight), color)
+            return self._getConstantTile(color)
         # We ask to read an area that will cover the tile at the z level.  The
         # scale we computed in the __init__ process for this svs level tells
         # how much larger a region we need to read.
@@ -162,6 +189,9 @@ class SVSFileTileSource(FileTileSource):
         if svslevel['scale'] != 1:
             tile = tile.resize((self.tileWidth, self.tileHeight),
                                PIL.Image.LANCZOS)
+        color = getUniformColor(tile)
+        if color is not None:
+            self._uniformTiles[(x, y, z)] = color
         if pilImageAllowed:
             return tile
         output = BytesIO()
@@ -170,9 +200,19 @@ class SVSFileTileSource(FileTileSource):
         return output.getvalue()
 
     def getTileMimeType(self):
-        if self.encoding == 'JPEG':
-            return 'image/jpeg'
-        return 'image/png'
+        return self.outputMimeTypes[self.encoding]
+
+    def getUniformTileColor(self, x, y, z):
+        """
+        Check if a tile that has already been read is a single color.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :returns: an RGB tuple, or None if the tile hasn't been read or isn't a
+            single color.
+        """
+        return self._uniformTiles.get((x, y, z))
 
     def getPreferredLevel(self, level):
         """
@@ -23,7 +23,9 @@ from .base import TileSource, TileSourceException
 
 import PIL
 from PIL import Image, ImageDraw, ImageFont
-if int(PIL.PILLOW_VERSION.split('.')[0]) < 3:
+# Pillow 7 removed PILLOW_VERSION
+if int(getattr(PIL, '__version__', getattr(
+        PIL, 'PILLOW_VERSION', '0')).split('.')[0]) < 3:
     raise ImportError('Pillow v3.0 or later is required')
 
 
@@ -47,7 +49,7 @@ class TestTileSource(TileSource):
             maxLevel and tileHeight if None.
         :param fractal: if True, and the tile size is square and a power of
             two, draw a simple fractal on the tiles.
-        :param encoding: 'PNG' or 'JPEG'.
+        :param encoding: 'PNG', 'JPEG', or, if PIL supports it, 'WEBP'.
         """
         super(TestTileSource, self).__init__()
 
@@ -63,7 +65,7 @@ class TestTileSource(TileSource):
                       if sizeX is None else sizeX)
         self.sizeY = (((2 ** self.maxLevel) * self.tileHeight)
                       if sizeY is None else sizeY)
-        if encoding not in ('PNG', 'JPEG'):
+        if encoding not in self.outputMimeTypes:
             raise ValueError('Invalid encoding "%s"' % encoding)
         self.encoding = encoding
         # Used for reporting tile information
@@ -140,6 +142,4 @@ class TestTileSource(TileSource):
         return output.getvalue()
 
     def getTileMimeType(self):
-        if self.encoding == 'JPEG':
-            return 'image/jpeg'
-        return 'image/png'
+        return self.outputMimeTypes[self.encoding]
@@ -22,8 +22,10 @@ import itertools
 import six
 from six import BytesIO
 
-from .base import FileTileSource, TileSourceException
-from .cache import LruCacheMetaclass
+from .base import FileTileSource, TileSourceException, SniffNo, \
+    SniffLikely, TiffSignatures, getUniformColor
+from .cache import LruCacheMetaclass, instanceLruCache
+from .style import TileStyle, getTileStyle
 from .tiff_reader import TiledTiffDirectory, TiffException, \
     InvalidOperationTiffException, IOTiffException
 
@@ -36,11 +38,26 @@ except ImportError:
     import logging as logger
 
 try:
-    import PIL
+    import PIL.Image
 except ImportError:
     PIL = None
 
 
+# The number of re-encoded tiles kept by each tile source
+EncodedTileCacheSize = 256
+# The number of decoded tiles kept by each tile source for generating missing
+# tiles in sparse files
+ParentTileCacheSize = 16
+# Tiles are only checked for being a single color if their stored size is no
+# more than this factor times the smallest tile of their level and no more
+# than one byte per this many pixels.
+UniformTileSizeFactor = 1.25
+UniformTilePixelsPerByte = 16
+
+# PIL modes for decoded tiles by the number of samples per pixel
+SampleModes = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
+
+
 @six.add_metaclass(LruCacheMetaclass)
 class TiffFileTileSource(FileTileSource):
     """
@@ -53,11 +70,60 @@ class TiffFileTileSource(FileTileSource):
     @staticmethod
     def cacheKeyFunc(args, kwargs):
         path = args[0]
-        return path
+        return (path,
+                kwargs.get('jpegQuality'),
+                kwargs.get('jpegSubsampling'),
+                kwargs.get('encoding'),
+                kwargs.get('channels'),
+                kwargs.get('windowMin'),
+                kwargs.get('windowMax'),
+                kwargs.get('colormap'))
+
+    @classmethod
+    def sniff(cls, path, header):
+        return SniffLikely if header[:4] in TiffSignatures else SniffNo
 
-    def __init__(self, item, **kwargs):
+    def __init__(self, item, jpegQuality=None, jpegSubsampling=0,
+                 encoding='JPEG', channels=None, windowMin=None,
+                 windowMax=None, colormap=None, **kwargs):
+        """
+        Initialize the tile class.
+
+        :param item: the associated file path or Girder item.
+        :param jpegQuality: the quality of encoded JPEG and WebP tiles.  If
+                            this is given, tiles that are stored as JPEGs
+                            are re-encoded with it.  Otherwise, 95 is used
+                            for tiles that must be encoded.
+        :param jpegSubsampling: when re-encoding jpegs, use this subsampling
+                                (0 is full chroma, 1 is half, 2 is quarter).
+        :param encoding: 'JPEG', 'PNG', or, if PIL supports it, 'WEBP'.
+                         Tiles that are stored as JPEGs are served without
+                         re-encoding them if this is 'JPEG' and no quality is
+                         given.
+        :param channels: the channels to display.  This and the other style
+                         parameters may be lists or comma-separated strings.
+                         See style.TileStyle.
+        :param windowMin: the value of each channel that is shown as black.
+        :param windowMax: the value of each channel that is shown at full
+                          intensity.
+        :param colormap: the colormap of each channel.
+        """
         super(TiffFileTileSource, self).__init__(item, **kwargs)
 
+        if encoding not in self.outputMimeTypes:
+            raise ValueError('Invalid encoding "%s"' % encoding)
+
+        self.encoding = encoding
+        # Stored JPEGs are only transcoded when a quality is asked for
+        self._transcodeJpeg = jpegQuality is not None
+        self.jpegQuality = int(jpegQuality) if jpegQuality is not None else 95
+        self.jpegSubsampling = int(jpegSubsampling)
+        # Tiles that aren't 8-bit gray or RGB always need a style to be shown
+        self.style = getTileStyle(channels, windowMin, windowMax, colormap)
+        # The colors of tiles that were checked for being a single color,
+        # keyed by (x, y, z).  None for tiles with more than one color.
+        self._uniformTiles = {}
+
         largeImagePath = self._getLargeImagePath()
         lastException = None
 
@@ -67,8 +133,12 @@ class TiffFileTileSource(FileTileSource):
                 tiffDirectory = TiledTiffDirectory(largeImagePath, directoryNum)
             except TiffException as lastException:
                 break
-            else:
-                self._tiffDirectories.append(tiffDirectory)
+            # Stop at directories that aren't lower resolution levels, such
+            # as label or macro images.
+            if (self._tiffDirectories and tiffDirectory.imageWidth >=
+                    self._tiffDirectories[-1].imageWidth):
+                break
+            self._tiffDirectories.append(tiffDirectory)
 
         if not self._tiffDirectories:
             logger.info('File %s didn\'t meet requirements for tile source: '
@@ -87,26 +157,228 @@ class TiffFileTileSource(FileTileSource):
 
     def getTile(self, x, y, z, pilImageAllowed=False, sparseFallback=False,
                 **kwargs):
+        """
+        Get a tile.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :param pilImageAllowed: if True, a PIL image may be returned instead
+            of encoded data.
+        :param sparseFallback: if True and the tile has no data, generate it
+            from the closest lower resolution level that does.
+        :returns: the encoded tile or a PIL image.
+        """
         try:
-            return self._tiffDirectories[z].getTile(x, y)
+            if z < 0:
+                raise IndexError()
+            tiffDirectory = self._tiffDirectories[z]
+            # Sparse files leave tiles out; this is cheaper than failing to
+            # read them.
+            if tiffDirectory.isTileMissing(x, y):
+                raise IOTiffException('Tile has no data')
+            color = self.getUniformTileColor(x, y, z)
+            if color is not None:
+                if pilImageAllowed:
+                    return PIL.Image.new(
+                        'RGB', (self.tileWidth, self.tileHeight), color)
+                return self._getConstantTile(color)
+            if tiffDirectory.embeddedJpeg and self.style is None and ((
+                    self.encoding == 'JPEG' and not self._transcodeJpeg) or
+                    PIL is None):
+                return tiffDirectory.getTile(x, y)
+            if pilImageAllowed:
+                return self._getTileImage(x, y, z)
+            return self._getEncodedTile(x, y, z)
         except IndexError:
             raise TileSourceException('z layer does not exist')
         except InvalidOperationTiffException as e:
             raise TileSourceException(e.message)
         except IOTiffException as e:
-            if sparseFallback and pilImageAllowed and z and PIL:
-                image = self.getTile(x / 2, y / 2, z - 1, pilImageAllowed,
-                                     sparseFallback)
-                if not isinstance(image, PIL.Image.Image):
-                    image = PIL.Image.open(BytesIO(image))
-                image = image.crop((
-                    self.tileWidth / 2 if x % 2 else 0,
-                    self.tileHeight / 2 if y % 2 else 0,
-                    self.tileWidth if x % 2 else self.tileWidth / 2,
-                    self.tileHeight if y % 2 else self.tileHeight / 2))
-                image = image.resize((self.tileWidth, self.tileHeight))
-                return image
-            raise TileSourceException('Internal I/O failure: %s' % e.message)
+            error = e
+        image = None
+        if sparseFallback and z and PIL:
+            image = self._getFallbackTileImage(x, y, z)
+        if image is None:
+            raise TileSourceException('Internal I/O failure: %s' %
+                                      error.message)
+        if pilImageAllowed:
+            return image
+        return self._encodeImage(
+            image, self.encoding, self.jpegQuality, self.jpegSubsampling)[0]
+
+    @instanceLruCache(32)
+    def _getUniformTileCandidates(self, z):
+        """
+        Find the tiles of a level that are small enough that they might be a
+        single color.  This only reads the tile sizes.
+
+        :param z: the level.
+        :returns: a set of (x, y) tile positions.
+        """
+        tiffDirectory = self._tiffDirectories[z]
+        tilesAcross = (tiffDirectory.imageWidth + self.tileWidth - 1) // \
+            self.tileWidth
+        byteCounts = tiffDirectory.getTileByteCounts()
+        stored = [count for count in byteCounts if count]
+        if not stored:
+            return frozenset()
+        limit = min(min(stored) * UniformTileSizeFactor,
+                    self.tileWidth * self.tileHeight //
+                    UniformTilePixelsPerByte)
+        # Edge tiles are padded, so they are rarely a single color
+        fullAcross = tiffDirectory.imageWidth // self.tileWidth
+        fullDown = tiffDirectory.imageHeight // self.tileHeight
+        return frozenset(
+            (tileNum % tilesAcross, tileNum // tilesAcross)
+            for tileNum, count in enumerate(byteCounts)
+            if count and count <= limit and
+            tileNum % tilesAcross < fullAcross and
+            tileNum // tilesAcross < fullDown)
+
+    def getUniformTileColor(self, x, y, z):
+        """
+        Check if a tile is a single color.  Tiles are only decoded to check
+        if their size suggests that they might be, and each is only checked
+        once.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :returns: an RGB tuple, or None if the tile isn't a single color.
+        """
+        if PIL is None or not 0 <= z < self.levels:
+            return None
+        key = (x, y, z)
+        if key in self._uniformTiles:
+            return self._uniformTiles[key]
+        try:
+            if (x, y) not in self._getUniformTileCandidates(z):
+                return None
+            color = getUniformColor(self._getTileImage(x, y, z))
+        except TiffException:
+            return None
+        self._uniformTiles[key] = color
+        return color
+
+    def _getFallbackTileImage(self, x, y, z):
+        """
+        Generate a tile that has no data by scaling up part of the tile that
+        covers it in the closest lower resolution level with data.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :returns: a PIL image, or None if no lower resolution level has data.
+        """
+        for parentZ in range(z - 1, -1, -1):
+            scale = 2 ** (z - parentZ)
+            try:
+                parent = self._getParentTileImage(
+                    x // scale, y // scale, parentZ)
+            except TiffException:
+                continue
+            left = (x % scale) * self.tileWidth // scale
+            top = (y % scale) * self.tileHeight // scale
+            right = max(left + 1,
+                        (x % scale + 1) * self.tileWidth // scale)
+            bottom = max(top + 1,
+                         (y % scale + 1) * self.tileHeight // scale)
+            return parent.crop((left, top, right, bottom)).resize(
+                (self.tileWidth, self.tileHeight))
+        return None
+
+    @instanceLruCache(ParentTileCacheSize)
+    def _getParentTileImage(self, x, y, z):
+        """
+        Decode a tile used to generate missing higher resolution tiles.  Each
+        of these covers many missing tiles, so they are cached.  The returned
+        image must not be modified.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :returns: a PIL image.
+        :raises: TiffException if the tile has no data.
+        """
+        tiffDirectory = self._tiffDirectories[z]
+        if tiffDirectory.isTileMissing(x, y):
+            raise IOTiffException('Tile has no data')
+        if tiffDirectory.embeddedJpeg and self.style is None:
+            image = PIL.Image.open(BytesIO(tiffDirectory.getTile(x, y)))
+            image.load()
+            return image
+        return self._getTileImage(x, y, z)
+
+    def getMetadata(self):
+        metadata = super(TiffFileTileSource, self).getMetadata()
+        metadata['channels'] = self._tiffDirectories[-1].samplesPerPixel
+        metadata['dtype'] = self._tiffDirectories[-1].dtype
+        return metadata
+
+    def getTileArray(self, x, y, z):
+        """
+        Get the decoded pixels of a tile without applying a style.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :returns: a numpy array of shape (tileHeight, tileWidth, channels) in
+            the data type of the file.
+        """
+        try:
+            if z < 0:
+                raise IndexError()
+            return self._tiffDirectories[z].getTile(x, y, decode=True)
+        except IndexError:
+            raise TileSourceException('z layer does not exist')
+        except TiffException as e:
+            raise TileSourceException(e.message)
+
+    def _getTileImage(self, x, y, z):
+        """
+        Decode a tile into a PIL image, applying the style if there is one.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :returns: a PIL image.
+        """
+        tile = self._tiffDirectories[z].getTile(x, y, decode=True)
+        style = self.style
+        if style is None and (tile.dtype.name != 'uint8' or
+                              tile.shape[2] not in SampleModes):
+            style = TileStyle()
+        if style is not None:
+            return PIL.Image.fromarray(style.apply(tile), 'RGB')
+        image = PIL.Image.fromarray(
+            tile if tile.shape[2] != 1 else tile[:, :, 0],
+            SampleModes[tile.shape[2]])
+        if self.encoding == 'JPEG' and image.mode in ('LA', 'RGBA'):
+            # JPEG doesn't support alpha
+            image = image.convert(image.mode[:-1])
+        return image
+
+    @instanceLruCache(EncodedTileCacheSize)
+    def _getEncodedTile(self, x, y, z):
+        """
+        Decode a tile and encode it with this tile source's encoding and
+        quality.  Tiles are cached, since decoding and encoding is much slower
+        than serving stored JPEGs.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :returns: the encoded tile.
+        """
+        image = self._getTileImage(x, y, z)
+        output = BytesIO()
+        image.save(output, self.encoding, quality=self.jpegQuality,
+                   subsampling=self.jpegSubsampling)
+        return output.getvalue()
+
+    def getTileMimeType(self):
+        return self.outputMimeTypes[self.encoding]
 
 
 if girder:
@@ -121,4 +393,11 @@ if girder:
         @staticmethod
         def cacheKeyFunc(args, kwargs):
             item = args[0]
-            return item.get('largeImage', {}).get('fileId')
+            return (item.get('largeImage', {}).get('fileId'),
+                    kwargs.get('jpegQuality'),
+                    kwargs.get('jpegSubsampling'),
+                    kwargs.get('encoding'),
+                    kwargs.get('channels'),
+                    kwargs.get('windowMin'),
+                    kwargs.get('windowMax'),
+                    kwargs.get('colormap'))
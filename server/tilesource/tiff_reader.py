@@ -19,13 +19,47 @@
 
 import base64
 import ctypes
+import mmap
 import os
 import six
+import threading
 
 from libtiff import libtiff_ctypes
 
 from .cache import instanceLruCache
 
+# Tiles that aren't JPEG-compressed RGB are decoded into numpy arrays
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None
+
+
+# Compression schemes that libtiff can't decode, but PIL can decode from the
+# raw tile data.  These are all JPEG 2000; 33003 is YCbCr and the rest RGB.
+PILDecodedCompressions = {
+    33003: 'YCbCr',
+    33005: 'RGB',
+    34712: 'RGB',
+}
+
+# numpy data types for each (SampleFormat, BitsPerSample) that can be decoded
+DecodedSampleTypes = {
+    (libtiff_ctypes.SAMPLEFORMAT_UINT, 8): 'uint8',
+    (libtiff_ctypes.SAMPLEFORMAT_UINT, 16): 'uint16',
+    (libtiff_ctypes.SAMPLEFORMAT_UINT, 32): 'uint32',
+    (libtiff_ctypes.SAMPLEFORMAT_INT, 8): 'int8',
+    (libtiff_ctypes.SAMPLEFORMAT_INT, 16): 'int16',
+    (libtiff_ctypes.SAMPLEFORMAT_INT, 32): 'int32',
+    (libtiff_ctypes.SAMPLEFORMAT_IEEEFP, 32): 'float32',
+    (libtiff_ctypes.SAMPLEFORMAT_IEEEFP, 64): 'float64',
+}
+
 
 def patchLibtiff():
     libtiff_ctypes.libtiff.TIFFFieldWithTag.restype = \
@@ -39,6 +73,14 @@ def patchLibtiff():
     libtiff_ctypes.TIFFDataType.TIFF_SLONG8 = 17
     # BigTIFF 64-bit unsigned integer (offset)
     libtiff_ctypes.TIFFDataType.TIFF_IFD8 = 18
+
+    # Decoded tiles are read directly into numpy arrays
+    libtiff_ctypes.libtiff.TIFFReadEncodedTile.restype = ctypes.c_ssize_t
+    libtiff_ctypes.libtiff.TIFFReadEncodedTile.argtypes = (
+        libtiff_ctypes.TIFF, ctypes.c_uint32, ctypes.c_void_p,
+        ctypes.c_ssize_t)
+    libtiff_ctypes.libtiff.TIFFIsCODECConfigured.restype = ctypes.c_int
+    libtiff_ctypes.libtiff.TIFFIsCODECConfigured.argtypes = (ctypes.c_uint16, )
 patchLibtiff()
 
 
@@ -84,6 +126,9 @@ class TiledTiffDirectory(object):
         ValidationTiffException
         """
         self._tiffFile = None
+        self._fileMap = None
+        # libtiff file handles can't be read from multiple threads at once
+        self._tileLock = threading.RLock()
 
         self._open(filePath, directoryNum)
         try:
@@ -92,6 +137,8 @@ class TiledTiffDirectory(object):
             self._close()
             raise
         self._loadMetadata()
+        if self._embeddedJpeg:
+            self._mapFile(filePath)
 
     def __del__(self):
         self._close()
@@ -126,10 +173,67 @@ class TiledTiffDirectory(object):
         if self._tiffFile:
             self._tiffFile.close()
             self._tiffFile = None
+        if self._fileMap is not None:
+            self._fileMap.close()
+            self._fileMap = None
+
+    def _mapFile(self, filePath):
+        """
+        Map the TIFF file into memory, so that embedded JPEG tiles can be
+        copied straight from the page cache instead of being read by libtiff
+        into an intermediate buffer.  If the file can't be mapped, tiles are
+        read through libtiff.
+
+        :param filePath: A path to the TIFF file on disk.
+        :type filePath: str
+        """
+        try:
+            with open(filePath, 'rb') as f:
+                self._fileMap = mmap.mmap(f.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError, OverflowError):
+            self._fileMap = None
 
     def _validate(self):
         """
         Validate that this TIFF file and directory are suitable for reading.
+        Directories with JPEG-compressed RGB tiles and shared JPEG tables are
+        served without decoding.  Other directories are decoded if numpy is
+        available.
+
+        :raises: ValidationTiffException
+        """
+        if not self._tiffFile.IsTiled():
+            raise ValidationTiffException('Only tiled TIFF files are supported')
+
+        if self._tiffFile.GetField('TileWidth') != \
+                self._tiffFile.GetField('TileLength'):
+            raise ValidationTiffException('Non-square TIFF tiles are not'
+                                          ' supported')
+
+        if self._tiffFile.GetField('PlanarConfig') != \
+                libtiff_ctypes.PLANARCONFIG_CONTIG:
+            raise ValidationTiffException('Only contiguous planar configuration'
+                                          ' TIFF files are supported')
+
+        if self._tiffFile.GetField('Orientation') != \
+                libtiff_ctypes.ORIENTATION_TOPLEFT:
+            raise ValidationTiffException('Only top-left orientation TIFF files'
+                                          ' are supported')
+
+        try:
+            self._validateEmbeddedJpeg()
+            self._embeddedJpeg = True
+        except ValidationTiffException:
+            if numpy is None:
+                raise
+            self._embeddedJpeg = False
+            self._validateDecodable()
+
+    def _validateEmbeddedJpeg(self):
+        """
+        Validate that the tiles of this directory are JPEG images that can be
+        served without decoding them.
 
         :raises: ValidationTiffException
         """
@@ -146,11 +250,6 @@ class TiledTiffDirectory(object):
             raise ValidationTiffException('Only unsigned int sampled TIFF files'
                                           ' are supported')
 
-        if self._tiffFile.GetField('PlanarConfig') != \
-                libtiff_ctypes.PLANARCONFIG_CONTIG:
-            raise ValidationTiffException('Only contiguous planar configuration'
-                                          ' TIFF files are supported')
-
         if self._tiffFile.GetField('Photometric') not in (
                 libtiff_ctypes.PHOTOMETRIC_RGB,
                 libtiff_ctypes.PHOTOMETRIC_YCBCR):
@@ -158,24 +257,11 @@ class TiledTiffDirectory(object):
                                           ' interpretation TIFF files are'
                                           ' supported')
 
-        if self._tiffFile.GetField('Orientation') != \
-                libtiff_ctypes.ORIENTATION_TOPLEFT:
-            raise ValidationTiffException('Only top-left orientation TIFF files'
-                                          ' are supported')
-
         if self._tiffFile.GetField('Compression') != \
                 libtiff_ctypes.COMPRESSION_JPEG:
             raise ValidationTiffException('Only JPEG compression TIFF files are'
                                           ' supported')
 
-        if not self._tiffFile.IsTiled():
-            raise ValidationTiffException('Only tiled TIFF files are supported')
-
-        if self._tiffFile.GetField('TileWidth') != \
-                self._tiffFile.GetField('TileLength'):
-            raise ValidationTiffException('Non-square TIFF tiles are not'
-                                          ' supported')
-
         if self._tiffFile.GetField('JpegTablesMode') != \
                 libtiff_ctypes.JPEGTABLESMODE_QUANT | \
                 libtiff_ctypes.JPEGTABLESMODE_HUFF:
@@ -183,6 +269,64 @@ class TiledTiffDirectory(object):
                                           ' Huffman and quantization tables are'
                                           ' supported')
 
+    def _validateDecodable(self):
+        """
+        Validate that the tiles of this directory can be decoded, either by
+        libtiff or, for JPEG 2000, by PIL.
+
+        :raises: ValidationTiffException
+        """
+        samples = self._tiffFile.GetField('SamplesPerPixel') or 1
+        bits = self._tiffFile.GetField('BitsPerSample') or 1
+        sampleFormat = self._tiffFile.GetField('SampleFormat') or \
+            libtiff_ctypes.SAMPLEFORMAT_UINT
+        if (sampleFormat, bits) not in DecodedSampleTypes:
+            raise ValidationTiffException(
+                'Unsupported TIFF sample format %d with %d bits per sample' % (
+                    sampleFormat, bits))
+        self._dtype = numpy.dtype(DecodedSampleTypes[(sampleFormat, bits)])
+        self._samplesPerPixel = samples
+
+        photometric = self._tiffFile.GetField('Photometric')
+        if photometric == libtiff_ctypes.PHOTOMETRIC_MINISBLACK:
+            # Multichannel images, such as fluorescence images, have one
+            # sample per channel
+            pass
+        elif photometric == libtiff_ctypes.PHOTOMETRIC_MINISWHITE:
+            if samples not in (1, 2) or self._dtype.kind != 'u':
+                raise ValidationTiffException(
+                    'Min-is-white TIFF files must have one or two unsigned'
+                    ' samples per pixel')
+        elif photometric in (libtiff_ctypes.PHOTOMETRIC_RGB,
+                             libtiff_ctypes.PHOTOMETRIC_YCBCR):
+            if samples not in (3, 4):
+                raise ValidationTiffException(
+                    'RGB TIFF files must have three or four samples per pixel')
+        else:
+            raise ValidationTiffException('Only grayscale, multichannel, RGB,'
+                                          ' and YCbCr photometric'
+                                          ' interpretation TIFF files are'
+                                          ' supported')
+        self._photometric = photometric
+
+        compression = self._tiffFile.GetField('Compression')
+        self._pilDecodeMode = PILDecodedCompressions.get(compression)
+        if self._pilDecodeMode:
+            if PIL is None:
+                raise ValidationTiffException('PIL is required to decode JPEG'
+                                              ' 2000 TIFF files')
+            return
+        if libtiff_ctypes.libtiff.TIFFIsCODECConfigured(compression) != 1:
+            raise ValidationTiffException(
+                'TIFF compression %d is not supported by libtiff' % compression)
+        if photometric == libtiff_ctypes.PHOTOMETRIC_YCBCR:
+            if compression != libtiff_ctypes.COMPRESSION_JPEG:
+                raise ValidationTiffException('Only JPEG compression YCbCr TIFF'
+                                              ' files are supported')
+            # Have libtiff convert the decoded tiles to RGB
+            self._tiffFile.SetField('JpegColorMode',
+                                    libtiff_ctypes.JPEGCOLORMODE_RGB)
+
     def _loadMetadata(self):
         self._tileWidth = self._tiffFile.GetField('TileWidth')
         self._tileHeight = self._tiffFile.GetField('TileLength')
@@ -304,41 +448,111 @@ class TiledTiffDirectory(object):
         if tileNum >= totalTileCount:
             raise InvalidOperationTiffException('Tile number out of range')
 
+        # In practice, this will never overflow, and it's simpler to convert the
+        # long to an int
+        return int(self._getRawTileSizes()[tileNum])
+
+    def _getRawTileSizes(self):
+        """
+        Get the file sizes in bytes of the raw encoded data of all tiles.
+
+        :return: A ctypes array of sizes indexed by internal tile number.
+        :raises: IOTiffException
+        """
         # pylibtiff treats the output of TIFFTAG_TILEBYTECOUNTS as a scalar
         # uint32; libtiff's documentation specifies that the output will be an
         # array of uint32; in reality and per the TIFF spec, the output is an
         # array of either uint64 or unit16, so we need to call the ctypes
         # interface directly to get this tag
         # http://www.awaresystems.be/imaging/tiff/tifftags/tilebytecounts.html
+        return self._getTileArrayField(
+            libtiff_ctypes.TIFFTAG_TILEBYTECOUNTS,
+            self._getTileByteCountsType(), 'Could not get raw tile size')
+
+    @instanceLruCache(1)
+    def _getTileOffsetsType(self):
+        """
+        Get data type of the elements in the TIFFTAG_TILEOFFSETS array.
 
-        rawTileSizesType = self._getTileByteCountsType()
-        rawTileSizes = ctypes.POINTER(rawTileSizesType)()
+        :return: The element type in TIFFTAG_TILEOFFSETS.
+        :rtype: ctypes.c_uint64 or ctypes.c_uint32
+        :raises: IOTiffException
+        """
+        tileOffsetsFieldInfo = libtiff_ctypes.libtiff.TIFFFieldWithTag(
+            self._tiffFile, libtiff_ctypes.TIFFTAG_TILEOFFSETS).contents
+        tileOffsetsLibtiffType = tileOffsetsFieldInfo.field_type
+
+        if tileOffsetsLibtiffType in (libtiff_ctypes.TIFFDataType.TIFF_LONG8,
+                                      libtiff_ctypes.TIFFDataType.TIFF_IFD8):
+            return ctypes.c_uint64
+        elif tileOffsetsLibtiffType == libtiff_ctypes.TIFFDataType.TIFF_LONG:
+            return ctypes.c_uint32
+        else:
+            raise IOTiffException('Invalid type for TIFFTAG_TILEOFFSETS:'
+                                  ' %s' % tileOffsetsLibtiffType)
+
+    def _getRawTileOffsets(self):
+        """
+        Get the file offsets of the raw encoded data of all tiles.
+
+        :return: A ctypes array of offsets indexed by internal tile number.
+        :raises: IOTiffException
+        """
+        return self._getTileArrayField(
+            libtiff_ctypes.TIFFTAG_TILEOFFSETS, self._getTileOffsetsType(),
+            'Could not get raw tile offset')
+
+    def _getTileArrayField(self, tag, elementType, errorMessage):
+        """
+        Get a TIFF field that has one value per tile.
+
+        :param tag: The TIFF tag of the field.
+        :param elementType: The ctypes type of the values.
+        :param errorMessage: The message of the exception raised if the field
+        can't be read.
+        :return: A ctypes array of values indexed by internal tile number.
+        :raises: IOTiffException
+        """
+        values = ctypes.POINTER(elementType)()
 
         libtiff_ctypes.libtiff.TIFFGetField.argtypes = \
             libtiff_ctypes.libtiff.TIFFGetField.argtypes[:2] + \
-            [ctypes.POINTER(ctypes.POINTER(rawTileSizesType))]
+            [ctypes.POINTER(ctypes.POINTER(elementType))]
         if libtiff_ctypes.libtiff.TIFFGetField(
-                self._tiffFile,
-                libtiff_ctypes.TIFFTAG_TILEBYTECOUNTS,
-                ctypes.byref(rawTileSizes)) != 1:
-            raise IOTiffException('Could not get raw tile size')
+                self._tiffFile, tag, ctypes.byref(values)) != 1:
+            raise IOTiffException(errorMessage)
+        return values
 
-        # In practice, this will never overflow, and it's simpler to convert the
-        # long to an int
-        return int(rawTileSizes[tileNum])
+    def getTileByteCounts(self):
+        """
+        Get the size of the stored data of each tile.  Tiles that were never
+        written have a size of 0.
 
-    def _getJpegFrame(self, tileNum):
+        :return: The sizes of the tiles, ordered by row and then by column.
+        :rtype: list
+        :raises: IOTiffException
         """
-        Get the raw encoded JPEG image frame from a tile.
+        with self._tileLock:
+            totalTileCount = libtiff_ctypes.libtiff.TIFFNumberOfTiles(
+                self._tiffFile).value
+            rawTileSizes = self._getRawTileSizes()
+            return [int(rawTileSizes[tileNum])
+                    for tileNum in range(totalTileCount)]
+
+    def _getRawTile(self, tileNum):
+        """
+        Get the raw encoded data of a tile.
 
         :param tileNum: The internal tile number of the desired tile.
         :type tileNum: int
-        :return: The JPEG image frame, including a JPEG Start Of Frame marker.
+        :return: The encoded tile data.
         :rtype: bytes
         :raises: InvalidOperationTiffException or IOTiffException
         """
         # This raises an InvalidOperationTiffException if the tile doesn't exist
         rawTileSize = self._getJpegFrameSize(tileNum)
+        if not rawTileSize:
+            raise IOTiffException('Tile has no data')
 
         frameBuffer = ctypes.create_string_buffer(rawTileSize)
 
@@ -353,28 +567,92 @@ class TiledTiffDirectory(object):
             # It's unlikely that this will ever occur, but incomplete reads will
             # be checked for by looking for the JPEG end marker
             raise IOTiffException('Buffer overflow when reading tile')
+        return frameBuffer.raw
 
-        if frameBuffer.raw[:2] != b'\xff\xd8':
+    def _findJpegFrameStart(self, data, start, end):
+        """
+        Check the markers of a raw JPEG tile and find its JPEG Start Of Frame
+        marker.
+
+        :param data: The raw tile, or a buffer that contains it.
+        :type data: bytes or mmap.mmap
+        :param start: The position of the raw tile in data.
+        :type start: int
+        :param end: The position just past the end of the raw tile in data.
+        :type end: int
+        :return: The position of the JPEG Start Of Frame marker in data.
+        :rtype: int
+        :raises: IOTiffException
+        """
+        if data[start:start + 2] != b'\xff\xd8':
             raise IOTiffException('Missing JPEG Start Of Image marker in frame')
-        if frameBuffer.raw[-2:] != b'\xff\xd9':
+        if data[end - 2:end] != b'\xff\xd9':
             raise IOTiffException('Missing JPEG End Of Image marker in frame')
-        if frameBuffer.raw[2:4] in (b'\xff\xc0', b'\xff\xc2'):
-            frameStartPos = 2
-        else:
-            # VIPS may encode TIFFs with the quantization (but not Huffman)
-            # tables also at the start of every frame, so locate them for
-            # removal
-            # VIPS seems to prefer Baseline DCT, so search for that first
-            frameStartPos = frameBuffer.raw.find(b'\xff\xc0', 2, -2)
+        if data[start + 2:start + 4] in (b'\xff\xc0', b'\xff\xc2'):
+            return start + 2
+        # VIPS may encode TIFFs with the quantization (but not Huffman)
+        # tables also at the start of every frame, so locate them for
+        # removal
+        # VIPS seems to prefer Baseline DCT, so search for that first
+        frameStartPos = data.find(b'\xff\xc0', start + 2, end - 2)
+        if frameStartPos == -1:
+            frameStartPos = data.find(b'\xff\xc2', start + 2, end - 2)
             if frameStartPos == -1:
-                frameStartPos = frameBuffer.raw.find(b'\xff\xc2', 2, -2)
-                if frameStartPos == -1:
-                    raise IOTiffException('Missing JPEG Start Of Frame marker')
+                raise IOTiffException('Missing JPEG Start Of Frame marker')
+        return frameStartPos
+
+    def _getJpegFrame(self, tileNum):
+        """
+        Get the raw encoded JPEG image frame from a tile.
+
+        :param tileNum: The internal tile number of the desired tile.
+        :type tileNum: int
+        :return: The JPEG image frame, including a JPEG Start Of Frame marker.
+        :rtype: bytes
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        frame = self._getRawTile(tileNum)
+        frameStartPos = self._findJpegFrameStart(frame, 0, len(frame))
 
         # Strip the Start / End Of Image markers
-        tileData = frameBuffer.raw[frameStartPos:-2]
+        tileData = frame[frameStartPos:-2]
         return tileData
 
+    def _getMappedJpegFrameRange(self, tileNum):
+        """
+        Get the position of the raw encoded JPEG image frame of a tile in the
+        memory-mapped file.
+
+        :param tileNum: The internal tile number of the desired tile.
+        :type tileNum: int
+        :return: The start and end of the frame in the mapped file, including
+        the JPEG Start Of Frame and End Of Image markers.
+        :rtype: tuple
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        # This also checks that the tile number is in range
+        rawTileSize = self._getJpegFrameSize(tileNum)
+        if not rawTileSize:
+            raise IOTiffException('Tile has no data')
+        offset = int(self._getRawTileOffsets()[tileNum])
+        if offset + rawTileSize > len(self._fileMap):
+            raise IOTiffException('Tile data is past the end of the file')
+        return (self._findJpegFrameStart(
+            self._fileMap, offset, offset + rawTileSize),
+            offset + rawTileSize)
+
+    @instanceLruCache(1)
+    def _getJpegHeader(self):
+        """
+        Get everything that precedes the frame of each complete JPEG tile.
+
+        :return: A JPEG Start Of Image marker, the JPEG tables, and padding.
+        :rtype: bytes
+        :raises: IOTiffException
+        """
+        # TODO: why write padding?
+        return b'\xff\xd8' + self._getJpegTables() + b'\xff\xff\xff\xff'
+
     @property
     def tileWidth(self):
         """
@@ -407,36 +685,152 @@ class TiledTiffDirectory(object):
         # TODO: fetch lazily and memoize
         return self._imageHeight
 
-    def getTile(self, x, y):
+    @property
+    def samplesPerPixel(self):
         """
-        Get the complete JPEG image from a tile.
+        Get the number of samples (channels) in each pixel of decoded tiles.
+
+        :return: The number of samples per pixel.
+        :rtype: int
+        """
+        if self._embeddedJpeg:
+            return 3
+        return self._samplesPerPixel
+
+    @property
+    def dtype(self):
+        """
+        Get the data type of the samples of decoded tiles.
+
+        :return: The numpy data type name.
+        :rtype: str
+        """
+        if self._embeddedJpeg:
+            return 'uint8'
+        return self._dtype.name
+
+    @property
+    def embeddedJpeg(self):
+        """
+        Check if the tiles of this directory are served without decoding.
+
+        :return: True if getTile returns JPEG images by default.
+        :rtype: bool
+        """
+        return self._embeddedJpeg
+
+    def _getDecodedTile(self, tileNum):
+        """
+        Decode a tile into a numpy array.
+
+        :param tileNum: The internal tile number of the desired tile.
+        :type tileNum: int
+        :return: The tile pixels, with shape (tileHeight, tileWidth, samples).
+        :rtype: numpy.ndarray
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        if self._pilDecodeMode:
+            image = PIL.Image.open(six.BytesIO(self._getRawTile(tileNum)))
+            if self._pilDecodeMode == 'YCbCr':
+                image = PIL.Image.merge('YCbCr', image.split()[:3]).convert(
+                    'RGB')
+            tile = numpy.asarray(image)
+            return tile.reshape(tile.shape[:2] + (-1, ))
+
+        if not self._getJpegFrameSize(tileNum):
+            raise IOTiffException('Tile has no data')
+        # The tile is decoded directly into the array's memory
+        tile = numpy.empty(
+            (self._tileHeight, self._tileWidth, self._samplesPerPixel),
+            dtype=self._dtype)
+        bytesRead = libtiff_ctypes.libtiff.TIFFReadEncodedTile(
+            self._tiffFile, tileNum, tile.ctypes.data_as(ctypes.c_void_p),
+            tile.nbytes)
+        if bytesRead == -1:
+            raise IOTiffException('Failed to decode tile')
+        if self._photometric == libtiff_ctypes.PHOTOMETRIC_MINISWHITE:
+            tile[:, :, 0] = numpy.iinfo(self._dtype).max - tile[:, :, 0]
+        return tile
+
+    def isTileMissing(self, x, y):
+        """
+        Check if a tile was never written to the file, which is common in
+        sparse images.  This only reads the tile byte counts.
 
         :param x: The column index of the desired tile.
         :type x: int
         :param y: The row index of the desired tile.
         :type y: int
-        :rtype: bytes
+        :return: True if the tile has no data.
+        :rtype: bool
         :raises: InvalidOperationTiffException or IOTiffException
         """
-        # This raises an InvalidOperationTiffException if the tile doesn't exist
-        tileNum = self._toTileNum(x, y)
+        with self._tileLock:
+            # This raises an InvalidOperationTiffException if the tile doesn't
+            # exist
+            tileNum = self._toTileNum(x, y)
+            return not self._getJpegFrameSize(tileNum)
 
-        imageBuffer = six.BytesIO()
-
-        # Write JPEG Start Of Image marker
-        imageBuffer.write(b'\xff\xd8')
-
-        imageBuffer.write(self._getJpegTables())
-
-        # TODO: why write padding?
-        imageBuffer.write(b'\xff\xff\xff\xff')
-
-        imageBuffer.write(self._getJpegFrame(tileNum))
+    def getTile(self, x, y, decode=False):
+        """
+        Get a tile, either as a complete JPEG image or as decoded pixels.
 
-        # Write JPEG End Of Image marker
-        imageBuffer.write(b'\xff\xd9')
+        :param x: The column index of the desired tile.
+        :type x: int
+        :param y: The row index of the desired tile.
+        :type y: int
+        :param decode: If False and the tiles of this directory are JPEG
+        images, return the JPEG image.  Otherwise, return the decoded pixels.
+        :type decode: bool
+        :return: A JPEG image or an array with shape (tileHeight, tileWidth,
+        samples).
+        :rtype: bytes or numpy.ndarray
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        if self._embeddedJpeg:
+            image = self._getEmbeddedJpeg(x, y)
+            if not decode:
+                return image
+            if numpy is None or PIL is None:
+                raise InvalidOperationTiffException(
+                    'numpy and PIL are required to decode tiles')
+            tile = numpy.asarray(PIL.Image.open(six.BytesIO(image)))
+            return tile.reshape(tile.shape[:2] + (-1, ))
+
+        with self._tileLock:
+            # This raises an InvalidOperationTiffException if the tile doesn't
+            # exist
+            tileNum = self._toTileNum(x, y)
+            return self._getDecodedTile(tileNum)
+
+    def _getEmbeddedJpeg(self, x, y):
+        """
+        Get the complete JPEG image from a tile.
 
-        return imageBuffer.getvalue()
+        :param x: The column index of the desired tile.
+        :type x: int
+        :param y: The row index of the desired tile.
+        :type y: int
+        :rtype: bytes
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        with self._tileLock:
+            # This raises an InvalidOperationTiffException if the tile doesn't
+            # exist
+            tileNum = self._toTileNum(x, y)
+            header = self._getJpegHeader()
+            if self._fileMap is None:
+                # Write the JPEG End Of Image marker after the frame
+                return header + self._getJpegFrame(tileNum) + b'\xff\xd9'
+            frameStart, frameEnd = self._getMappedJpegFrameRange(tileNum)
+
+        # The frame's own End Of Image marker is kept.  Joining a view of the
+        # mapped file copies the frame exactly once, and doesn't need the
+        # libtiff handle, so it is done without holding the lock.
+        if six.PY3:
+            with memoryview(self._fileMap) as fileView:
+                return b''.join((header, fileView[frameStart:frameEnd]))
+        return header + self._fileMap[frameStart:frameEnd]
 
     # TODO: refactor and remove this
     def parse_image_description(self):
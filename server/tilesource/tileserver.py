@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+import six
+from six.moves import urllib
+
+from . import getTileSource
+from .base import TileGeneralException, TileSourceException
+from .signing import verifyToken
+from ..constants import TileCacheMaxAge
+
+try:
+    import asyncio
+    import concurrent.futures
+except ImportError:
+    asyncio = None
+
+logger = logging.getLogger('large_image.tileserver')
+
+# Number of threads used to read and encode tiles
+TileServerThreads = 8
+# Seconds after which idle connections are closed
+KeepAliveTimeout = 75
+# Requests with longer headers than this are refused
+MaxHeaderSize = 16384
+
+HttpReasons = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+}
+
+
+class TileServer(object):
+    """
+    A standalone server for the tiles of files in Girder's filesystem
+    assetstores.  It doesn't use Girder: clients present a token signed by the
+    Girder plugin with a shared secret, which names the assetstore and the
+    path within it of the file whose tiles they may read.  Connections are
+    handled by asyncio, and tiles are read and encoded in a thread pool, so a
+    few threads can serve many open connections.  Serving requires Python 3.
+
+    Tiles are served from /tiles/<token>/<z>/<x>/<y>, and the tile metadata
+    from /tiles/<token>.  Run the server with
+    "python -m large_image.server.tilesource.tileserver --secret <secret>
+    --assetstore <assetstore id>=<root directory>".
+    """
+    def __init__(self, secret, assetstores, threads=TileServerThreads):
+        """
+        :param secret: the secret shared with the Girder plugin.
+        :param assetstores: a dictionary of the root directories of the
+            assetstores whose files can be read, keyed by assetstore id.
+        :param threads: the number of threads used to read tiles.
+        """
+        if not secret:
+            raise ValueError('A secret is required.')
+        self.secret = secret
+        self.assetstores = assetstores
+        self.threads = threads
+        self.port = None
+        self.ready = threading.Event()
+
+    def _errorResponse(self, status, message):
+        return status, {'Content-Type': 'application/json'}, json.dumps({
+            'message': message, 'type': 'rest'}).encode('utf8')
+
+    def _getPath(self, payload):
+        """
+        Get the local path of the file named by a token.
+
+        :param payload: the payload of a verified token.
+        :returns: the path of the file.
+        """
+        root = os.path.abspath(self.assetstores[payload['assetstore']])
+        path = os.path.normpath(os.path.join(root, payload['path']))
+        if not path.startswith(os.path.join(root, '')):
+            raise TileSourceException('The path is outside the assetstore.')
+        return path
+
+    def handle(self, method, target):
+        """
+        Answer a request.  This blocks, so the protocol runs it in the thread
+        pool.
+
+        :param method: the HTTP method.
+        :param target: the request target, a path with an optional query.
+        :returns: a tuple of the HTTP status, a dictionary of headers, and the
+            body as bytes.
+        """
+        if method not in ('GET', 'HEAD'):
+            return self._errorResponse(405, 'Only GET requests are allowed.')
+        parts = urllib.parse.urlsplit(target).path.strip('/').split('/')
+        if parts[0] != 'tiles' or len(parts) not in (2, 5):
+            return self._errorResponse(404, 'No such route.')
+        try:
+            payload = verifyToken(self.secret, parts[1])
+            path = self._getPath(payload)
+        except (TileGeneralException, KeyError, TypeError):
+            return self._errorResponse(403, 'Invalid or expired token.')
+        try:
+            source = getTileSource(path)
+            if len(parts) == 2:
+                status, headers, body = 200, {
+                    'Content-Type': 'application/json'}, json.dumps(
+                    source.getMetadata()).encode('utf8')
+            else:
+                try:
+                    z, x, y = [int(value) for value in parts[2:]]
+                except ValueError:
+                    return self._errorResponse(
+                        400, 'x, y, and z must be integers')
+                if x < 0 or y < 0 or z < 0:
+                    return self._errorResponse(
+                        400, 'x, y, and z must be positive integers')
+                status, headers, body = 200, {
+                    'Content-Type': source.getTileMimeType()
+                }, source.getTile(x, y, z)
+        except TileGeneralException as exc:
+            return self._errorResponse(404, exc.args[0] if exc.args else '')
+        # The token is part of the URL, so the response can be cached for as
+        # long as the token is valid.
+        headers['Cache-Control'] = 'private, max-age=%d' % max(0, min(
+            TileCacheMaxAge, payload['exp'] - int(time.time())))
+        return status, headers, body
+
+    def serve(self, host='127.0.0.1', port=8088):
+        """
+        Serve requests until interrupted or stopped.  Once the server is
+        listening, the ready event is set and port is the port it listens on.
+
+        :param host: the interface to listen on.
+        :param port: the port to listen on.  0 to pick an unused port.
+        """
+        if asyncio is None:
+            raise RuntimeError('The tile server requires Python 3.')
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(self.threads))
+        server = loop.run_until_complete(loop.create_server(
+            lambda: TileServerProtocol(self, loop), host, port))
+        self.port = server.sockets[0].getsockname()[1]
+        self._loop = loop
+        logger.info('Serving tiles on %s:%d' % (host, self.port))
+        self.ready.set()
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.ready.clear()
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
+
+    def stop(self):
+        """
+        Stop serving.  This can be called from any thread once the server is
+        ready.
+        """
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+class TileServerProtocol(asyncio.Protocol if asyncio else object):
+    """
+    A minimal HTTP/1.1 connection for the tile server.  Requests on a
+    connection are answered in order, one at a time, and nothing more is read
+    from the connection while a request is being answered.  Connections are
+    kept open between requests unless the client asks otherwise.
+    """
+    def __init__(self, server, loop):
+        self.server = server
+        self.loop = loop
+        self.transport = None
+        self.buffer = b''
+        self.pending = False
+        self.idleHandle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._resetIdleTimer()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.idleHandle is not None:
+            self.idleHandle.cancel()
+
+    def _resetIdleTimer(self):
+        if self.idleHandle is not None:
+            self.idleHandle.cancel()
+        self.idleHandle = self.loop.call_later(
+            KeepAliveTimeout, self._closeIdle)
+
+    def _closeIdle(self):
+        if self.transport is not None and not self.pending:
+            self.transport.close()
+
+    def data_received(self, data):
+        self.buffer += data
+        self._resetIdleTimer()
+        self._nextRequest()
+
+    def _nextRequest(self):
+        """
+        Start answering the next complete request in the buffer, if no
+        request is being answered.
+        """
+        if self.pending or self.transport is None:
+            return
+        end = self.buffer.find(b'\r\n\r\n')
+        if end < 0:
+            if len(self.buffer) > MaxHeaderSize:
+                self._write(431, {}, b'', 'HTTP/1.1', False, False)
+            return
+        head, self.buffer = self.buffer[:end], self.buffer[end + 4:]
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+            headers = {}
+            for line in lines[1:]:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        except ValueError:
+            self._write(400, {}, b'', 'HTTP/1.1', False, False)
+            return
+        if headers.get('content-length', '0') != '0' or \
+                'transfer-encoding' in headers:
+            # Tile requests don't have bodies, so don't try to skip them
+            self._write(400, {}, b'', version, False, False)
+            return
+        connection = headers.get('connection', '').lower()
+        keepAlive = ('close' not in connection if version == 'HTTP/1.1'
+                     else 'keep-alive' in connection)
+        self.pending = True
+        # Don't read any more until this request is answered, so a client
+        # that keeps sending requests can't make the buffer grow.
+        self.transport.pause_reading()
+        future = self.loop.run_in_executor(
+            None, self.server.handle, method, target)
+        future.add_done_callback(
+            lambda future: self._respond(future, method, version, keepAlive))
+
+    def _respond(self, future, method, version, keepAlive):
+        self.pending = False
+        self._resetIdleTimer()
+        try:
+            status, headers, body = future.result()
+        except Exception:
+            logger.exception('Failed to answer a tile request')
+            status, headers, body = 500, {}, b''
+        self._write(status, headers, body, version, keepAlive,
+                    method != 'HEAD')
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.resume_reading()
+        self._nextRequest()
+
+    def _write(self, status, headers, body, version, keepAlive, sendBody=True):
+        """
+        Send a response.  The connection is closed after it unless keepAlive
+        is True.
+        """
+        if self.transport is None:
+            return
+        headers = dict(headers)
+        headers['Content-Length'] = str(len(body))
+        headers['Access-Control-Allow-Origin'] = '*'
+        if version == 'HTTP/1.0' and keepAlive:
+            headers['Connection'] = 'keep-alive'
+        elif not keepAlive:
+            headers['Connection'] = 'close'
+        head = ''.join(['%s %d %s\r\n' % (
+            version if version in ('HTTP/1.0', 'HTTP/1.1') else 'HTTP/1.1',
+            status, HttpReasons.get(status, ''))] + [
+            '%s: %s\r\n' % item for item in six.iteritems(headers)] + [
+            '\r\n']).encode('latin-1')
+        # Writing the body separately avoids copying it into the head
+        self.transport.writelines([head, body] if sendBody else [head])
+        if not keepAlive:
+            self.transport.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Serve the tiles of large images to clients with tokens '
+        'from the Girder large_image plugin.')
+    parser.add_argument(
+        '--host', default='127.0.0.1', help='The interface to listen on.')
+    parser.add_argument(
+        '--port', type=int, default=8088, help='The port to listen on.')
+    parser.add_argument(
+        '--secret', default=os.environ.get('LARGE_IMAGE_TILE_SECRET'),
+        help='The secret used to sign tokens.  This must match the '
+        'tile_signing_secret setting of the Girder plugin.  Defaults to the '
+        'LARGE_IMAGE_TILE_SECRET environment variable.')
+    parser.add_argument(
+        '--assetstore', action='append', default=[], metavar='ID=ROOT',
+        help='The id and root directory of a Girder filesystem assetstore '
+        'whose files can be read.  This may be given more than once.')
+    parser.add_argument(
+        '--threads', type=int, default=TileServerThreads,
+        help='The number of threads used to read tiles.')
+    opts = parser.parse_args(args)
+    if asyncio is None:
+        parser.error('The tile server requires Python 3.')
+    if not opts.secret:
+        parser.error('A secret is required.')
+    if not opts.assetstore or not all('=' in value
+                                      for value in opts.assetstore):
+        parser.error('At least one assetstore id and root is required.')
+    assetstores = dict(value.split('=', 1) for value in opts.assetstore)
+    logging.basicConfig(level=logging.INFO)
+    TileServer(opts.secret, assetstores, opts.threads).serve(
+        opts.host, opts.port)
+
+
+if __name__ == '__main__':
+    main()
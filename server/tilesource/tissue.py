@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import base64
+import math
+
+import numpy
+import PIL.Image
+import six
+
+from .base import TileSourceException
+
+
+# The maximum width and height of the thumbnail used to compute a tissue mask
+TissueMaskSize = 512
+# Pixels whose channels differ by more than this are tissue regardless of
+# their brightness, since stained tissue is colored and glass is gray.
+TissueSaturationThreshold = 25
+# Pixels darker than this are treated as outside of the scanned area
+TissueBlackThreshold = 10
+# The number of times the mask is closed and opened to fill small holes and
+# remove specks of dust
+TissueMorphologyIterations = 2
+
+
+def otsuThreshold(values):
+    """
+    Find the threshold that best separates 8-bit values into two classes
+    using Otsu's method.
+
+    :param values: a numpy array of values from 0 to 255.
+    :returns: the threshold.  Values below it are in the lower class.
+    """
+    histogram = numpy.bincount(
+        values.astype(numpy.uint8).ravel(), minlength=256).astype(float)
+    levels = numpy.arange(256, dtype=float)
+    weightLow = numpy.cumsum(histogram)
+    weightHigh = weightLow[-1] - weightLow
+    sumLow = numpy.cumsum(histogram * levels)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        meanLow = sumLow / weightLow
+        meanHigh = (sumLow[-1] - sumLow) / weightHigh
+        variance = weightLow * weightHigh * (meanLow - meanHigh) ** 2
+    variance[~numpy.isfinite(variance)] = 0
+    return int(numpy.argmax(variance)) + 1
+
+
+def _shifted(mask, combine, initial):
+    """
+    Combine each pixel of a mask with its eight neighbors.
+
+    :param mask: a 2-D boolean numpy array.
+    :param combine: numpy.logical_or to dilate, numpy.logical_and to erode.
+    :param initial: the value used beyond the edges of the mask.
+    :returns: a new mask.
+    """
+    padded = numpy.pad(mask, 1, 'constant', constant_values=initial)
+    height, width = mask.shape
+    result = mask.copy()
+    for dy in range(3):
+        for dx in range(3):
+            combine(result, padded[dy:dy + height, dx:dx + width],
+                    out=result)
+    return result
+
+
+def dilate(mask):
+    return _shifted(mask, numpy.logical_or, False)
+
+
+def erode(mask):
+    return _shifted(mask, numpy.logical_and, True)
+
+
+def computeTissueMask(image, threshold=None):
+    """
+    Find the tissue in a low resolution image of a brightfield slide.  Tissue
+    is darker or more colorful than the glass around it.
+
+    :param image: a PIL image of the whole slide.
+    :param threshold: the brightness below which pixels are tissue.  None to
+        pick a threshold from the image.
+    :returns: the mask as a 2-D boolean numpy array and the threshold used.
+    """
+    if image.mode in ('RGBA', 'LA'):
+        # Transparent areas weren't scanned
+        alpha = numpy.asarray(image.split()[-1]) > 0
+    else:
+        alpha = True
+    rgb = numpy.asarray(image.convert('RGB')).astype(numpy.int16)
+    brightness = rgb.mean(axis=2)
+    saturation = rgb.max(axis=2) - rgb.min(axis=2)
+    scanned = alpha & (brightness > TissueBlackThreshold)
+    if threshold is None:
+        values = brightness[scanned]
+        threshold = otsuThreshold(values) if values.size else 0
+    mask = scanned & ((brightness < threshold) |
+                      (saturation > TissueSaturationThreshold))
+    # Close then open to fill holes and remove isolated pixels
+    for _ in range(TissueMorphologyIterations):
+        mask = dilate(mask)
+    for _ in range(TissueMorphologyIterations * 2):
+        mask = erode(mask)
+    for _ in range(TissueMorphologyIterations):
+        mask = dilate(mask)
+    return mask, threshold
+
+
+def getSourceTissueMask(source, size=TissueMaskSize, threshold=None):
+    """
+    Compute the tissue mask of a tile source from a low resolution region.
+
+    :param source: the tile source.
+    :param size: the maximum width and height of the mask.
+    :param threshold: the brightness below which pixels are tissue.  None to
+        pick a threshold from the image.
+    :returns: the mask as a 2-D boolean numpy array and the threshold used.
+    """
+    regionData, _ = source.getRegion(width=size, height=size,
+                                     encoding='PNG')
+    if not regionData:
+        raise TileSourceException('The image is empty.')
+    return computeTissueMask(PIL.Image.open(six.BytesIO(regionData)),
+                             threshold)
+
+
+def encodeMask(mask, threshold=None):
+    """
+    Convert a mask to a form that can be stored in a database.
+
+    :param mask: a 2-D boolean numpy array.
+    :param threshold: the threshold used to compute the mask.
+    :returns: a dictionary with the width, height, threshold, and the mask
+        as base64-encoded packed bits.
+    """
+    return {
+        'width': int(mask.shape[1]),
+        'height': int(mask.shape[0]),
+        'threshold': threshold,
+        'mask': base64.b64encode(
+            numpy.packbits(mask.astype(numpy.uint8))).decode('ascii'),
+    }
+
+
+def decodeMask(record):
+    """
+    Convert a stored mask back to a numpy array.
+
+    :param record: a dictionary from encodeMask.
+    :returns: a 2-D boolean numpy array.
+    """
+    bits = numpy.frombuffer(base64.b64decode(record['mask']),
+                            dtype=numpy.uint8)
+    count = record['width'] * record['height']
+    return numpy.unpackbits(bits)[:count].reshape(
+        record['height'], record['width']).astype(bool)
+
+
+def getTileOccupancy(mask, metadata, level):
+    """
+    Find which tiles of a level contain tissue.
+
+    :param mask: a 2-D boolean numpy array covering the whole image.
+    :param metadata: the tile source metadata.
+    :param level: the level of the tiles.
+    :returns: a 2-D boolean numpy array with one entry per tile, indexed by
+        row and then column.
+    """
+    if not 0 <= level < metadata['levels']:
+        raise TileSourceException('z layer does not exist')
+    scale = 2 ** (metadata['levels'] - 1 - level)
+    tileWidth = metadata['tileWidth'] * scale
+    tileHeight = metadata['tileHeight'] * scale
+    tilesAcross = int(math.ceil(float(metadata['sizeX']) / tileWidth))
+    tilesDown = int(math.ceil(float(metadata['sizeY']) / tileHeight))
+    maskHeight, maskWidth = mask.shape
+    # The bounds of each tile in mask pixels.  Every tile covers at least one
+    # mask pixel, even when tiles are smaller than mask pixels.
+    bounds = []
+    for count, tileSize, imageSize, maskSize in (
+            (tilesAcross, tileWidth, metadata['sizeX'], maskWidth),
+            (tilesDown, tileHeight, metadata['sizeY'], maskHeight)):
+        edges = numpy.arange(count + 1) * tileSize * float(
+            maskSize) / imageSize
+        low = numpy.clip(numpy.floor(edges[:-1]).astype(int), 0, maskSize - 1)
+        high = numpy.clip(numpy.ceil(edges[1:]).astype(int), low + 1,
+                          maskSize)
+        bounds.append((low, high))
+    # Count the tissue pixels in each tile with a summed area table
+    table = numpy.zeros((maskHeight + 1, maskWidth + 1), dtype=numpy.int64)
+    table[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+    (x0, x1), (y0, y1) = bounds
+    y0, y1 = y0[:, numpy.newaxis], y1[:, numpy.newaxis]
+    counts = table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+    return counts > 0
+
+
+def iterOccupiedTiles(mask, metadata, level):
+    """
+    Iterate through the tiles of a level that contain tissue.
+
+    :param mask: a 2-D boolean numpy array covering the whole image.
+    :param metadata: the tile source metadata.
+    :param level: the level of the tiles.
+    :returns: an iterator of (x, y) tile positions, ordered by row.
+    """
+    occupancy = getTileOccupancy(mask, metadata, level)
+    for y, x in zip(*numpy.nonzero(occupancy)):
+        yield int(x), int(y)
@@ -52,7 +52,11 @@ setup(
         'large_image.server': 'server',
     },
     entry_points={
-        'girder.plugin': 'large_image = large_image.server:load'
+        'girder.plugin': 'large_image = large_image.server:load',
+        'console_scripts': [
+            'large_image_tileserver = '
+            'large_image.server.tilesource.tileserver:main',
+        ],
     },
     classifiers=[
         'Development Status :: 3 - Alpha',